@@ -73,18 +73,34 @@ PYBIND11_MODULE(_urunet, m)
         )
         .def(
             "transform",
-            [](urunet::rc4& self, const pybind11::bytes& buffer) {
-                const Py_ssize_t size = PyBytes_Size(buffer.ptr());
-                if (size <= 256) {
-                    char temp[256];
-                    self.transform(PyBytes_AsString(buffer.ptr()), temp, size);
-                    return pybind11::bytes(temp, size);
-                } else {
-                    auto temp = std::make_unique<char[]>(size);
-                    self.transform(PyBytes_AsString(buffer.ptr()), temp.get(), size);
-                    return pybind11::bytes(temp.get(), size);
-                }
-            }
+            [](urunet::rc4& self, const pybind11::buffer& buffer) {
+                // Transform straight into the new bytes object instead of bouncing through a
+                // temporary buffer and copying it in.
+                const pybind11::buffer_info in = buffer.request();
+                const Py_ssize_t size = in.size * in.itemsize;
+                PyObject* result = PyBytes_FromStringAndSize(nullptr, size);
+                if (!result)
+                    throw pybind11::error_already_set();
+                self.transform(in.ptr, PyBytes_AS_STRING(result), size);
+                return pybind11::reinterpret_steal<pybind11::bytes>(result);
+            },
+            pybind11::pos_only(),
+            pybind11::arg("buffer")
+        )
+        .def(
+            "transform_into",
+            [](urunet::rc4& self, const pybind11::buffer& inbuf, const pybind11::buffer& outbuf) {
+                const pybind11::buffer_info in = inbuf.request();
+                const pybind11::buffer_info out = outbuf.request(true);
+                const Py_ssize_t size = in.size * in.itemsize;
+                if (out.size * out.itemsize < size)
+                    throw pybind11::value_error("output buffer is too small");
+                self.transform(in.ptr, out.ptr, size);
+                return size;
+            },
+            pybind11::pos_only(),
+            pybind11::arg("inbuf"),
+            pybind11::arg("outbuf")
         )
     ;
 }
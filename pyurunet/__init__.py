@@ -14,7 +14,60 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from .authcli import *
-from .filecli import *
-from .gatecli import *
+
+import importlib
+
+# The errors are cheap and everyone wants them. Everything else is only imported when it's first
+# used, so tools that only need one client (or none at all) don't pay for all of them.
 from ._netio.errors import *
+
+# name -> module it lives in
+_lazy = {
+    "AuthCli": "authcli",
+    "GameRank": "authcli",
+    "GameScore": "authcli",
+    "LoginResult": "authcli",
+    "Player": "authcli",
+    "RankTable": "authcli",
+    "VaultNodeRef": "authcli",
+    "FileCli": "filecli",
+    "ManifestEntry": "filecli",
+    "ManifestTable": "filecli",
+    "GameCli": "gamecli",
+    "GateKeeperCli": "gatecli",
+    "address_cache": "gatecli",
+    "resolve_auth_server": "gatecli",
+    "resolve_file_server": "gatecli",
+    "ContentStore": "store",
+    "SyncAuthCli": "sync",
+    "SyncClient": "sync",
+    "SyncFileCli": "sync",
+    "SyncGameCli": "sync",
+    "SyncGateKeeperCli": "sync",
+    "NodeType": "vault.node",
+    "VaultNode": "vault.node",
+    "VaultGraph": "vault.graph",
+    "VaultIndex": "vault.index",
+    "VaultMirror": "vault.mirror",
+    "VaultWriteBuffer": "vault.writer",
+    "SharedNodeCache": "vault.shared",
+    "AimdLimiter": "_netio.limiter",
+    "ReconnectPolicy": "_netio.msg",
+    "configure_logging": "_netio.msg",
+}
+
+__all__ = [
+    "NetError", "error_lut",
+    *(i for i in tuple(globals()) if i.startswith("UruNet")),
+    *_lazy
+]
+
+def __getattr__(name: str):
+    if (module := _lazy.get(name)) is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
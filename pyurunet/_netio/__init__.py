@@ -14,9 +14,68 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from . import authstructs
-from .constants import *
-from .cryptio import RC4
+
+import importlib
+
 from .errors import *
-from . import fields
-from .msg import *
+
+# name -> submodule it lives in, or None for the submodules themselves. These are only imported
+# when first used, since most of them drag in asyncio and friends.
+_lazy = {
+    "authstructs": None,
+    "bufpool": None,
+    "cache": None,
+    "capture": None,
+    "constants": None,
+    "cryptio": None,
+    "events": None,
+    "fields": None,
+    "filestructs": None,
+    "gamestructs": None,
+    "gatestructs": None,
+    "keepalive": None,
+    "limiter": None,
+    "msg": None,
+    "propagate": None,
+    "sendqueue": None,
+    "server": None,
+    "BufferPool": "bufpool",
+    "DiffieHellmanG": "constants",
+    "NetProtocol": "constants",
+    "Product": "constants",
+    "TtlCache": "cache",
+    "RC4": "cryptio",
+    "Event": "events",
+    "EventStream": "events",
+    "PingScheduler": "keepalive",
+    "RttEstimator": "keepalive",
+    "AimdLimiter": "limiter",
+    "NetClient": "msg",
+    "NetMessage": "msg",
+    "NetStructDispatcher": "msg",
+    "ReconnectPolicy": "msg",
+    "connection_header": "msg",
+    "read_netstruct": "msg",
+    "write_netstruct": "msg",
+    "PropagateRouter": "propagate",
+    "Lane": "sendqueue",
+    "SendQueue": "sendqueue",
+    "NetServer": "server",
+    "NetServerConnection": "server",
+    "serve_workers": "server",
+}
+
+def __getattr__(name: str):
+    try:
+        module = _lazy[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    if module is None:
+        value = importlib.import_module(f".{name}", __name__)
+    else:
+        value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
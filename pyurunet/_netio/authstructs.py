@@ -197,10 +197,20 @@ server_addr = (
     (fields.integer, "addr", 4),
     (fields.uuid, "token", 1)
 )
+notify_new_build = (
+    # Plasma calls this "foo" and never looks at it.
+    (fields.integer, "unused", 4),
+)
+
 kicked_off = (
     (fields.integer, "reason", 4),
 )
 
+propagate_buffer = (
+    (fields.integer, "msg_type", 4),
+    (fields.medium_buffer, "buffer", 1),
+)
+
 client_register_req = (
     (fields.integer, "build_id", 4),
 )
@@ -252,6 +262,56 @@ vault_node_fetch_reply = (
     (fields.medium_buffer, "node_data", 1),
 )
 
+vault_node_create_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.medium_buffer, "node_data", 1),
+)
+vault_node_create_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+    (fields.integer, "node_id", 4),
+)
+
+vault_node_save_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "node_id", 4),
+    (fields.uuid, "revision_id", 1),
+    (fields.medium_buffer, "node_data", 1),
+)
+vault_node_save_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+)
+
+vault_node_add_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "parent_id", 4),
+    (fields.integer, "child_id", 4),
+    (fields.integer, "owner_id", 4),
+)
+vault_node_add_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+)
+
+# Vault notifications. These are pushed to us whenever a node we've fetched changes.
+vault_node_changed = (
+    (fields.integer, "node_id", 4),
+    (fields.uuid, "revision_id", 1),
+)
+vault_node_added = (
+    (fields.integer, "parent_id", 4),
+    (fields.integer, "child_id", 4),
+    (fields.integer, "owner_id", 4),
+)
+vault_node_removed = (
+    (fields.integer, "parent_id", 4),
+    (fields.integer, "child_id", 4),
+)
+vault_node_deleted = (
+    (fields.integer, "node_id", 4),
+)
+
 vault_node_remove_request = (
     (fields.integer, "trans_id", 4),
     (fields.integer, "parent_id", 4),
@@ -271,3 +331,46 @@ vault_node_find_reply = (
     (fields.integer, "result", 4),
     (fields.dword_array, "node_ids", None),
 )
+
+score_get_scores_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "owner_id", 4),
+    (fields.string, "game_name", 64),
+)
+score_get_scores_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+    (fields.integer, "score_count", 4),
+    (fields.medium_buffer, "buffer", 1),
+)
+
+score_get_ranks_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "owner_id", 4),
+    (fields.integer, "score_group", 4),
+    (fields.integer, "parent_folder_id", 4),
+    (fields.string, "game_name", 64),
+    (fields.integer, "time_period", 4),
+    (fields.integer, "num_results", 4),
+    (fields.integer, "page_number", 4),
+    (fields.integer, "sort_desc", 4),
+)
+score_get_ranks_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+    (fields.integer, "rank_count", 4),
+    (fields.medium_buffer, "buffer", 1),
+)
+
+score_get_high_scores_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "age_id", 4),
+    (fields.integer, "max_scores", 4),
+    (fields.string, "game_name", 64),
+)
+score_get_high_scores_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+    (fields.integer, "score_count", 4),
+    (fields.medium_buffer, "buffer", 1),
+)
@@ -0,0 +1,82 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+from typing import *
+import weakref
+
+
+class BufferPool:
+    """Hands out reusable receive buffers as memoryview slices. Buffers come in power of two size
+       classes from min_size to max_size; anything bigger than that is simply allocated. A view
+       must not be touched after it has been released back to the pool."""
+
+    def __init__(self, min_size: int = 4096, max_size: int = 16 * 1024 * 1024, max_free: int = 8):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free = max_free
+        self._free: Dict[int, List[bytearray]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _size_class(self, size: int) -> int:
+        return max(self.min_size, 1 << (size - 1).bit_length())
+
+    def acquire(self, size: int) -> memoryview:
+        if size > self.max_size:
+            self.misses += 1
+            return memoryview(bytearray(size))
+
+        size_class = self._size_class(size)
+        if free := self._free.get(size_class):
+            self.hits += 1
+            buf = free.pop()
+        else:
+            self.misses += 1
+            buf = bytearray(size_class)
+        return memoryview(buf)[:size]
+
+    def release(self, view: memoryview) -> None:
+        buf = view.obj
+        view.release()
+        if not isinstance(buf, bytearray) or len(buf) > self.max_size:
+            return
+        if len(buf) != self._size_class(len(buf)):
+            return
+        free = self._free.setdefault(len(buf), [])
+        if len(free) < self.max_free:
+            free.append(buf)
+
+    def clear(self) -> None:
+        self._free.clear()
+
+    @property
+    def pooled_bytes(self) -> int:
+        return sum(size * len(free) for size, free in self._free.items())
+
+
+_pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+def default_pool() -> BufferPool:
+    """Returns the shared buffer pool for the running event loop. Pools aren't thread safe, so
+       clients running on different loops mustn't share one."""
+    loop = asyncio.get_running_loop()
+    if (pool := _pools.get(loop)) is None:
+        pool = BufferPool()
+        _pools[loop] = pool
+    return pool
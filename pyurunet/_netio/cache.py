@@ -0,0 +1,86 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import time
+from typing import *
+
+_missing = object()
+
+
+class TtlCache:
+    """An asyncio-friendly cache whose entries expire after ttl seconds. Concurrent lookups of the
+       same missing key are coalesced so that only one of them actually does the work."""
+
+    def __init__(self, ttl: float, maxsize: Optional[int] = None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value for key without fetching it"""
+        if (entry := self._entries.get(key)) is None:
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return default
+        return value
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable = _missing) -> None:
+        """Drops one key from the cache, or everything if no key is given"""
+        if key is _missing:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    async def get(self, key: Hashable, factory: Callable[[], Awaitable[Any]],
+                  ttl: Optional[float] = None) -> Any:
+        """Returns the cached value for key, awaiting factory() to produce it if needed"""
+        if (value := self.peek(key, _missing)) is not _missing:
+            return value
+
+        if (task := self._inflight.get(key)) is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda x: self._fetch_done(key, x, ttl))
+
+        # Shielded so that one impatient caller being cancelled doesn't cancel the lookup
+        # for everyone else waiting on it.
+        return await asyncio.shield(task)
+
+    def _fetch_done(self, key: Hashable, task: asyncio.Future, ttl: Optional[float]) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result(), ttl)
@@ -0,0 +1,199 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+import enum
+import os
+import struct
+import time
+from typing import Iterator, NamedTuple, Optional
+
+from . import fields as _fields
+
+# Capture files are a small header followed by an append-only stream of records. Each record
+# is the decrypted frame exactly as it crossed the wire (message header included), so a replay
+# can feed the bytes straight back into the dispatcher without knowing the protocol.
+_file_magic = b"URUCAP"
+_file_version = 1
+_file_header = struct.Struct("<6sH")
+_record_header = struct.Struct("<BdII")
+
+
+class Direction(enum.IntEnum):
+    incoming = 0
+    outgoing = 1
+
+
+class CaptureFrame(NamedTuple):
+    direction: Direction
+    timestamp: float
+    msg_id: int
+    payload: bytes
+
+
+class ReplayStats(NamedTuple):
+    frames: int
+    size: int
+    elapsed: float
+
+
+class CaptureWriter:
+    """Appends decrypted frames to a capture file"""
+
+    def __init__(self, path: os.PathLike):
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_file_header.pack(_file_magic, _file_version))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def write(self, direction: Direction, msg_id: int, payload: bytes,
+              timestamp: Optional[float] = None) -> None:
+        if timestamp is None:
+            timestamp = time.time()
+        self._file.write(_record_header.pack(direction, timestamp, msg_id, len(payload)))
+        self._file.write(payload)
+
+
+class CaptureReader:
+    """Tees everything read from a stream so the completed frame can be recorded"""
+
+    def __init__(self, base, capture: CaptureWriter):
+        self._base = base
+        self._capture = capture
+        self._frame = bytearray()
+
+    def __getattr__(self, name):
+        return getattr(self._base, name)
+
+    async def read(self, size: int = -1) -> bytes:
+        data = await self._base.read(size)
+        self._frame += data
+        return data
+
+    async def readexactly(self, size: int) -> bytes:
+        data = await self._base.readexactly(size)
+        self._frame += data
+        return data
+
+    async def readinto_exactly(self, view: memoryview) -> None:
+        await _fields.readinto_exactly(self._base, view)
+        self._frame += view
+
+    def commit(self, msg_id: int) -> None:
+        if not self._capture.closed:
+            self._capture.write(Direction.incoming, msg_id, self._frame)
+        self._frame = bytearray()
+
+
+def read_capture(path: os.PathLike) -> Iterator[CaptureFrame]:
+    """Iterates over the frames stored in a capture file"""
+    with open(path, "rb") as fp:
+        header = fp.read(_file_header.size)
+        if len(header) < _file_header.size:
+            return
+        magic, version = _file_header.unpack(header)
+        if magic != _file_magic:
+            raise ValueError(f"'{path}' is not a PyUruNet capture file")
+        if version != _file_version:
+            raise ValueError(f"Unsupported capture file version {version}")
+
+        while True:
+            header = fp.read(_record_header.size)
+            if len(header) < _record_header.size:
+                # A truncated trailing record means the capture was cut off mid-write, which
+                # is normal for a process that got killed. Just stop here.
+                break
+            direction, timestamp, msg_id, size = _record_header.unpack(header)
+            payload = fp.read(size)
+            if len(payload) < size:
+                break
+            yield CaptureFrame(Direction(direction), timestamp, msg_id, payload)
+
+
+class _NullWriter:
+    """Stand-in StreamWriter that discards everything handlers try to send during a replay"""
+
+    def write(self, data: bytes) -> None:
+        pass
+
+    async def drain(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def is_closing(self) -> bool:
+        return False
+
+    def get_extra_info(self, name, default=None):
+        return ("replay", 0) if name == "peername" else default
+
+
+async def replay_capture(path: os.PathLike, dispatcher, *,
+                         direction: Direction = Direction.incoming,
+                         paced: bool = False, speed: float = 1.0) -> ReplayStats:
+    """Feeds the frames of a capture file through a dispatcher's dispatch_netstructs. By default,
+       the frames are fed as fast as the dispatcher can eat them. If paced is True, the recorded
+       inter-frame timing is reproduced, optionally scaled by speed."""
+    reader = asyncio.StreamReader()
+    dispatcher.reader = reader
+    dispatcher.writer = _NullWriter()
+    dispatch_task = asyncio.create_task(dispatcher.dispatch_netstructs())
+
+    frames, size = 0, 0
+    first_timestamp: Optional[float] = None
+    start = time.perf_counter()
+    for frame in read_capture(path):
+        if frame.direction != direction:
+            continue
+        if dispatch_task.done():
+            break
+
+        if paced:
+            if first_timestamp is None:
+                first_timestamp = frame.timestamp
+            delay = (frame.timestamp - first_timestamp) / speed - (time.perf_counter() - start)
+            if delay > 0.0:
+                await asyncio.sleep(delay)
+
+        reader.feed_data(frame.payload)
+        frames += 1
+        size += len(frame.payload)
+
+        # Let the dispatcher chew through what we've fed it so the whole capture doesn't
+        # end up buffered in memory.
+        await asyncio.sleep(0)
+
+    reader.feed_eof()
+    await dispatch_task
+    return ReplayStats(frames, size, time.perf_counter() - start)
@@ -24,6 +24,7 @@ class DiffieHellmanG:
 
 class NetProtocol:
     auth = 10
+    game = 11
     gatekeeper = 22
     file = 16
 
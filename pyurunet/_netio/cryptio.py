@@ -16,6 +16,8 @@
 
 import _urunet
 
+from . import fields
+
 class RC4(_urunet.rc4):
     def __init__(self, base, key, logger=None):
         super().__init__(key)
@@ -33,5 +35,8 @@ class RC4(_urunet.rc4):
     async def readexactly(self, size) -> bytes:
         return self.transform(await self._base.readexactly(size))
 
+    async def readinto_exactly(self, view: memoryview) -> None:
+        await fields.readinto_exactly(self._base, view, self.transform_into)
+
     def write(self, data: bytes):
         self._base.write(self.transform(data))
@@ -171,3 +171,7 @@ error_lut = {
     NetError.vault_node_access_violation: UruNetVaultNodeAccessViolationError,
     NetError.vault_node_not_found: UruNetVaultNodeNotFoundError,
 }
+
+# Not a NetError - raised when the other end sends us something that doesn't make any sense,
+# at which point the only sane thing to do is to drop the connection.
+class UruNetProtocolError(UruNetError): pass
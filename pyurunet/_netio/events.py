@@ -0,0 +1,129 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import itertools
+from typing import *
+
+# Gives each event that can't be coalesced a key of its own.
+_unique = itertools.count()
+
+KeyFunc = Callable[[int, Any], Optional[Hashable]]
+
+
+class Event(NamedTuple):
+    msg_id: int
+    message: Any
+
+
+class EventStream:
+    """Unsolicited messages from the server, for one subscriber. Use it as an async iterator,
+       ideally inside `async with` so the subscription goes away when you're done.
+
+       The queue never blocks the read loop. Events that make an earlier one still in the queue
+       redundant (eg a second change to the same vault node) replace it in place, so a slow
+       consumer sees the latest state rather than every step. If the queue is still full, the
+       oldest event is thrown away and counted in dropped."""
+
+    def __init__(self, client, types: Iterable[int], *, maxsize: int = 256,
+                 keys: Optional[Dict[int, KeyFunc]] = None):
+        self.client = client
+        self.maxsize = maxsize
+        self.keys = keys if keys is not None else client.event_keys
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self._queue: OrderedDict[Hashable, Event] = OrderedDict()
+        self._waiter: Optional[asyncio.Future] = None
+        self._closed = False
+        self._remove_listeners = [client.add_listener(i, self._on_message) for i in set(types)]
+        client._event_streams.add(self)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _on_message(self, msg_id: int, netmsg) -> None:
+        self.received += 1
+        # Pooled buffers would be recycled out from under us once the handler returns.
+        self.client.retain_netstruct(netmsg)
+
+        key_func = self.keys.get(msg_id)
+        key = key_func(msg_id, netmsg) if key_func is not None else None
+        if key is None:
+            key = (None, next(_unique))
+        elif key in self._queue:
+            # The newer event takes the older one's place in line at the back, not its position -
+            # otherwise eg an add coalesced past a later remove would be seen before the remove.
+            self._queue[key] = Event(msg_id, netmsg)
+            self._queue.move_to_end(key)
+            self.coalesced += 1
+            self._wake()
+            return
+
+        if len(self._queue) >= self.maxsize:
+            self._queue.popitem(last=False)
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                self.client.log.warning(f"Event subscriber is falling behind, {self.dropped} events dropped")
+        self._queue[key] = Event(msg_id, netmsg)
+        self._wake()
+
+    def _wake(self) -> None:
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def close(self) -> None:
+        """Unsubscribes. Events already queued can still be read."""
+        if self._closed:
+            return
+        self._closed = True
+        for i in self._remove_listeners:
+            i()
+        self._remove_listeners.clear()
+        self.client._event_streams.discard(self)
+        self._wake()
+
+    def get_nowait(self) -> Optional[Event]:
+        if self._queue:
+            return self._queue.popitem(last=False)[1]
+        return None
+
+    async def get(self) -> Event:
+        while not self._queue:
+            if self._closed:
+                raise EOFError("Event stream closed")
+            self._waiter = asyncio.get_running_loop().create_future()
+            await self._waiter
+        return self._queue.popitem(last=False)[1]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Event:
+        try:
+            return await self.get()
+        except EOFError:
+            raise StopAsyncIteration from None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
@@ -16,13 +16,40 @@
 
 from __future__ import annotations
 
+from array import array
+import asyncio
 from collections import namedtuple
+from contextvars import ContextVar
+import functools
 import struct
-from typing import Optional, Sequence
+import sys
+from typing import Callable, Optional, Sequence
 from uuid import UUID
 
+from .bufpool import BufferPool
+from .errors import UruNetProtocolError
+
 _net_field = namedtuple("_NetField", ["reader", "writer"])
 
+# Set by the dispatcher while it reads from a connection that pools its receive buffers.
+receive_pool: ContextVar[Optional[BufferPool]] = ContextVar("receive_pool", default=None)
+
+async def readinto_exactly(fd, view: memoryview, transform_into: Optional[Callable] = None) -> None:
+    """Fills view from fd without ever allocating a buffer for the whole thing"""
+    if transform_into is None and (readinto := getattr(fd, "readinto_exactly", None)) is not None:
+        return await readinto(view)
+
+    pos, size = 0, len(view)
+    while pos < size:
+        chunk = await fd.read(size - pos)
+        if not chunk:
+            raise asyncio.IncompleteReadError(bytes(view[:pos]), size)
+        if transform_into is None:
+            view[pos:pos + len(chunk)] = chunk
+        else:
+            transform_into(chunk, view[pos:pos + len(chunk)])
+        pos += len(chunk)
+
 async def _read_blob(fd, size: int) -> bytes:
     data = await fd.readexactly(size)
     return data
@@ -38,8 +65,17 @@ async def _read_buffer(fd, size, maxsize):
     bufsz = await _read_integer(fd, 4)
     bufsz *= size
     if bufsz > maxsize:
-        # somehow signal that the client needs to be booted
-        pass
+        raise UruNetProtocolError(f"Buffer of {bufsz} bytes is over the {maxsize} byte limit")
+
+    if (pool := receive_pool.get()) is not None and bufsz >= pool.min_size:
+        view = pool.acquire(bufsz)
+        try:
+            await readinto_exactly(fd, view)
+        except BaseException:
+            pool.release(view)
+            raise
+        return view
+
     data = await fd.readexactly(bufsz)
     return data
 
@@ -48,7 +84,7 @@ def _write_buffer(fd, size, value: Optional[bytes]):
         _write_integer(fd, 4, len(value) // size)
         fd.write(value)
     else:
-        _write_integer(fd, size, 0)
+        _write_integer(fd, 4, 0)
 
 # buffer size hints to prevent clients from sending us a load of crap
 # tiny = 1KB; medium = 1MB; big = 10MB
@@ -98,21 +134,44 @@ def _write_integer(fd, size: int, value: int) -> None:
 
 integer = _net_field(_read_integer, _write_integer)
 
-async def _read_dword_array(fd, size: Optional[int]) -> Sequence[int]:
+# Arrays of dwords are decoded straight into a compact array('I') rather than a tuple of ints.
+# The typecode is checked because the C compiler decides how big an unsigned int is, not us.
+_dword_typecode = "I" if array("I").itemsize == 4 else "L"
+_dword_swap = sys.byteorder != "little"
+
+# Counted arrays (vault find results, mostly) top out at 4MB.
+_max_dword_array = 1024 * 1024
+
+@functools.lru_cache(maxsize=64)
+def _dword_struct(count: int) -> struct.Struct:
+    return struct.Struct(f"<{count}I")
+
+async def _read_dword_array(fd, size: Optional[int]) -> array:
     if size is None:
         size = await _read_integer(fd, 4)
-    data = await fd.readexactly(size * 4)
-    if data is not None:
-        return struct.unpack(f"<{'I' * size}", data)
-    return [0] * size
-
-def _write_dword_array(fd, size: int, value: Sequence[int]) -> None:
+        if size > _max_dword_array:
+            raise UruNetProtocolError(f"Array of {size} dwords is over the {_max_dword_array} limit")
+    value = array(_dword_typecode)
+    value.frombytes(await fd.readexactly(size * 4))
+    if _dword_swap:
+        value.byteswap()
+    return value
+
+def _write_dword_array(fd, size: Optional[int], value: Optional[Sequence[int]]) -> None:
     if size is None:
         size = 0 if value is None else len(value)
         _write_integer(fd, 4, size)
     if value is None:
-        value = [0] * size
-    fd.write(struct.pack(f"<{'I' * size}", *value))
+        fd.write(bytes(size * 4))
+        return
+
+    if len(value) != size:
+        raise ValueError(f"Expected {size} dwords, got {len(value)}")
+    if isinstance(value, array) and value.typecode == _dword_typecode and not _dword_swap:
+        # Arrays are buffers, so this is written without any intermediate copies.
+        fd.write(value)
+    else:
+        fd.write(_dword_struct(size).pack(*value))
 
 dword_array = _net_field(_read_dword_array, _write_dword_array)
 
@@ -56,6 +56,9 @@ build_id_reply = (
     (fields.integer, "result", 4),
     (fields.integer, "build_id", 4),
 )
+build_id_update = (
+    (fields.integer, "build_id", 4),
+)
 
 manifest_request = (
     (fields.integer, "trans_id", 4),
@@ -73,3 +76,20 @@ manifest_ack = (
     (fields.integer, "trans_id", 4),
     (fields.integer, "reader_id", 4),
 )
+
+file_download_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.char16_blob, "file_name", 260),
+    (fields.integer, "build_id", 4),
+)
+file_download_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+    (fields.integer, "reader_id", 4),
+    (fields.integer, "total_size", 4),
+    (fields.medium_buffer, "buffer", 1),
+)
+file_download_chunk_ack = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "reader_id", 4),
+)
@@ -0,0 +1,68 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+import enum
+
+from . import fields
+
+class C2G(enum.IntEnum):
+    # Global
+    PingRequest = 0
+
+    # Age
+    JoinAgeRequest = 1
+
+    # Game
+    PropagateBuffer = 2
+    GameMgrMsg = 3
+
+
+class G2C(enum.IntEnum):
+    # Global
+    PingReply = 0
+
+    # Age
+    JoinAgeReply = 1
+
+    # Game
+    PropagateBuffer = 2
+    GameMgrMsg = 3
+
+
+# Unlike everyone else's, game server pings aren't transactions.
+ping_pong = (
+    (fields.integer, "ping_time", 4),
+)
+
+join_age_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "age_mcp_id", 4),
+    (fields.uuid, "account_uuid", 1),
+    (fields.integer, "player_id", 4),
+)
+join_age_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "result", 4),
+)
+
+propagate_buffer = (
+    (fields.integer, "msg_type", 4),
+    (fields.medium_buffer, "buffer", 1),
+)
+
+game_mgr_msg = (
+    (fields.medium_buffer, "buffer", 1),
+)
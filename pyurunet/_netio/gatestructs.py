@@ -0,0 +1,55 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+import enum
+
+from . import fields
+
+class C2G(enum.IntEnum):
+    # Global
+    PingRequest = 0
+
+    # Server addresses
+    FileSrvIpAddressRequest = 1
+    AuthSrvIpAddressRequest = 2
+
+
+class G2C(enum.IntEnum):
+    # Global
+    PingReply = 0
+
+    # Server addresses
+    FileSrvIpAddressReply = 1
+    AuthSrvIpAddressReply = 2
+
+
+ping_pong = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "ping_time", 4),
+    (fields.tiny_buffer, "payload", 1),
+)
+
+file_srv_address_request = (
+    (fields.integer, "trans_id", 4),
+    (fields.integer, "is_patcher", 1),
+)
+auth_srv_address_request = (
+    (fields.integer, "trans_id", 4),
+)
+srv_address_reply = (
+    (fields.integer, "trans_id", 4),
+    (fields.string, "address", 24),
+)
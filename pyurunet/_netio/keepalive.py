@@ -0,0 +1,182 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import *
+import weakref
+
+
+class RttEstimator:
+    """Smoothed round trip time and jitter (mean deviation) estimates, per RFC 6298"""
+
+    alpha = 1.0 / 8.0
+    beta = 1.0 / 4.0
+    initial_rto = 3.0
+    min_rto = 0.2
+
+    def __init__(self):
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.last: Optional[float] = None
+        self.samples = 0
+
+    def __repr__(self) -> str:
+        if self.srtt is None:
+            return "<RttEstimator (no samples)>"
+        return f"<RttEstimator srtt={self.srtt * 1000.0:.1f}ms jitter={self.rttvar * 1000.0:.1f}ms>"
+
+    def update(self, sample: float) -> None:
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2.0
+        else:
+            self.rttvar = (1.0 - self.beta) * self.rttvar + self.beta * abs(self.srtt - sample)
+            self.srtt = (1.0 - self.alpha) * self.srtt + self.alpha * sample
+        self.last = sample
+        self.samples += 1
+
+    @property
+    def jitter(self) -> Optional[float]:
+        return self.rttvar
+
+    @property
+    def rto(self) -> float:
+        """How long to wait for a reply before giving up on it"""
+        if self.srtt is None:
+            return self.initial_rto
+        return max(self.min_rto, self.srtt + 4.0 * self.rttvar)
+
+
+class PingScheduler:
+    """Keeps any number of connections alive from a single task. Pings are spread out over the
+       interval rather than firing in bursts, and connections that have recently carried traffic
+       in both directions are skipped entirely."""
+
+    def __init__(self, interval: float = 20.0, jitter: float = 0.25, min_timeout: float = 10.0):
+        self.interval = interval
+        self.jitter = jitter
+        self.min_timeout = min_timeout
+        # client -> seq of its one live heap entry. Anything else in the heap for it is stale.
+        self._clients: Dict[Any, int] = {}
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pings: Set[asyncio.Task] = set()
+        self._closing = False
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def _next_interval(self) -> float:
+        # Always come in under the interval so the server never sees us go quiet for too long.
+        return self.interval * random.uniform(1.0 - self.jitter, 1.0)
+
+    def _schedule(self, client, due: float) -> None:
+        wake = not self._heap or due < self._heap[0][0]
+        seq = self._clients[client] = next(self._seq)
+        heapq.heappush(self._heap, (due, seq, client))
+        if wake and self._wakeup is not None:
+            self._wakeup.set()
+
+    def register(self, client) -> None:
+        if self._closing:
+            raise RuntimeError("PingScheduler is closed")
+        if client in self._clients:
+            return
+        self._schedule(client, time.monotonic() + random.uniform(0.0, self.interval))
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def unregister(self, client) -> None:
+        # The heap entry is lazily discarded when it comes due.
+        self._clients.pop(client, None)
+
+    def close(self) -> None:
+        """Stops pinging everyone. The scheduler can't be used again afterwards."""
+        self._closing = True
+        self._clients.clear()
+        self._heap.clear()
+        if self._task is not None:
+            self._task.cancel()
+        for task in tuple(self._pings):
+            task.cancel()
+
+    async def _run(self) -> None:
+        while self._clients:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                _, seq, client = heapq.heappop(self._heap)
+                if self._clients.get(client) == seq:
+                    self._service(client, now)
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _service(self, client, now: float) -> None:
+        writer = client.writer
+        if writer is None or writer.is_closing():
+            # Probably in the middle of reconnecting, try again later.
+            self._schedule(client, now + self._next_interval())
+            return
+
+        last_traffic = min(client.last_send, client.last_recv)
+        if now - last_traffic < self.interval:
+            self._schedule(client, last_traffic + self._next_interval())
+            return
+
+        task = asyncio.create_task(self._ping(client))
+        self._pings.add(task)
+        task.add_done_callback(self._pings.discard)
+
+    async def _ping(self, client) -> None:
+        timeout = max(self.min_timeout, client.rtt.rto * 4.0)
+        try:
+            await asyncio.wait_for(client.measure_ping(), timeout)
+        except asyncio.TimeoutError:
+            client.log.warning(f"No ping reply in {timeout:.1f}s, dropping the connection")
+            client.connection_reset("Ping timeout")
+        except asyncio.CancelledError:
+            # The connection dropped out from under the ping. That's fine, unless it's us
+            # being shut down.
+            if self._closing:
+                raise
+        except Exception as e:
+            client.log.warning(f"Ping failed: {e!r}")
+        if client in self._clients:
+            self._schedule(client, time.monotonic() + self._next_interval())
+
+
+_schedulers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+def default_scheduler() -> PingScheduler:
+    """Returns the process-wide ping scheduler for the running event loop"""
+    loop = asyncio.get_running_loop()
+    if (scheduler := _schedulers.get(loop)) is None or scheduler._closing:
+        scheduler = PingScheduler()
+        _schedulers[loop] = scheduler
+    return scheduler
@@ -0,0 +1,134 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+import random
+import time
+from typing import *
+
+from .keepalive import RttEstimator
+
+
+class AimdLimiter:
+    """Limits how many transactions are in flight, TCP style. The limit creeps up by about one
+       for every round trip's worth of replies while the window is actually in use, and is cut
+       in half when the server says it's busy, a reply times out, or replies suddenly take far
+       longer than usual. Give several connections' limiters the same parent to cap them as a
+       pool as well."""
+
+    def __init__(self, initial: int = 8, *, min_limit: int = 1, max_limit: int = 512,
+                 backoff: float = 0.5, latency_factor: float = 3.0,
+                 timeout_factor: float = 4.0, min_timeout: float = 30.0,
+                 retry_delay: float = 0.25, max_retry_delay: float = 10.0, max_retries: int = 6,
+                 parent: Optional[AimdLimiter] = None):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.base_retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries = max_retries
+        self.parent = parent
+
+        self.inflight = 0
+        self.latency = RttEstimator()
+        self.congestion_events = 0
+        self._last_cut = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def __repr__(self) -> str:
+        return f"<AimdLimiter limit={self.limit:.1f} inflight={self.inflight} waiting={len(self._waiters)}>"
+
+    def child(self, initial: Optional[int] = None, **kwargs) -> AimdLimiter:
+        """Makes a limiter for one connection that also counts against this one"""
+        return AimdLimiter(initial if initial is not None else max(1, int(self.limit)), parent=self, **kwargs)
+
+    @property
+    def timeout(self) -> float:
+        """How long to wait for a reply before calling it lost"""
+        return max(self.min_timeout, self.latency.rto * self.timeout_factor)
+
+    def retry_delay(self, attempt: int) -> float:
+        return min(self.max_retry_delay, self.base_retry_delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+    async def acquire(self) -> None:
+        if self.inflight < max(self.min_limit, int(self.limit)) and not self._waiters:
+            self.inflight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # We were handed a slot just as we were cancelled.
+                    self._release_slot()
+                else:
+                    self._waiters.remove(waiter)
+                raise
+
+        if self.parent is not None:
+            try:
+                await self.parent.acquire()
+            except BaseException:
+                self._release_slot()
+                raise
+
+    def release(self, latency: Optional[float] = None, congested: bool = False) -> None:
+        """Gives back a slot. Pass the reply's latency if there was one, or congested if the
+           server pushed back."""
+        window_full = self.inflight >= int(self.limit)
+        self._release_slot()
+        if congested:
+            self._decrease()
+        elif latency is not None:
+            srtt = self.latency.srtt
+            self.latency.update(latency)
+            if self.latency.samples > 8 and latency > srtt * self.latency_factor:
+                self._decrease()
+            elif window_full:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+                self._wake()
+        if self.parent is not None:
+            self.parent.release(latency, congested)
+
+    def _release_slot(self) -> None:
+        self.inflight -= 1
+        self._wake()
+
+    def _decrease(self) -> None:
+        # Everything in flight during a congestion event tends to fail together. Only cut once
+        # per round trip, or one bad moment would take us straight down to the floor.
+        now = time.monotonic()
+        if now - self._last_cut < (self.latency.srtt or 0.0):
+            return
+        self._last_cut = now
+        self.congestion_events += 1
+        self.limit = max(float(self.min_limit), self.limit * self.backoff)
+
+    def _wake(self) -> None:
+        while self._waiters and self.inflight < max(self.min_limit, int(self.limit)):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
@@ -24,22 +24,35 @@ from dataclasses import dataclass
 import io
 import inspect
 import logging
+import random
 import secrets
 import sys
+import time
 from typing import *
 import uuid
 
+from . import capture as _capture
+from . import events as _events
 from . import cryptio, errors, fields
+from . import keepalive as _keepalive
+from .bufpool import BufferPool
 from .constants import Product
+from .sendqueue import Lane, SendQueue
 
-# FIXME: don't hardwire this?
 _logger = logging.getLogger("PyUruNet")
-_logger.setLevel(logging.DEBUG)
-_handler = logging.StreamHandler()
-_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(peer)s %(message)s"))
-_logger.addHandler(_handler)
+_logger.addHandler(logging.NullHandler())
 
-_kablooey = (asyncio.CancelledError, ConnectionError, EOFError)
+def configure_logging(level: int = logging.DEBUG, handler: Optional[logging.Handler] = None) -> None:
+    """Sends PyUruNet's log output somewhere. By default, that's everything to stderr."""
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(peer)s %(message)s"))
+    _logger.setLevel(level)
+    _logger.addHandler(handler)
+
+_kablooey = (asyncio.CancelledError, ConnectionError, EOFError, errors.UruNetProtocolError)
+
+Listener = Callable[[int, "NetMessage"], None]
 
 connection_header = (
     (fields.integer, "conn_type", 1),
@@ -84,6 +97,9 @@ async def read_netstruct(fd: asyncio.StreamReader, struct: Sequence) -> NetMessa
     for rw, name, size in struct:
         data = await rw.reader(fd, size)
         setattr(msg, name, data)
+        if isinstance(data, memoryview):
+            # Borrowed from the receive pool, see NetStructDispatcher.release_netstruct()
+            msg.__dict__.setdefault("_pooled", []).append(data)
     return msg
 
 def write_netstruct(fd: Optional[asyncio.StreamWriter], msg: NetMessage) -> Union[bytes, int]:
@@ -116,10 +132,43 @@ class NetStructDispatcher(abc.ABC):
         (fields.integer, "msg_id", 2),
     )
 
+    # If set, coroutine handlers run as tasks instead of being awaited by the read loop. Handlers
+    # for the same transaction (or the same message type, if there is no transaction) still run
+    # in the order their messages arrived. Once max_backlog handlers are outstanding, we stop
+    # reading from the socket until one of them finishes.
+    concurrent_dispatch: bool = False
+    max_backlog: int = 64
+
+    # If set, large buffer fields are read into memoryviews borrowed from this pool rather than
+    # freshly allocated bytes. They are handed back once the message's handler is done with them.
+    buffer_pool: Optional[BufferPool] = None
+
+    # Unsolicited messages that events() subscribes to by default, and msg_id -> function that
+    # returns a key for events that supersede earlier ones with the same key (or None if they
+    # don't). Only the latest of those is kept when a subscriber falls behind.
+    event_types: Collection[int] = ()
+    event_keys: Dict[int, _events.KeyFunc] = {}
+
     def __init__(self, reader=None, writer=None):
         self._msg_header_size = sum(list(zip(*self._msg_header))[2])
         self.reader = reader
         self.writer = writer
+        self.capture: Optional[_capture.CaptureWriter] = None
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.last_recv = time.monotonic()
+        self.last_send = self.last_recv
+        self._handler_tasks: Set[asyncio.Task] = set()
+        self._handler_chains: Dict[Hashable, asyncio.Task] = {}
+        self._backlog: Optional[asyncio.Semaphore] = None
+        self.send_queue = SendQueue(self)
+
+        # msg_id -> coroutine function that reads the message body from the stream by itself
+        self.raw_readers: Dict[int, Callable[[Any], Awaitable[None]]] = {}
+
+        # msg_id -> callables that get a look at every message of that type before its handler does
+        self.listeners: Dict[int, List[Listener]] = {}
+        self._event_streams: Set[_events.EventStream] = set()
 
         # TODO: use multiple loggers?
         self.log = logging.LoggerAdapter(_logger, extra=dict(peer=""))
@@ -197,14 +246,42 @@ class NetStructDispatcher(abc.ABC):
             fields.integer.writer(self.writer, 1, 2)
             await self.writer.drain()
 
+    def start_capture(self, path) -> None:
+        """Records all decrypted frames crossing this connection to a capture file"""
+        self.stop_capture()
+        self.capture = _capture.CaptureWriter(path)
+
+    def stop_capture(self) -> None:
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
     async def dispatch_netstructs(self):
+        if self.buffer_pool is not None:
+            fields.receive_pool.set(self.buffer_pool)
+
         while True:
+            fd = self.reader if self.capture is None else _capture.CaptureReader(self.reader, self.capture)
             try:
-                header = await read_netstruct(self.reader, self._msg_header)
+                header = await read_netstruct(fd, self._msg_header)
             except _kablooey as e:
                 self.connection_reset(str(e))
                 break
 
+            if (raw_reader := self.raw_readers.get(header.msg_id)) is not None:
+                # Fast path for high volume messages. The raw reader consumes the body itself and
+                # never builds a NetMessage.
+                try:
+                    await raw_reader(fd)
+                except _kablooey as e:
+                    self.connection_reset(str(e))
+                    break
+                if fd is not self.reader:
+                    fd.commit(header.msg_id)
+                self.messages_received += 1
+                self.last_recv = time.monotonic()
+                continue
+
             try:
                 msg_struct = self.incoming_lookup[header.msg_id]
             except LookupError:
@@ -214,24 +291,117 @@ class NetStructDispatcher(abc.ABC):
                 return
 
             try:
-                actual_netmsg = await read_netstruct(self.reader, msg_struct)
+                actual_netmsg = await read_netstruct(fd, msg_struct)
             except _kablooey as e:
                 self.connection_reset(str(e))
                 break
+            if fd is not self.reader:
+                fd.commit(header.msg_id)
+            self.messages_received += 1
+            self.last_recv = time.monotonic()
+
+            if listeners := self.listeners.get(header.msg_id):
+                self._notify_listeners(listeners, header.msg_id, actual_netmsg)
 
             handler = self.incoming_handlers.get(header.msg_id, self.handle_incoming)
             try:
                 self.log.debug(f"Dispatching {header.msg_id:02X} to {handler}")
                 dispatch_result = handler(header.msg_id, actual_netmsg)
                 if asyncio.iscoroutine(dispatch_result):
+                    if self.concurrent_dispatch:
+                        await self._dispatch_task(header.msg_id, actual_netmsg, dispatch_result)
+                        continue
                     # Be very careful about doing this, or you may deadlock the loop.
                     await dispatch_result
             except CancelledError:
                 raise
             except Exception as e:
                 self.log.exception(e)
+            self.release_netstruct(actual_netmsg)
+
+    def add_listener(self, msg_id: int, callback: Listener) -> Callable[[], None]:
+        """Calls callback(msg_id, netmsg) for every incoming message of msg_id, on top of whatever
+           the handler does with it. Listeners are called synchronously from the read loop and
+           must copy anything they want to keep from pooled buffers. Returns a function that
+           removes the listener again."""
+        listeners = self.listeners.setdefault(msg_id, [])
+        listeners.append(callback)
+
+        def remove():
+            if callback in listeners:
+                listeners.remove(callback)
+        return remove
+
+    def events(self, types: Optional[Iterable[int]] = None, *, maxsize: int = 256) -> _events.EventStream:
+        """Subscribes to unsolicited messages of the given types (or all of event_types). Use as
+           `async with client.events() as events: async for event in events: ...`"""
+        return _events.EventStream(self, self.event_types if types is None else types, maxsize=maxsize)
+
+    def _notify_listeners(self, listeners: List[Listener], msg_id: int, netmsg: NetMessage) -> None:
+        for callback in tuple(listeners):
+            try:
+                callback(msg_id, netmsg)
+            except Exception as e:
+                self.log.exception(e)
+
+    def release_netstruct(self, netmsg: NetMessage) -> None:
+        """Returns any pooled buffers in netmsg to the pool. This happens automatically after the
+           message is handled, unless the message was handed off elsewhere (eg as the result of a
+           transaction), in which case the buffers simply become the recipient's."""
+        if pooled := netmsg.__dict__.pop("_pooled", None):
+            for i in pooled:
+                self.buffer_pool.release(i)
+
+    @staticmethod
+    def retain_netstruct(netmsg: NetMessage) -> None:
+        """Stops pooled buffers in netmsg from being recycled once its handler returns"""
+        netmsg.__dict__.pop("_pooled", None)
+
+    async def _dispatch_task(self, msg_id: int, netmsg: NetMessage, coro: Coroutine) -> None:
+        if self._backlog is None:
+            self._backlog = asyncio.Semaphore(self.max_backlog)
+        try:
+            await self._backlog.acquire()
+        except BaseException:
+            coro.close()
+            raise
 
-    def connection_reset(self):
+        if trans_id := getattr(netmsg, "trans_id", None):
+            key = (True, trans_id)
+        else:
+            key = (False, msg_id)
+        task = asyncio.create_task(self._run_handler(self._handler_chains.get(key), coro, netmsg))
+        self._handler_chains[key] = task
+        self._handler_tasks.add(task)
+        task.add_done_callback(lambda x: self._handler_done(key, x))
+
+    async def _run_handler(self, previous: Optional[asyncio.Task], coro: Coroutine, netmsg: NetMessage) -> None:
+        try:
+            if previous is not None:
+                try:
+                    await asyncio.wait((previous,))
+                except BaseException:
+                    coro.close()
+                    raise
+            await coro
+        finally:
+            self.release_netstruct(netmsg)
+
+    def _handler_done(self, key: Hashable, task: asyncio.Task) -> None:
+        self._handler_tasks.discard(task)
+        if self._handler_chains.get(key) is task:
+            del self._handler_chains[key]
+        self._backlog.release()
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            self.log.exception(exc)
+
+    def connection_reset(self, msg: str = "Connection reset"):
+        if self._handler_tasks:
+            current = asyncio.current_task()
+            for i in self._handler_tasks:
+                if i is not current:
+                    i.cancel(msg)
+        self.send_queue.clear(msg)
         if self.writer is not None:
             self.writer.close()
 
@@ -243,30 +413,48 @@ class NetStructDispatcher(abc.ABC):
     def peername(self) -> str:
         return "/".join((str(i) for i in self.writer.get_extra_info("peername")))
 
-    async def send_netstruct(self, msg_id: Optional[int], netmsg: NetMessage) -> None:
+    def _frame_netstruct(self, msg_id: Optional[int], netmsg: NetMessage) -> bytes:
         msgBuf = write_netstruct(None, netmsg)
-
         if msg_id is None:
-            sendBuf = msgBuf
-        else:
-            header = NetMessage(self._msg_header,
-                                msg_id=msg_id,
-                                msg_size=self._msg_header_size+len(msgBuf))
-            headerBuf = write_netstruct(None, header)
-            sendBuf = headerBuf + msgBuf
+            return msgBuf
 
-        self.writer.write(sendBuf)
-        try:
-            await self.writer.drain()
-        except _kablooey as e:
-            self.log.exception(e)
-            self.connection_reset(str(e))
+        header = NetMessage(self._msg_header,
+                            msg_id=msg_id,
+                            msg_size=self._msg_header_size+len(msgBuf))
+        headerBuf = write_netstruct(None, header)
+        return headerBuf + msgBuf
+
+    async def send_netstruct(self, msg_id: Optional[int], netmsg: NetMessage, lane: Lane = Lane.normal) -> None:
+        """Sends a message, waiting until it has been handed off to the transport"""
+        await self.send_queue.send(self._frame_netstruct(msg_id, netmsg), msg_id, lane)
+
+    def queue_netstruct(self, msg_id: Optional[int], netmsg: NetMessage, lane: Lane = Lane.normal) -> None:
+        """Queues a message to be sent without waiting on it (or on backpressure)"""
+        self.send_queue.push(self._frame_netstruct(msg_id, netmsg), msg_id, lane)
 
 
 @dataclass
 class _Transaction:
     future: asyncio.Future
     data: Any
+    msg_id: int = 0
+    netmsg: Optional[NetMessage] = None
+    idempotent: bool = False
+
+
+@dataclass
+class ReconnectPolicy:
+    """Opts a NetClient into transparently reconnecting after the connection drops"""
+
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    max_attempts: Optional[int] = None
+    connect_timeout: float = 30.0
+
+    def delay(self, attempt: int) -> float:
+        # "Full jitter" exponential backoff, so a shard full of clients doesn't come
+        # crashing back in lockstep.
+        return random.uniform(0.0, min(self.max_delay, self.base_delay * (2 ** attempt)))
 
 
 class NetClient(NetStructDispatcher):
@@ -275,6 +463,21 @@ class NetClient(NetStructDispatcher):
         self._next_trans_id = 1
         self._transactions: Dict[int, _Transaction] = {}
         self._read_task: Optional[asyncio.Task] = None
+        self._connect_args: Dict[str, Any] = {}
+        self._reconnect_policy: Optional[ReconnectPolicy] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._online: Optional[asyncio.Event] = None
+        self._closed = False
+        self.rtt = _keepalive.RttEstimator()
+
+        # An AimdLimiter, if in-flight transactions should be throttled by how the server copes.
+        self.limiter = None
+        # Seconds to wait for any reply. Clients with a limiter default to the limiter's timeout.
+        self.transaction_timeout: Optional[float] = None
+
+        # Called with no arguments once a dropped connection has been reestablished. Anything
+        # that could have missed server notifications while we were gone should catch up here.
+        self.reconnect_listeners: List[Callable[[], Any]] = []
 
     @abc.abstractmethod
     async def _perform_handshake(self, build: int, uuid: uuid.UUID) -> None:
@@ -287,7 +490,7 @@ class NetClient(NetStructDispatcher):
                 try:
                     result = errors.NetError(result)
                 except ValueError:
-                    self.warning(f"Transaction {trans_id} returned an invalid error code: {result}")
+                    self.log.warning(f"Transaction {trans_id} returned an invalid error code: {result}")
                     exc = ValueError
                 else:
                     exc = errors.error_lut.get(result)
@@ -296,6 +499,8 @@ class NetClient(NetStructDispatcher):
                     self.log.error(f"Transaction {trans_id} failed: {exc.__name__}")
                     transaction.future.set_exception(exc)
                 else:
+                    # The reply belongs to whoever is waiting on it now.
+                    self.retain_netstruct(netmsg)
                     transaction.future.set_result(netmsg)
             else:
                 self.log.warning(f"Unexpected transaction reply from server: {trans_id}")
@@ -304,34 +509,215 @@ class NetClient(NetStructDispatcher):
 
     async def start(self, *, host: str = Product.host, port: int = Product.port,
                     build: int = Product.build_id, product: uuid.UUID = Product.uuid,
-                    nkey: int = 0, xkey: int = 0):
-        self.log.info(f"Connecting to {host}/{port}...")
-        self.reader, self.writer = await asyncio.open_connection(host, port)
-        self.log.extra["peer"] = self.peername
-        self.log.debug("Connection established, performing handshake...")
+                    nkey: int = 0, xkey: int = 0, reconnect: Optional[ReconnectPolicy] = None):
+        self._connect_args = dict(host=host, port=port, build=build, product=product, nkey=nkey, xkey=xkey)
+        self._reconnect_policy = reconnect
+        self._closed = False
+        if reconnect is not None and self._online is None:
+            self._online = asyncio.Event()
         try:
-            await self._perform_handshake(build=build, product=product, nkey=nkey, xkey=xkey)
-            #await self.dispatch_netstructs()
+            await self._connect(**self._connect_args)
         except _kablooey:
             self.connection_reset()
         else:
             self._read_task = asyncio.create_task(self.dispatch_netstructs())
+            if self._online is not None:
+                self._online.set()
+
+    async def _connect(self, *, host: str, port: int, build: int, product: uuid.UUID,
+                       nkey: int, xkey: int) -> None:
+        self.log.info(f"Connecting to {host}/{port}...")
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.log.extra["peer"] = self.peername
+        self.log.debug("Connection established, performing handshake...")
+        await self._perform_handshake(build=build, product=product, nkey=nkey, xkey=xkey)
+
+    async def _restore_session(self) -> None:
+        """Called after a reconnect to bring the new connection back to the state of the old one
+           before any in-flight transactions are replayed"""
+        pass
+
+    async def _reconnect(self) -> None:
+        policy = self._reconnect_policy
+        attempt = 0
+        while not self._closed:
+            if policy.max_attempts is not None and attempt >= policy.max_attempts:
+                break
+            delay = policy.delay(attempt)
+            attempt += 1
+            self.log.info(f"Reconnecting in {delay:.2f}s (attempt {attempt})...")
+            await asyncio.sleep(delay)
 
-    async def send_transaction(self, msg_id: int, netmsg: NetMessage, data=None):
+            try:
+                await asyncio.wait_for(self._connect(**self._connect_args), policy.connect_timeout)
+                self._read_task = asyncio.create_task(self.dispatch_netstructs())
+                await self._restore_session()
+
+                replay = [i for i in self._transactions.values() if i.netmsg is not None]
+                self.log.info(f"Reconnected, replaying {len(replay)} transaction(s)")
+                for transaction in replay:
+                    # Whatever the first attempt collected is going to arrive all over again.
+                    if (clear := getattr(transaction.data, "clear", None)) is not None:
+                        clear()
+                    await self.send_netstruct(transaction.msg_id, transaction.netmsg)
+            except asyncio.CancelledError:
+                raise
+            except (*_kablooey, OSError, asyncio.TimeoutError, AssertionError, errors.UruNetError) as e:
+                self.log.warning(f"Reconnect attempt {attempt} failed: {e!r}")
+                if self._read_task is not None:
+                    self._read_task.cancel()
+                if self.writer is not None:
+                    self.writer.close()
+            else:
+                if self.writer is not None and not self.writer.is_closing():
+                    self._online.set()
+                    self._notify_reconnected()
+                    return
+
+        self.log.error("Giving up on reconnecting")
+        self.close("Reconnect failed")
+
+    def add_reconnect_listener(self, callback: Callable[[], Any]) -> Callable[[], None]:
+        """Calls callback() after every successful reconnect. Coroutine functions are run as tasks.
+           Returns a function that removes the listener again."""
+        self.reconnect_listeners.append(callback)
+
+        def remove():
+            if callback in self.reconnect_listeners:
+                self.reconnect_listeners.remove(callback)
+        return remove
+
+    def _notify_reconnected(self) -> None:
+        for callback in tuple(self.reconnect_listeners):
+            try:
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    task = asyncio.create_task(result)
+                    self._handler_tasks.add(task)
+                    task.add_done_callback(self._reconnect_listener_done)
+            except Exception as e:
+                self.log.exception(e)
+
+    def _reconnect_listener_done(self, task: asyncio.Task) -> None:
+        self._handler_tasks.discard(task)
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            self.log.exception(exc)
+
+    async def _wait_online(self) -> None:
+        # The session restore happens on the reconnect task and obviously can't wait for itself.
+        if self._online is not None and not self._online.is_set() and asyncio.current_task() is not self._reconnect_task:
+            await self._online.wait()
+        if self._closed and self._reconnect_policy is not None:
+            raise errors.UruNetDisconnectedError("Connection closed")
+
+    async def send_transaction(self, msg_id: int, netmsg: NetMessage, data=None, *,
+                               idempotent: bool = False, lane: Lane = Lane.normal):
+        """Sends a request and waits for the matching reply. Idempotent transactions are replayed
+           if the connection is reestablished while they are in flight. If the client has a
+           limiter, this also waits for a free slot first, and idempotent transactions the server
+           was too busy for (or never answered) are retried after a delay."""
+        # Pings and such must never queue up behind the traffic they're measuring.
+        if (limiter := self.limiter) is None or lane == Lane.control:
+            return await self._transact(msg_id, netmsg, data, idempotent, lane, self.transaction_timeout)
+
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            start, latency, congested = time.monotonic(), None, False
+            try:
+                result = await self._transact(msg_id, netmsg, data, idempotent, lane,
+                                              self.transaction_timeout or limiter.timeout)
+            except (errors.UruNetServerBusyError, errors.UruNetTimeoutError) as e:
+                congested = True
+                if not idempotent or attempt >= limiter.max_retries:
+                    raise
+                exc = e
+            except errors.UruNetDisconnectedError:
+                congested = True
+                raise
+            except errors.UruNetError:
+                # The server answered, it just didn't like the question.
+                latency = time.monotonic() - start
+                raise
+            else:
+                latency = time.monotonic() - start
+                return result
+            finally:
+                limiter.release(latency, congested)
+
+            delay = limiter.retry_delay(attempt)
+            attempt += 1
+            self.log.debug(f"Retrying {msg_id:04X} in {delay:.2f}s after {type(exc).__name__} (attempt {attempt})")
+            await asyncio.sleep(delay)
+            if (clear := getattr(data, "clear", None)) is not None:
+                clear()
+
+    async def _transact(self, msg_id: int, netmsg: NetMessage, data, idempotent: bool, lane: Lane,
+                        timeout: Optional[float]):
+        await self._wait_online()
         trans_id = self._trans_id
         trans = _Transaction(future=asyncio.get_running_loop().create_future(), data=data)
+        if idempotent and self._reconnect_policy is not None:
+            trans.msg_id, trans.netmsg, trans.idempotent = msg_id, netmsg, True
         self._transactions[trans_id] = trans
         netmsg.trans_id = trans_id
-        await self.send_netstruct(msg_id, netmsg)
-        await trans.future
-        return trans.future.result()
+        try:
+            try:
+                await self.send_netstruct(msg_id, netmsg, lane)
+            except errors.UruNetDisconnectedError:
+                # Replayable transactions go out again once we've reconnected, so the reply is
+                # still worth waiting for.
+                if not trans.idempotent or self._closed:
+                    raise
+            if timeout is None:
+                await trans.future
+            else:
+                try:
+                    await asyncio.wait_for(asyncio.shield(trans.future), timeout)
+                except asyncio.TimeoutError:
+                    raise errors.UruNetTimeoutError(f"No reply to {msg_id:04X} within {timeout:.2f}s") from None
+            return trans.future.result()
+        finally:
+            # Don't leave a timed out or cancelled transaction behind for a late reply to trip over.
+            if self._transactions.get(trans_id) is trans:
+                del self._transactions[trans_id]
 
     def connection_reset(self, msg: str = "Connection reset"):
         if self._read_task is not None:
             self._read_task.cancel(msg)
-        for transaction in self._transactions.values():
-            transaction.future.cancel(msg)
-        return super().connection_reset()
+        if self._reconnect_policy is not None and not self._closed:
+            self._begin_reconnect(msg)
+        else:
+            for transaction in self._transactions.values():
+                transaction.future.cancel(msg)
+            # Nothing more is coming, so let subscribers run out of events.
+            for stream in tuple(self._event_streams):
+                stream.close()
+        return super().connection_reset(msg)
+
+    def _begin_reconnect(self, msg: str) -> None:
+        self._online.clear()
+
+        # Anything that isn't safe to send twice has to fail now - we have no way of knowing
+        # whether or not the server acted on it before the connection dropped.
+        for trans_id, transaction in list(self._transactions.items()):
+            if not transaction.idempotent:
+                del self._transactions[trans_id]
+                if not transaction.future.done():
+                    transaction.future.set_exception(errors.UruNetDisconnectedError(msg))
+
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self.log.warning(f"Connection lost ({msg}), will reconnect")
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    def close(self, msg: str = "Connection closed") -> None:
+        """Closes the connection for good, even if automatic reconnection is enabled"""
+        self._closed = True
+        if self._reconnect_task is not None and self._reconnect_task is not asyncio.current_task():
+            self._reconnect_task.cancel(msg)
+        self.connection_reset(msg)
+        if self._online is not None:
+            self._online.set()
 
     @property
     def _trans_id(self):
@@ -344,7 +730,26 @@ class NetClient(NetStructDispatcher):
     async def ping(self) -> None:
         ...
 
-    async def keep_alive(self) -> None:
-        while not self._read_task.cancelled():
-            await self.ping()
-            await asyncio.sleep(20)
+    async def measure_ping(self) -> float:
+        """Pings the server and folds the round trip time into the RTT estimate"""
+        start = time.perf_counter()
+        await self.ping()
+        rtt = time.perf_counter() - start
+        self.rtt.update(rtt)
+        return rtt
+
+    async def keep_alive(self, scheduler: Optional[_keepalive.PingScheduler] = None) -> None:
+        """Keeps the connection alive until it is closed. The actual pinging is done by a shared
+           scheduler so that thousands of connections don't each need their own timer."""
+        if scheduler is None:
+            scheduler = _keepalive.default_scheduler()
+        scheduler.register(self)
+        try:
+            while self._read_task is not None:
+                await asyncio.wait((self._read_task,))
+                # Hang around if the connection is about to come back.
+                if self._reconnect_task is None or self._reconnect_task.done() or self._closed:
+                    break
+                await asyncio.wait((self._reconnect_task,))
+        finally:
+            scheduler.unregister(self)
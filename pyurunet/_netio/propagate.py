@@ -0,0 +1,138 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import struct
+from typing import *
+
+from . import fields
+from .errors import UruNetProtocolError
+from .sendqueue import Lane
+
+# PropagateBuffer is the same on every protocol that has it: the plasma message's class index,
+# the length of the stream, then the stream itself. The auth and game protocols both use a two
+# byte msg_id, so the whole frame header is built with one pack.
+_body = struct.Struct("<II")
+_frame = struct.Struct("<HII")
+
+_missing = object()
+
+# Plasma itself won't send anything near this big.
+max_propagate_size = 1024 * 1024
+
+# Subscribers get (msg_type, payload) and are called synchronously from the read loop.
+Subscriber = Callable[[int, Any], None]
+
+
+class PropagateRouter:
+    """Passes PropagateBuffer messages straight through to subscribers as raw memoryviews, without
+       ever building a NetMessage. A payload view is only valid for the duration of the callback,
+       so copy it if you need to hang onto it. Subscribers that want something fancier than raw
+       bytes subscribe with decoded=True and get the result of the decoder registered for that
+       message type instead, which is only run if someone actually asked for it."""
+
+    def __init__(self, client, incoming: int, outgoing: int):
+        self.client = client
+        self.outgoing = outgoing
+        self.decoders: Dict[int, Callable[[memoryview], Any]] = {}
+        self.received = 0
+        self.dropped = 0
+        self._raw: Dict[Optional[int], List[Subscriber]] = {}
+        self._decoded: Dict[Optional[int], List[Subscriber]] = {}
+        client.raw_readers[incoming] = self._read
+
+    def subscribe(self, msg_type: Optional[int], callback: Subscriber, *, decoded: bool = False) -> Callable[[], None]:
+        """Calls callback for every message of msg_type (or every message at all, if None).
+           Returns a function that undoes the subscription."""
+        subscribers = (self._decoded if decoded else self._raw).setdefault(msg_type, [])
+        subscribers.append(callback)
+
+        def unsubscribe():
+            if callback in subscribers:
+                subscribers.remove(callback)
+        return unsubscribe
+
+    def _subscribers(self, table, msg_type: int) -> Iterator[Subscriber]:
+        if subscribers := table.get(msg_type):
+            yield from tuple(subscribers)
+        if subscribers := table.get(None):
+            yield from tuple(subscribers)
+
+    async def _read(self, fd) -> None:
+        msg_type, size = _body.unpack(await fd.readexactly(_body.size))
+        if size > max_propagate_size:
+            raise UruNetProtocolError(f"PropagateBuffer of {size} bytes is over the {max_propagate_size} byte limit")
+        self.received += 1
+
+        pool = self.client.buffer_pool
+        if pool is not None and size >= pool.min_size:
+            payload = pool.acquire(size)
+            try:
+                await fields.readinto_exactly(fd, payload)
+                self.route(msg_type, payload)
+            finally:
+                pool.release(payload)
+        else:
+            self.route(msg_type, memoryview(await fd.readexactly(size)))
+
+    def route(self, msg_type: int, payload: memoryview) -> None:
+        delivered = False
+        for callback in self._subscribers(self._raw, msg_type):
+            delivered = True
+            self._call(callback, msg_type, payload)
+
+        decoded = _missing
+        for callback in self._subscribers(self._decoded, msg_type):
+            if decoded is _missing:
+                decoder = self.decoders.get(msg_type, bytes)
+                try:
+                    decoded = decoder(payload)
+                except Exception as e:
+                    self.client.log.warning(f"Failed to decode PropagateBuffer type {msg_type:04X}: {e!r}")
+                    break
+            delivered = True
+            self._call(callback, msg_type, decoded)
+
+        if not delivered:
+            self.dropped += 1
+
+    def _call(self, callback: Subscriber, msg_type: int, payload: Any) -> None:
+        # One broken subscriber mustn't take down the connection for everyone else.
+        try:
+            callback(msg_type, payload)
+        except Exception as e:
+            self.client.log.exception(e)
+
+    def frame(self, msg_type: int, payload: bytes) -> bytes:
+        return _frame.pack(self.outgoing, msg_type, len(payload)) + payload
+
+    def queue(self, msg_type: int, payload: bytes, lane: Lane = Lane.normal) -> None:
+        """Queues a message to be sent without waiting on it. Everything queued in the same pass
+           of the event loop goes out in one write."""
+        self.client.send_queue.push(self.frame(msg_type, payload), self.outgoing, lane)
+
+    async def send(self, msg_type: int, payload: bytes, lane: Lane = Lane.normal) -> None:
+        await self.client.send_queue.send(self.frame(msg_type, payload), self.outgoing, lane)
+
+    async def send_batch(self, messages: Iterable[Tuple[int, bytes]], lane: Lane = Lane.normal) -> None:
+        """Sends many (msg_type, payload) messages, waiting on all of them at once rather than
+           one at a time"""
+        frame, outgoing = _frame.pack, self.outgoing
+        await self.client.send_queue.send_many(
+            ((outgoing, frame(outgoing, msg_type, len(payload)) + payload) for msg_type, payload in messages),
+            lane
+        )
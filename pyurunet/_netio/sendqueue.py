@@ -0,0 +1,166 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+import enum
+import time
+from typing import *
+
+from . import capture as _capture
+from . import errors
+
+
+class Lane(enum.IntEnum):
+    """Outbound priority. Lower lanes are always written first."""
+
+    control = 0
+    normal = 1
+    bulk = 2
+
+
+class _Outgoing(NamedTuple):
+    data: bytes
+    msg_id: Optional[int]
+    future: Optional[asyncio.Future]
+
+
+class SendQueue:
+    """Outbound messages for a single connection. Everything queued during one pass of the event
+       loop goes out in a single write, control traffic first. Large backlogs are written in
+       flush_size slices so that control messages queued in the meantime can jump ahead of them."""
+
+    def __init__(self, owner, limit: int = 1024 * 1024, flush_size: int = 64 * 1024):
+        self.owner = owner
+        self.limit = limit
+        self.flush_size = flush_size
+        self.pending_bytes = 0
+        self._lanes = tuple(deque() for _ in Lane)
+        self._scheduled = False
+        self._draining: Optional[asyncio.Task] = None
+        self._space: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return sum(len(i) for i in self._lanes)
+
+    def push(self, data: bytes, msg_id: Optional[int] = None, lane: Lane = Lane.normal,
+             future: Optional[asyncio.Future] = None) -> None:
+        """Queues data to be sent without waiting for it or for room in the queue"""
+        self._lanes[lane].append(_Outgoing(data, msg_id, future))
+        self.pending_bytes += len(data)
+        if not self._scheduled and self._draining is None:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    async def wait_for_space(self, lane: Lane = Lane.normal) -> None:
+        """Waits until the queue is back under its limit. Control traffic never waits."""
+        while lane != Lane.control and self.pending_bytes >= self.limit:
+            if self._space is None:
+                self._space = asyncio.Event()
+            self._space.clear()
+            await self._space.wait()
+
+    async def send(self, data: bytes, msg_id: Optional[int] = None, lane: Lane = Lane.normal) -> None:
+        """Queues data and waits until the transport has taken it. If the queue is over its limit,
+           this waits for it to drain before queueing anything (except for control traffic)."""
+        await self.wait_for_space(lane)
+        future = asyncio.get_running_loop().create_future()
+        self.push(data, msg_id, lane, future)
+        await future
+
+    async def send_many(self, frames: Iterable[Tuple[Optional[int], bytes]], lane: Lane = Lane.normal) -> None:
+        """Queues several (msg_id, data) frames at once and waits until the transport has taken
+           all of them. If the queue fills up along the way, this waits for it to drain before
+           queueing the rest."""
+        future, last = None, None
+        for msg_id, data in frames:
+            if last is not None:
+                self.push(last[1], last[0], lane)
+            # Checked before every frame so one huge batch can't blow straight through the limit.
+            await self.wait_for_space(lane)
+            last = (msg_id, data)
+        if last is not None:
+            future = asyncio.get_running_loop().create_future()
+            self.push(last[1], last[0], lane, future)
+            await future
+
+    def clear(self, msg: str = "Connection closed") -> None:
+        """Throws away everything that hasn't been written yet. Anyone waiting on those messages
+           gets an UruNetDisconnectedError, since they never made it out."""
+        for lane in self._lanes:
+            while lane:
+                if (future := lane.popleft().future) is not None and not future.done():
+                    future.set_exception(errors.UruNetDisconnectedError(msg))
+        self.pending_bytes = 0
+        if self._space is not None:
+            self._space.set()
+
+    def _flush(self) -> None:
+        self._scheduled = False
+        writer = self.owner.writer
+        if writer is None or writer.is_closing():
+            self.clear("Connection closed before the message could be sent")
+            return
+
+        batch, size = [], 0
+        for lane in self._lanes:
+            control = lane is self._lanes[Lane.control]
+            while lane and (control or size < self.flush_size):
+                item = lane.popleft()
+                batch.append(item)
+                size += len(item.data)
+        if not batch:
+            return
+        self.pending_bytes -= size
+
+        # Captured here rather than when queued so the capture matches what went over the wire.
+        if (capture := self.owner.capture) is not None:
+            for i in batch:
+                if i.msg_id is not None:
+                    capture.write(_capture.Direction.outgoing, i.msg_id, i.data)
+
+        writer.write(batch[0].data if len(batch) == 1 else b"".join(i.data for i in batch))
+        self.owner.messages_sent += len(batch)
+        self.owner.last_send = time.monotonic()
+
+        # Capture replays write to a stand-in with no transport, and so no backpressure either.
+        transport = getattr(writer, "transport", None)
+        if transport is not None and transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            self._draining = asyncio.create_task(self._drain(writer, batch))
+        else:
+            self._flushed(batch)
+
+    async def _drain(self, writer, batch: List[_Outgoing]) -> None:
+        try:
+            await writer.drain()
+        except (ConnectionError, EOFError) as e:
+            self.owner.log.exception(e)
+            self.owner.connection_reset(str(e))
+        finally:
+            self._draining = None
+            self._flushed(batch)
+
+    def _flushed(self, batch: List[_Outgoing]) -> None:
+        for i in batch:
+            if i.future is not None and not i.future.done():
+                i.future.set_result(None)
+        if self._space is not None and self.pending_bytes < self.limit:
+            self._space.set()
+        if any(self._lanes) and not self._scheduled and self._draining is None:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
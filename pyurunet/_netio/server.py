@@ -0,0 +1,238 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+from typing import *
+
+from . import fields
+from .constants import Product
+from .msg import NetMessage, NetStructDispatcher, read_netstruct, _kablooey
+
+_logger = logging.getLogger("PyUruNet")
+
+# Everything in the connection header after the conn_type byte, which we use to pick a protocol.
+_connection_header_tail = (
+    (fields.integer, "size", 2),
+    (fields.integer, "build_id", 4),
+    (fields.integer, "build_type", 4),
+    (fields.integer, "branch_id", 4),
+    (fields.uuid, "product", 1),
+)
+
+
+class NetServerConnection(NetStructDispatcher):
+    """The server side of a single client connection"""
+
+    # The protocol whose Diffie-Hellman keys encrypt this connection. None means the
+    # protocol is not encrypted at all (eg the FileSrv).
+    encryption_protocol: Optional[int] = None
+
+    # A slow request shouldn't hold up everything the client sent after it.
+    concurrent_dispatch = True
+
+    def __init__(self, server: NetServer, reader, writer):
+        super().__init__(reader, writer)
+        self.server = server
+        self.max_backlog = server.max_pending
+        self.log.extra["peer"] = self.peername
+        self.connect_header: Optional[NetMessage] = None
+        self.connect_data = b""
+        self._pending: Set[asyncio.Task] = set()
+        self._pending_limit = asyncio.Semaphore(server.max_pending)
+
+    async def _perform_handshake(self) -> None:
+        self.connect_header = await read_netstruct(self.reader, _connection_header_tail)
+        data_size = await fields.integer.reader(self.reader, 4)
+        self.connect_data = await self.reader.readexactly(max(data_size - 4, 0))
+
+        if self.encryption_protocol is not None:
+            kkey, nkey = self.server.keys[self.encryption_protocol]
+            await self._establish_encryption_s2c(kkey, nkey)
+
+    def handle_incoming(self, msg_id: int, netmsg: NetMessage) -> None:
+        self.log.warning(f"Unhandled {msg_id:X}")
+
+    def connection_reset(self, msg: str = "Connection reset"):
+        for i in self._pending:
+            i.cancel(msg)
+        return super().connection_reset(msg)
+
+    async def spawn(self, coro: Awaitable) -> asyncio.Task:
+        """Runs a coroutine alongside the dispatcher. If too many are already running, this waits
+           for one to finish, so awaiting it from a handler stops us from reading any more
+           requests from a client that is outrunning us."""
+        await self._pending_limit.acquire()
+        task = asyncio.create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._spawn_done)
+        return task
+
+    def _spawn_done(self, task: asyncio.Task) -> None:
+        self._pending.discard(task)
+        self._pending_limit.release()
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            self.log.exception(exc)
+
+
+class NetServer:
+    """Accepts connections and dispatches them to a NetServerConnection based on the protocol
+       requested in the connection header."""
+
+    # conn_type -> NetServerConnection subclass
+    protocols: Dict[int, Type[NetServerConnection]] = {}
+
+    def __init__(self, *, host: str = "0.0.0.0", port: int = Product.port,
+                 keys: Optional[Dict[int, Tuple[int, int]]] = None,
+                 reuse_port: bool = False, backlog: int = 100,
+                 max_connections: Optional[int] = None, max_pending: int = 64,
+                 write_buffer_limit: int = 256 * 1024, handshake_timeout: float = 30.0):
+        self.host = host
+        self._port = port
+        self.keys = keys if keys is not None else {}
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self.write_buffer_limit = write_buffer_limit
+        self.handshake_timeout = handshake_timeout
+        self.connections: Set[NetServerConnection] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.log = logging.LoggerAdapter(_logger, extra=dict(peer=f"{host}/{port}"))
+
+    @property
+    def port(self) -> int:
+        if self._server is not None and self._server.sockets:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    async def start(self) -> None:
+        if self.reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+        self._server = await asyncio.start_server(
+            self._accept, self.host, self._port,
+            backlog=self.backlog,
+            reuse_port=self.reuse_port or None
+        )
+        self.log.extra["peer"] = f"{self.host}/{self.port}"
+        self.log.info(f"Listening on {self.host}/{self.port}")
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            self.close()
+            await self.wait_closed()
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for i in list(self.connections):
+            i.connection_reset("Server shutting down")
+
+    async def wait_closed(self) -> None:
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        await self.wait_closed()
+
+    def connection_factory(self, conn_type: int) -> Optional[Type[NetServerConnection]]:
+        return self.protocols.get(conn_type)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if self.max_connections is not None and len(self.connections) >= self.max_connections:
+            self.log.warning("Too many connections, turning away a client")
+            writer.close()
+            return
+
+        # Make drain() actually wait on slow clients so they get throttled instead of
+        # making us buffer everything we want to send them.
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_limit)
+
+        conn = None
+        try:
+            conn_type = await asyncio.wait_for(fields.integer.reader(reader, 1), self.handshake_timeout)
+            if (conn_cls := self.connection_factory(conn_type)) is None:
+                self.log.warning(f"Client requested unknown protocol {conn_type}")
+                return
+
+            conn = conn_cls(self, reader, writer)
+            self.connections.add(conn)
+            await asyncio.wait_for(conn._perform_handshake(), self.handshake_timeout)
+            await conn.dispatch_netstructs()
+        except (asyncio.TimeoutError, *_kablooey) as e:
+            if conn is not None:
+                conn.connection_reset(str(e))
+        except Exception as e:
+            # Garbage handshakes trip assertions in the encryption setup. Don't let one client
+            # spew the traceback of the century.
+            self.log.warning(f"Dropping client after {e.__class__.__name__}: {e}")
+            if conn is not None:
+                conn.connection_reset(str(e))
+        finally:
+            if conn is not None:
+                self.connections.discard(conn)
+            writer.close()
+
+
+def _worker_main(factory: Callable[[], NetServer]) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def run():
+        server = factory()
+        if not server.reuse_port:
+            raise RuntimeError("Worker servers must be created with reuse_port=True")
+        await server.serve_forever()
+    asyncio.run(run())
+
+def serve_workers(factory: Callable[[], NetServer], workers: Optional[int] = None) -> None:
+    """Runs a NetServer in several worker processes that all share one listening port using
+       SO_REUSEPORT, letting the kernel balance connections between them. The factory is called
+       in each worker, so it must be picklable (eg a module-level function)."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    processes = [multiprocessing.Process(target=_worker_main, args=(factory,), daemon=True)
+                 for _ in range(workers)]
+    for i in processes:
+        i.start()
+    try:
+        for i in processes:
+            i.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for i in processes:
+            if i.is_alive():
+                i.terminate()
+        for i in processes:
+            i.join()
@@ -16,6 +16,7 @@
 
 from __future__ import annotations
 
+from array import array
 import asyncio
 from dataclasses import dataclass
 import io
@@ -24,11 +25,12 @@ import pprint
 import secrets
 import struct
 import time
-from typing import Iterable, List, NamedTuple, Optional, Sequence
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
 import uuid
 
 from . import _netio
 from ._netio import authstructs as _msg
+from .vault.node import VaultNode
 
 import _urunet
 
@@ -61,7 +63,156 @@ class VaultNodeRef(NamedTuple):
     seen: Optional[bool]
 
 
+def _parse_node_refs(buffer: bytes) -> List[VaultNodeRef]:
+    mystruct = struct.Struct("<I")
+    stream = io.BytesIO(buffer)
+    size = len(buffer)
+
+    # The "seen" field is junk on MOULa, so filter that out.
+    seen_LUT = { 0: False, 1: True }
+    result = []
+    while stream.tell() < size:
+        result.append(VaultNodeRef(
+            mystruct.unpack(stream.read(4))[0],
+            mystruct.unpack(stream.read(4))[0],
+            mystruct.unpack(stream.read(4))[0],
+            seen_LUT.get(stream.read(1))
+        ))
+    return result
+
+def _write_node_refs(refs: Iterable[VaultNodeRef]) -> bytes:
+    mystruct = struct.Struct("<IIIB")
+    return b"".join((mystruct.pack(i.parent_id, i.child_id, i.saver_id, bool(i.seen)) for i in refs))
+
+
+class GameScore(NamedTuple):
+    score_id: int
+    owner_id: int
+    created_time: int
+    game_type: int
+    value: int
+    game_name: str
+
+
+class GameRank(NamedTuple):
+    rank: int
+    score: int
+    name: str
+
+
+# Scores and ranks both end in a u32 byte count (including the terminator) and a UTF-16 string.
+_score_header = struct.Struct("<IIIIiI")
+_rank_header = struct.Struct("<IiI")
+
+def _strip_null(name: memoryview) -> memoryview:
+    return name[:-2] if len(name) >= 2 and name[-2:] == b"\0\0" else name
+
+def _parse_scores(buffer: bytes, count: int) -> Tuple[GameScore, ...]:
+    view, pos, result = memoryview(buffer), 0, []
+    for _ in range(count):
+        *values, name_size = _score_header.unpack_from(view, pos)
+        pos += _score_header.size
+        name = bytes(_strip_null(view[pos:pos + name_size])).decode("utf-16-le", errors="replace")
+        pos += name_size
+        result.append(GameScore(*values, name))
+    return tuple(result)
+
+def _write_scores(scores: Iterable[GameScore]) -> bytes:
+    buf = io.BytesIO()
+    for i in scores:
+        name = f"{i.game_name}\0".encode("utf-16-le")
+        buf.write(_score_header.pack(i.score_id, i.owner_id, i.created_time, i.game_type, i.value, len(name)))
+        buf.write(name)
+    return buf.getvalue()
+
+
+class RankTable(Sequence[GameRank]):
+    """A leaderboard page, stored as a handful of arrays instead of thousands of tuples. The names
+       are kept as one UTF-16 blob and only decoded when a row is actually looked at."""
+
+    def __init__(self, ranks: array, scores: array, names: bytes, offsets: array):
+        self.ranks = ranks
+        self.scores = scores
+        self._names = names
+        self._offsets = offsets
+        self._index: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.ranks)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[GameRank, List[GameRank]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return GameRank(self.ranks[index], self.scores[index], self.name(index))
+
+    def __iter__(self) -> Iterator[GameRank]:
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self) -> str:
+        return f"<RankTable: {len(self)} ranks>"
+
+    def name(self, index: int) -> str:
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self._names[start:end].decode("utf-16-le", errors="replace")
+
+    def find(self, name: str) -> Optional[GameRank]:
+        """Looks up a rank by player name"""
+        if self._index is None:
+            self._index = { self.name(i): i for i in range(len(self)) }
+        if (index := self._index.get(name)) is not None:
+            return self[index]
+        return None
+
+def _parse_ranks(buffer: bytes, count: int) -> RankTable:
+    view, pos = memoryview(buffer), 0
+    ranks, scores, offsets, names = array("I"), array("i"), array("I", [0]), bytearray()
+    for _ in range(count):
+        rank, score, name_size = _rank_header.unpack_from(view, pos)
+        pos += _rank_header.size
+        names += _strip_null(view[pos:pos + name_size])
+        pos += name_size
+        ranks.append(rank)
+        scores.append(score)
+        offsets.append(len(names))
+    return RankTable(ranks, scores, bytes(names), offsets)
+
+def _write_ranks(ranks: Iterable[GameRank]) -> bytes:
+    buf = io.BytesIO()
+    for i in ranks:
+        name = f"{i.name}\0".encode("utf-16-le")
+        buf.write(_rank_header.pack(i.rank, i.score, len(name)))
+        buf.write(name)
+    return buf.getvalue()
+
+
+def _node_event_key(msg_id: int, netmsg: _netio.NetMessage) -> Tuple[int, int]:
+    return (msg_id, netmsg.node_id)
+
+def _ref_event_key(msg_id: int, netmsg: _netio.NetMessage) -> Tuple[int, int, int]:
+    return (msg_id, netmsg.parent_id, netmsg.child_id)
+
+
 class AuthCli(_netio.NetClient):
+    # PlayerChat and FriendNotify would belong here too, but no server is known to send them
+    # and we don't know what they look like.
+    event_types = (
+        _msg.A2C.NotifyNewBuild,
+        _msg.A2C.VaultNodeChanged,
+        _msg.A2C.VaultNodeDeleted,
+        _msg.A2C.VaultNodeAdded,
+        _msg.A2C.VaultNodeRemoved,
+        _msg.A2C.KickedOff,
+    )
+    event_keys = {
+        _msg.A2C.NotifyNewBuild: lambda msg_id, netmsg: msg_id,
+        _msg.A2C.VaultNodeChanged: _node_event_key,
+        _msg.A2C.VaultNodeDeleted: _node_event_key,
+        _msg.A2C.VaultNodeAdded: _ref_event_key,
+        _msg.A2C.VaultNodeRemoved: _ref_event_key,
+    }
+
     def __init__(self):
         super().__init__()
         self.incoming_lookup = {
@@ -71,26 +222,57 @@ class AuthCli(_netio.NetClient):
             _msg.A2C.AcctLoginReply: _msg.login_reply,
             _msg.A2C.AcctPlayerInfo: _msg.player_info,
             _msg.A2C.KickedOff: _msg.kicked_off,
+            _msg.A2C.NotifyNewBuild: _msg.notify_new_build,
             _msg.A2C.VaultNodeRefsFetched: _msg.vault_node_refs_fetch_reply,
             _msg.A2C.VaultNodeFetched: _msg.vault_node_fetch_reply,
             _msg.A2C.VaultRemoveNodeReply: _msg.vault_node_remove_reply,
             _msg.A2C.VaultNodeFindReply: _msg.vault_node_find_reply,
+            _msg.A2C.VaultNodeCreated: _msg.vault_node_create_reply,
+            _msg.A2C.VaultSaveNodeReply: _msg.vault_node_save_reply,
+            _msg.A2C.VaultAddNodeReply: _msg.vault_node_add_reply,
+            _msg.A2C.VaultNodeChanged: _msg.vault_node_changed,
+            _msg.A2C.VaultNodeAdded: _msg.vault_node_added,
+            _msg.A2C.VaultNodeRemoved: _msg.vault_node_removed,
+            _msg.A2C.VaultNodeDeleted: _msg.vault_node_deleted,
+            _msg.A2C.ScoreGetScoresReply: _msg.score_get_scores_reply,
+            _msg.A2C.ScoreGetRanksReply: _msg.score_get_ranks_reply,
+            _msg.A2C.ScoreGetHighScoresReply: _msg.score_get_high_scores_reply,
         }
         self.incoming_handlers = {
             _msg.A2C.ServerAddr: self._handle_server_addr,
             _msg.A2C.ClientRegisterReply: self._handle_client_register,
             _msg.A2C.AcctPlayerInfo: self._handle_player_info,
             _msg.A2C.KickedOff: self._handle_kicked_off,
+            _msg.A2C.NotifyNewBuild: self._handle_new_build,
+            _msg.A2C.VaultNodeChanged: self._handle_vault_notify,
+            _msg.A2C.VaultNodeAdded: self._handle_vault_notify,
+            _msg.A2C.VaultNodeRemoved: self._handle_vault_notify,
+            _msg.A2C.VaultNodeDeleted: self._handle_vault_notify,
         }
-        self._challenge = asyncio.get_running_loop().create_future()
+        self.propagate = _netio.propagate.PropagateRouter(self, _msg.A2C.PropagateBuffer, _msg.C2A.PropagateBuffer)
+        # Made for each connection, so a client can be constructed outside of the event loop.
+        self._challenge: Optional[asyncio.Future] = None
         self._build = 918
+        self._credentials: Optional[Tuple[str, str, Optional[int]]] = None
+
+        # Leaderboards get asked for constantly and change slowly. Identical queries made within
+        # a few seconds of each other share a single request.
+        self.score_cache = _netio.TtlCache(ttl=5.0, maxsize=1024)
+
+        # Fetched node data can be shared with other processes through a SharedNodeCache. Change
+        # notifications and our own saves knock nodes back out of it.
+        self.node_cache = None
+        # Anything we've read from or stored in it could have changed while we were offline and
+        # missing notifications, so they get knocked out on reconnect too.
+        self._cached_nodes: Set[int] = set()
 
     def _handle_server_addr(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
         pass
 
     def _handle_client_register(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
         self.log.debug("Got the server challenge!")
-        self._challenge.set_result(netmsg.challenge)
+        if self._challenge is not None and not self._challenge.done():
+            self._challenge.set_result(netmsg.challenge)
 
     def _handle_player_info(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
         self.log.debug(f"Got player ID {netmsg.player_id}: {netmsg.player_name}")
@@ -108,14 +290,25 @@ class AuthCli(_netio.NetClient):
         # semantics. Nothing like getting a "Kicked by CCR" response to your PingRequest.
         if exc := _netio.error_lut.get(reason):
             exc = exc(msg)
-            for i in self._transactions:
+            for i in self._transactions.values():
                 i.future.set_exception(exc)
             self._transactions.clear()
 
-        self.connection_reset(msg)
+        # Don't bother trying to reconnect - the server clearly doesn't want us.
+        self.close(msg)
+
+    def _handle_new_build(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        self.log.info("Server says there's a new build available")
+
+    def _handle_vault_notify(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        # Not much to do here - these are for whoever added a listener for them (eg a VaultMirror).
+        self.log.debug(f"Vault notification: {_msg.A2C(msg_id).name}")
+        if self.node_cache is not None and msg_id in {_msg.A2C.VaultNodeChanged, _msg.A2C.VaultNodeDeleted}:
+            self.node_cache.discard(netmsg.node_id)
 
     async def _perform_handshake(self, build, product, nkey, xkey) -> None:
         self._build = build
+        self._challenge = asyncio.get_running_loop().create_future()
         handshake_struct = _netio.msg.connection_header + _connection_data
         handshake = _netio.msg.NetMessage(handshake_struct,
                                           conn_type=_netio.NetProtocol.auth,
@@ -128,8 +321,18 @@ class AuthCli(_netio.NetClient):
         await self.send_netstruct(None, handshake)
         await self._establish_encryption_c2s(_netio.DiffieHellmanG.auth, nkey, xkey)
 
+    async def _restore_session(self) -> None:
+        if self.node_cache is not None:
+            for node_id in self._cached_nodes:
+                self.node_cache.discard(node_id)
+        self._cached_nodes.clear()
+        if self._credentials is not None:
+            await self.login(*self._credentials)
+
     async def login(self, account: str, password: str, build: Optional[int] = None) -> LoginResult:
         self.log.debug("Logging in...")
+        if self._reconnect_policy is not None:
+            self._credentials = (account, password, build)
 
         if not self._challenge.done():
             self.log.debug("Need a server challenge...")
@@ -179,18 +382,28 @@ class AuthCli(_netio.NetClient):
             players=players
         )
         self.log.debug(pprint.pformat(result))
+        return result
 
     async def ping(self) -> None:
         ts = int(time.monotonic())
         ping = _netio.msg.NetMessage(_msg.ping_pong, ping_time=ts, payload=b"fart\0")
         self.log.debug(f"AUTH PING: {ts}?")
-        pong = await self.send_transaction(_msg.C2A.PingRequest, ping)
+        pong = await self.send_transaction(_msg.C2A.PingRequest, ping, idempotent=True,
+                                           lane=_netio.Lane.control)
         self.log.debug(f"AUTH PONG: {pong.ping_time}!")
 
-    async def vault_fetch_node(self, node_id: int):
+    async def vault_fetch_node(self, node_id: int, *, cached: bool = True):
+        node_cache = self.node_cache
+        if node_cache is not None:
+            if cached and (data := node_cache.get(node_id)) is not None:
+                self._cached_nodes.add(node_id)
+                return data
+            generation = node_cache.generation
         req = _netio.msg.NetMessage(_msg.vault_node_fetch_request, node_id=node_id)
         self.log.debug(f"Requesting node {node_id}...")
-        reply = await self.send_transaction(_msg.C2A.VaultNodeFetch, req)
+        reply = await self.send_transaction(_msg.C2A.VaultNodeFetch, req, idempotent=True)
+        if node_cache is not None and node_cache.put(node_id, reply.node_data, generation=generation):
+            self._cached_nodes.add(node_id)
         return reply.node_data
 
     async def vault_fetch_node_refs(self, node_id: int) -> Sequence[VaultNodeRef]:
@@ -199,30 +412,49 @@ class AuthCli(_netio.NetClient):
             node_id=node_id
         )
         self.log.debug(f"Requesting vault tree for node {node_id}...")
-        reply = await self.send_transaction(_msg.C2A.VaultFetchNodeRefs, req)
-
-        mystruct = struct.Struct("<I")
-        stream = io.BytesIO(reply.buffer)
-        size = len(reply.buffer)
-
-        # The "seen" field is junk on MOULa, so filter that out.
-        seen_LUT = { 0: False, 1: True }
-        result = []
-        while stream.tell() < size:
-            result.append(VaultNodeRef(
-                mystruct.unpack(stream.read(4))[0],
-                mystruct.unpack(stream.read(4))[0],
-                mystruct.unpack(stream.read(4))[0],
-                seen_LUT.get(stream.read(1))
-            ))
-        return result
+        reply = await self.send_transaction(_msg.C2A.VaultFetchNodeRefs, req, idempotent=True)
+        return _parse_node_refs(reply.buffer)
 
     async def vault_find_node(self, template: bytes) -> Sequence[int]:
         req = _netio.msg.NetMessage(_msg.vault_node_find_request, template_node=template)
         self.log.debug(f"Sending vault node find of length {len(template)}")
-        reply = await self.send_transaction(_msg.C2A.VaultNodeFind, req)
+        reply = await self.send_transaction(_msg.C2A.VaultNodeFind, req, idempotent=True)
         return reply.node_ids
 
+    async def vault_create_node(self, node: Union[VaultNode, bytes]) -> int:
+        """Creates a node and returns its ID"""
+        data = node.to_bytes() if isinstance(node, VaultNode) else node
+        req = _netio.msg.NetMessage(_msg.vault_node_create_request, node_data=data)
+        self.log.debug(f"Creating a node of length {len(data)}")
+        reply = await self.send_transaction(_msg.C2A.VaultNodeCreate, req)
+        return reply.node_id
+
+    async def vault_save_node(self, node_id: int, node: Union[VaultNode, bytes],
+                              revision_id: Optional[uuid.UUID] = None) -> None:
+        """Saves the fields set in node over node_id. Fields that aren't set are left alone."""
+        data = node.to_bytes() if isinstance(node, VaultNode) else node
+        req = _netio.msg.NetMessage(
+            _msg.vault_node_save_request,
+            node_id=node_id,
+            revision_id=revision_id if revision_id is not None else uuid.uuid4(),
+            node_data=data
+        )
+        self.log.debug(f"Saving node {node_id} ({len(data)} bytes)")
+        # Saving the same fields twice is harmless, so this can be replayed.
+        await self.send_transaction(_msg.C2A.VaultNodeSave, req, idempotent=True)
+        if self.node_cache is not None:
+            self.node_cache.discard(node_id)
+
+    async def vault_add_node(self, parent_id: int, child_id: int, owner_id: int = 0) -> None:
+        req = _netio.msg.NetMessage(
+            _msg.vault_node_add_request,
+            parent_id=parent_id,
+            child_id=child_id,
+            owner_id=owner_id
+        )
+        self.log.debug(f"Adding reference {parent_id} -> {child_id}")
+        await self.send_transaction(_msg.C2A.VaultNodeAdd, req)
+
     async def vault_remove_node(self, parent_id: int, child_id: int) -> None:
         req = _netio.msg.NetMessage(
             _msg.vault_node_remove_request,
@@ -231,3 +463,58 @@ class AuthCli(_netio.NetClient):
         )
         self.log.debug(f"Sending vault node remove request for reference {parent_id} -> {child_id}")
         await self.send_transaction(_msg.C2A.VaultNodeRemove, req)
+
+    async def _get_scores(self, owner_id: int, game_name: str) -> Tuple[GameScore, ...]:
+        req = _netio.NetMessage(_msg.score_get_scores_request, owner_id=owner_id, game_name=game_name)
+        self.log.debug(f"Requesting {game_name} scores for {owner_id}")
+        reply = await self.send_transaction(_msg.C2A.ScoreGetScores, req, idempotent=True)
+        return _parse_scores(reply.buffer, reply.score_count)
+
+    async def get_scores(self, owner_id: int, game_name: str, *, cached: bool = True) -> Tuple[GameScore, ...]:
+        if not cached:
+            return await self._get_scores(owner_id, game_name)
+        key = ("scores", owner_id, game_name)
+        return await self.score_cache.get(key, lambda: self._get_scores(owner_id, game_name))
+
+    async def _get_ranks(self, owner_id: int, score_group: int, parent_folder_id: int, game_name: str,
+                         time_period: int, num_results: int, page_number: int, sort_desc: bool) -> RankTable:
+        req = _netio.NetMessage(
+            _msg.score_get_ranks_request,
+            owner_id=owner_id,
+            score_group=score_group,
+            parent_folder_id=parent_folder_id,
+            game_name=game_name,
+            time_period=time_period,
+            num_results=num_results,
+            page_number=page_number,
+            sort_desc=int(sort_desc)
+        )
+        self.log.debug(f"Requesting {game_name} ranks, page {page_number}")
+        reply = await self.send_transaction(_msg.C2A.ScoreGetRanks, req, idempotent=True)
+        return _parse_ranks(reply.buffer, reply.rank_count)
+
+    async def get_ranks(self, owner_id: int, score_group: int, parent_folder_id: int, game_name: str,
+                        time_period: int = 0, num_results: int = 100, page_number: int = 0,
+                        sort_desc: bool = True, *, cached: bool = True) -> RankTable:
+        args = (owner_id, score_group, parent_folder_id, game_name, time_period, num_results, page_number, bool(sort_desc))
+        if not cached:
+            return await self._get_ranks(*args)
+        return await self.score_cache.get(("ranks", *args), lambda: self._get_ranks(*args))
+
+    async def _get_high_scores(self, age_id: int, max_scores: int, game_name: str) -> Tuple[GameScore, ...]:
+        req = _netio.NetMessage(
+            _msg.score_get_high_scores_request,
+            age_id=age_id,
+            max_scores=max_scores,
+            game_name=game_name
+        )
+        self.log.debug(f"Requesting the top {max_scores} {game_name} scores in {age_id}")
+        reply = await self.send_transaction(_msg.C2A.ScoreGetHighScores, req, idempotent=True)
+        return _parse_scores(reply.buffer, reply.score_count)
+
+    async def get_high_scores(self, age_id: int, max_scores: int, game_name: str, *,
+                              cached: bool = True) -> Tuple[GameScore, ...]:
+        if not cached:
+            return await self._get_high_scores(age_id, max_scores, game_name)
+        key = ("high_scores", age_id, max_scores, game_name)
+        return await self.score_cache.get(key, lambda: self._get_high_scores(age_id, max_scores, game_name))
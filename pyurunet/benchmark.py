@@ -0,0 +1,362 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Microbenchmarks for the codecs, crypto, and parsers.
+
+Usage: python -m pyurunet.benchmark [-k FILTER] [-o results.json] [--compare baseline.json]
+"""
+
+from __future__ import annotations
+
+import argparse
+from array import array
+import asyncio
+from dataclasses import asdict, dataclass
+import datetime
+import fnmatch
+import io
+import json
+import os
+import platform
+import secrets
+import statistics
+import struct
+import subprocess
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+import uuid
+
+from . import _netio
+from ._netio import authstructs
+from .authcli import _parse_node_refs
+from .filecli import _parse_manifest
+from .gamecli import GameCli
+from .mocksrv import synthetic_manifest, synthetic_node, synthetic_node_refs
+from .vault.graph import VaultGraph
+from .vault.node import parse_node
+
+import _urunet
+
+# A benchmark setup function returns a callable that performs `number` operations. Async
+# benchmarks return a coroutine function instead. The optional second value is the number of
+# bytes processed per operation, used to report throughput.
+_Op = Union[Callable[[int], None], Callable[[int], Awaitable[None]]]
+_benchmarks: Dict[str, Callable[[], Tuple[_Op, Optional[int]]]] = {}
+
+def _benchmark(name: str):
+    def decorator(func):
+        _benchmarks[name] = func
+        return func
+    return decorator
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    number: int
+    repeat: int
+    best_ns: float
+    median_ns: float
+    ops_per_sec: float
+    mb_per_sec: Optional[float]
+
+
+def _field_read(field, size, value) -> Tuple[_Op, int]:
+    bio = io.BytesIO()
+    field.writer(bio, size, value)
+    data = bio.getvalue()
+
+    # The stream is refilled before every read, just like the transport would do, so that
+    # large payloads don't pile up in memory.
+    async def run(number: int):
+        fd = asyncio.StreamReader()
+        for _ in range(number):
+            fd.feed_data(data)
+            await field.reader(fd, size)
+    return run, len(data)
+
+def _field_write(field, size, value) -> Tuple[_Op, None]:
+    def run(number: int):
+        bio = io.BytesIO()
+        for _ in range(number):
+            field.writer(bio, size, value)
+    return run, None
+
+# ==============================================================================
+
+_uuid = uuid.UUID("ea489821-6c35-4bd0-9dae-bb17c585e680")
+_node_ids = list(range(1000, 2000))
+_buffer = secrets.token_bytes(64 * 1024)
+
+_benchmark("fields.integer.read")(lambda: _field_read(_netio.fields.integer, 4, 0xDEADBEEF))
+_benchmark("fields.integer.write")(lambda: _field_write(_netio.fields.integer, 4, 0xDEADBEEF))
+_benchmark("fields.string.read")(lambda: _field_read(_netio.fields.string, 64, "Hoikas@example.com"))
+_benchmark("fields.string.write")(lambda: _field_write(_netio.fields.string, 64, "Hoikas@example.com"))
+_benchmark("fields.char16_blob.read")(lambda: _field_read(_netio.fields.char16_blob, 260, "SecurePreloader"))
+_benchmark("fields.char16_blob.write")(lambda: _field_write(_netio.fields.char16_blob, 260, "SecurePreloader"))
+_benchmark("fields.uuid.read")(lambda: _field_read(_netio.fields.uuid, 1, _uuid))
+_benchmark("fields.uuid.write")(lambda: _field_write(_netio.fields.uuid, 1, _uuid))
+_benchmark("fields.dword_array.read.1000")(lambda: _field_read(_netio.fields.dword_array, None, _node_ids))
+_benchmark("fields.dword_array.write.1000")(lambda: _field_write(_netio.fields.dword_array, None, _node_ids))
+_benchmark("fields.dword_array.write_array.1000")(lambda: _field_write(_netio.fields.dword_array, None, array("I", _node_ids)))
+_benchmark("fields.medium_buffer.read.64k")(lambda: _field_read(_netio.fields.medium_buffer, 1, _buffer))
+_benchmark("fields.medium_buffer.write.64k")(lambda: _field_write(_netio.fields.medium_buffer, 1, _buffer))
+
+def _login_reply() -> _netio.NetMessage:
+    return _netio.NetMessage(
+        authstructs.login_reply,
+        trans_id=1,
+        result=0,
+        uuid=_uuid,
+        flags=0,
+        billing_type=1,
+        encryption_key=[1, 2, 3, 4]
+    )
+
+@_benchmark("netstruct.read.login_reply")
+def _netstruct_read():
+    data = _netio.write_netstruct(None, _login_reply())
+
+    async def run(number: int):
+        fd = asyncio.StreamReader()
+        for _ in range(number):
+            fd.feed_data(data)
+            await _netio.read_netstruct(fd, authstructs.login_reply)
+    return run, len(data)
+
+@_benchmark("netstruct.write.login_reply")
+def _netstruct_write():
+    netmsg = _login_reply()
+
+    def run(number: int):
+        for _ in range(number):
+            _netio.write_netstruct(None, netmsg)
+    return run, None
+
+def _rc4(size: int):
+    data = secrets.token_bytes(size)
+    rc4 = _urunet.rc4(secrets.token_bytes(7))
+
+    def run(number: int):
+        for _ in range(number):
+            rc4.transform(data)
+    return run, size
+
+for _size in (16, 256, 4096, 65536, 1024 * 1024):
+    _benchmark(f"rc4.transform.{_size}")(lambda size=_size: _rc4(size))
+
+def _sha(func, size: int):
+    data = secrets.token_bytes(size)
+
+    def run(number: int):
+        for _ in range(number):
+            func(data)
+    return run, size
+
+for _size in (64, 4096):
+    _benchmark(f"sha0_buffer.{_size}")(lambda size=_size: _sha(_urunet.sha0_buffer, size))
+    _benchmark(f"sha1_buffer.{_size}")(lambda size=_size: _sha(_urunet.sha1_buffer, size))
+
+@_benchmark("filecli.parse_manifest.1000")
+def _manifest():
+    data = synthetic_manifest(1000)
+
+    def run(number: int):
+        for _ in range(number):
+            _parse_manifest(data)
+    return run, len(data)
+
+@_benchmark("authcli.parse_node_refs.10000")
+def _node_refs():
+    data = synthetic_node_refs(10000)
+
+    def run(number: int):
+        for _ in range(number):
+            _parse_node_refs(data)
+    return run, len(data)
+
+@_benchmark("vault.parse_node.512")
+def _vault_node():
+    data = synthetic_node(1, 1, 512)
+
+    def run(number: int):
+        for _ in range(number):
+            parse_node(data)
+    return run, len(data)
+
+@_benchmark("vault.graph.build.10000")
+def _vault_graph_build():
+    refs = _parse_node_refs(synthetic_node_refs(10000))
+
+    def run(number: int):
+        for _ in range(number):
+            VaultGraph(refs)
+    return run, None
+
+@_benchmark("vault.graph.ancestors.10000")
+def _vault_graph_ancestors():
+    refs = _parse_node_refs(synthetic_node_refs(10000))
+    graph, leaf = VaultGraph(refs), refs[-1].child_id
+
+    def run(number: int):
+        for _ in range(number):
+            for _ in graph.ancestors(leaf):
+                pass
+    return run, None
+
+@_benchmark("propagate.read.256")
+def _propagate_read():
+    cli = GameCli()
+    cli.propagate.subscribe(None, lambda msg_type, payload: None)
+    data = struct.pack("<II", 0x0210, 256) + secrets.token_bytes(256)
+
+    async def run(number: int):
+        fd = asyncio.StreamReader()
+        for _ in range(number):
+            fd.feed_data(data)
+            await cli.propagate._read(fd)
+    return run, len(data)
+
+# Import time can only be measured in a fresh interpreter, so these include its startup cost.
+# Compare against import.baseline to see what's actually ours.
+def _import(statement: str):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, sys.path)))
+    args = [sys.executable, "-c", statement]
+
+    def run(number: int):
+        for _ in range(number):
+            subprocess.run(args, env=env, check=True)
+    return run, None
+
+_benchmark("import.baseline")(lambda: _import("pass"))
+_benchmark("import.pyurunet")(lambda: _import("import pyurunet"))
+_benchmark("import.pyurunet.AuthCli")(lambda: _import("import pyurunet; pyurunet.AuthCli"))
+_benchmark("import.pyurunet.FileCli")(lambda: _import("import pyurunet; pyurunet.FileCli"))
+
+# ==============================================================================
+
+def _time_once(loop: asyncio.AbstractEventLoop, op: _Op, number: int) -> float:
+    start = time.perf_counter()
+    result = op(number)
+    if asyncio.iscoroutine(result):
+        loop.run_until_complete(result)
+    return time.perf_counter() - start
+
+def run_benchmark(name: str, *, repeat: int = 5, min_time: float = 0.2,
+                  loop: Optional[asyncio.AbstractEventLoop] = None) -> BenchmarkResult:
+    """Runs a single benchmark, timeit-style: the number of operations per run is scaled up until
+       a run takes at least min_time, then the best of several runs is reported."""
+    op, size = _benchmarks[name]()
+    own_loop = loop is None
+    if own_loop:
+        loop = asyncio.new_event_loop()
+    try:
+        number = 1
+        while True:
+            elapsed = _time_once(loop, op, number)
+            if elapsed >= min_time:
+                break
+            number *= 10 if elapsed < min_time / 10 else 2
+
+        timings = [elapsed] + [_time_once(loop, op, number) for _ in range(repeat - 1)]
+    finally:
+        if own_loop:
+            loop.close()
+
+    per_op = [i / number for i in timings]
+    best = min(per_op)
+    return BenchmarkResult(
+        name=name,
+        number=number,
+        repeat=repeat,
+        best_ns=best * 1e9,
+        median_ns=statistics.median(per_op) * 1e9,
+        ops_per_sec=1.0 / best,
+        mb_per_sec=(size / best / (1024 * 1024)) if size else None
+    )
+
+def run_benchmarks(pattern: str = "*", **kwargs) -> Dict[str, Any]:
+    results = {}
+    for name in sorted(_benchmarks):
+        if not fnmatch.fnmatchcase(name, pattern):
+            continue
+        result = run_benchmark(name, **kwargs)
+        results[name] = asdict(result)
+        print(f"{name:<40} {result.best_ns:>14,.0f} ns/op {result.ops_per_sec:>14,.0f} ops/s", file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any],
+                    threshold: float = 0.10) -> Dict[str, float]:
+    """Returns the benchmarks that got slower than the baseline by more than threshold, mapped
+       to their new/old time ratio."""
+    regressions = {}
+    for name, result in current["results"].items():
+        if (old := baseline["results"].get(name)) is None:
+            continue
+        ratio = result["best_ns"] / old["best_ns"]
+        flag = ""
+        if ratio > 1.0 + threshold:
+            regressions[name] = ratio
+            flag = "  REGRESSION"
+        print(f"{name:<40} {old['best_ns']:>14,.0f} -> {result['best_ns']:>14,.0f} ns/op ({ratio:.2f}x){flag}", file=sys.stderr)
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m pyurunet.benchmark", description=__doc__.splitlines()[0])
+    parser.add_argument("-k", "--filter", default="*", help="only run benchmarks matching this glob")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="number of timed runs per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum duration of each timed run")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a previous JSON result")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown ratio above which a comparison counts as a regression")
+    parser.add_argument("-l", "--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print("\n".join(name for name in sorted(_benchmarks) if fnmatch.fnmatchcase(name, args.filter)))
+        return 0
+
+    results = run_benchmarks(args.filter, repeat=args.repeat, min_time=args.min_time)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, "r") as fp:
+            baseline = json.load(fp)
+        if regressions := compare_results(baseline, results, args.threshold):
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,16 +16,22 @@
 
 from __future__ import annotations
 
+from array import array
 import asyncio
+import binascii
 from dataclasses import dataclass
+import hashlib
 import io
-from pathlib import PureWindowsPath
+from pathlib import Path, PurePath, PureWindowsPath
 import struct
+import sys
 import time
-from typing import List
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+import zlib
 
 from . import _netio
 from ._netio import filestructs as _msg
+from .store import ContentStore
 
 import _urunet
 
@@ -46,6 +52,258 @@ class ManifestEntry:
     flags: int
 
 
+def _path_key(path: Union[str, PurePath]) -> str:
+    # Windows paths, so neither the case nor the flavor of slash matters.
+    return str(path).replace("/", "\\").casefold()
+
+def _hash_key(value: Union[str, bytes]) -> bytes:
+    return binascii.unhexlify(value) if isinstance(value, str) else bytes(value)
+
+
+class ManifestTable(Sequence[ManifestEntry]):
+    """A manifest stored column by column: the names as (interned) strings, the MD5s as raw bytes,
+       and the sizes and flags in arrays. ManifestEntry rows, with their PureWindowsPaths, are only
+       made when someone actually asks for one. Lookups by path or hash build their index the
+       first time they're needed."""
+
+    def __init__(self, entries: Iterable[ManifestEntry] = ()):
+        self.file_names: List[str] = []
+        self.download_names: List[str] = []
+        self.file_sizes = array("I")
+        self.download_sizes = array("I")
+        self.flags = array("I")
+        self._file_hashes = bytearray()
+        self._download_hashes = bytearray()
+        self._path_index: Optional[Dict[str, int]] = None
+        self._hash_index: Optional[Dict[bytes, List[int]]] = None
+        self._row_keys: Optional[Set[Tuple[str, bytes]]] = None
+        for i in entries:
+            self.append(i)
+
+    def __len__(self) -> int:
+        return len(self.file_names)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[ManifestEntry, List[ManifestEntry]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return ManifestEntry(
+            PureWindowsPath(self.file_names[index]), PureWindowsPath(self.download_names[index]),
+            self.file_hash(index).hex(), self.download_hash(index).hex(),
+            self.file_sizes[index], self.download_sizes[index], self.flags[index]
+        )
+
+    def __iter__(self) -> Iterator[ManifestEntry]:
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self) -> str:
+        return f"<ManifestTable: {len(self)} files>"
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, ManifestEntry):
+            index = self.index_of(item.file_name)
+            return index is not None and self[index] == item
+        return self.index_of(item) is not None
+
+    def clear(self) -> None:
+        for column in (self.file_names, self.download_names, self._file_hashes, self._download_hashes):
+            column.clear()
+        for column in (self.file_sizes, self.download_sizes, self.flags):
+            del column[:]
+        self._path_index = self._hash_index = self._row_keys = None
+
+    def file_hash(self, index: int) -> bytes:
+        return bytes(self._file_hashes[index * 16:index * 16 + 16])
+
+    def download_hash(self, index: int) -> bytes:
+        return bytes(self._download_hashes[index * 16:index * 16 + 16])
+
+    def append(self, entry: ManifestEntry) -> None:
+        self._append(str(entry.file_name), str(entry.download_name),
+                     _hash_key(entry.file_hash), _hash_key(entry.download_hash),
+                     entry.file_size, entry.download_size, entry.flags)
+
+    def _append(self, file_name: str, download_name: str, file_hash: bytes, download_hash: bytes,
+                file_size: int, download_size: int, flags: int) -> None:
+        index = len(self.file_names)
+        self.file_names.append(sys.intern(file_name))
+        self.download_names.append(sys.intern(download_name))
+        self._file_hashes += file_hash.rjust(16, b"\0")
+        self._download_hashes += download_hash.rjust(16, b"\0")
+        self.file_sizes.append(file_size)
+        self.download_sizes.append(download_size)
+        self.flags.append(flags)
+        if self._path_index is not None:
+            self._path_index.setdefault(_path_key(file_name), index)
+        if self._row_keys is not None:
+            self._row_keys.add((_path_key(file_name), file_hash))
+        self._hash_index = None
+
+    def update(self, other: Iterable[ManifestEntry]) -> int:
+        """Adds the entries of another manifest that this one doesn't already have, meaning the
+           same path with the same contents. A file that's different in the two manifests ends up
+           in here twice, and find() returns whichever came first. Returns how many were added."""
+        if self._row_keys is None:
+            self._row_keys = { (_path_key(name), self.file_hash(i)) for i, name in enumerate(self.file_names) }
+        row_keys, added = self._row_keys, len(self)
+        if isinstance(other, ManifestTable):
+            # Straight from column to column, without making any ManifestEntries.
+            for i, name in enumerate(other.file_names):
+                file_hash = other.file_hash(i)
+                if (_path_key(name), file_hash) not in row_keys:
+                    self._append(name, other.download_names[i], file_hash, other.download_hash(i),
+                                 other.file_sizes[i], other.download_sizes[i], other.flags[i])
+        else:
+            for i in other:
+                if (_path_key(i.file_name), _hash_key(i.file_hash).rjust(16, b"\0")) not in row_keys:
+                    self.append(i)
+        return len(self) - added
+
+    def index_of(self, path: Union[str, PurePath]) -> Optional[int]:
+        """Returns the row of the file at path, or None if the manifest doesn't have it"""
+        if self._path_index is None:
+            self._path_index = {}
+            for i, name in enumerate(self.file_names):
+                self._path_index.setdefault(_path_key(name), i)
+        return self._path_index.get(_path_key(path))
+
+    def find(self, path: Union[str, PurePath]) -> Optional[ManifestEntry]:
+        """Looks up a file by its client path, ignoring case"""
+        if (index := self.index_of(path)) is not None:
+            return self[index]
+        return None
+
+    def find_hash(self, file_hash: Union[str, bytes]) -> List[ManifestEntry]:
+        """Finds every file whose contents have this MD5, given as hex or raw bytes"""
+        if self._hash_index is None:
+            self._hash_index = {}
+            hashes = self._file_hashes
+            for i in range(len(self)):
+                self._hash_index.setdefault(bytes(hashes[i * 16:i * 16 + 16]), []).append(i)
+        return [self[i] for i in self._hash_index.get(_hash_key(file_hash), ())]
+
+
+class _Download:
+    """Where the chunks of a file download go. dest needs to be seekable (or have a clear()
+       method) for the download to start over cleanly after a reconnect."""
+
+    def __init__(self, dest: BinaryIO, expected_hash: Union[str, bytes, None], decompress: bool):
+        self.dest = dest
+        self.expected_hash = _hash_key(expected_hash) if expected_hash is not None else None
+        self.decompress = decompress
+        self._start = dest.tell() if not hasattr(dest, "clear") and dest.seekable() else None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.received = 0
+        self._md5 = hashlib.md5(usedforsecurity=False) if self.expected_hash is not None else None
+        self._inflate = zlib.decompressobj(wbits=31) if self.decompress else None
+
+    def clear(self) -> None:
+        # The download is starting over, eg after a reconnect.
+        self._reset()
+        if hasattr(self.dest, "clear"):
+            self.dest.clear()
+        elif self._start is not None:
+            self.dest.seek(self._start)
+            self.dest.truncate()
+
+    def write(self, data) -> None:
+        self.received += len(data)
+        if self._md5 is not None:
+            self._md5.update(data)
+        if self._inflate is not None:
+            try:
+                data = self._inflate.decompress(data)
+            except zlib.error as e:
+                raise _netio.UruNetProtocolError(f"Download is not valid gzip: {e}") from None
+        self.dest.write(data)
+
+    def finish(self) -> None:
+        if self._inflate is not None:
+            self.dest.write(self._inflate.flush())
+            if not self._inflate.eof:
+                raise _netio.UruNetProtocolError("Download ended in the middle of the gzip stream")
+        if self._md5 is not None and self._md5.digest() != self.expected_hash:
+            raise _netio.UruNetProtocolError(f"Download hashes to {self._md5.hexdigest()}, not {self.expected_hash.hex()}")
+
+
+_manifest_numbers = struct.Struct("<9H")
+
+def _string_end(data: bytes, pos: int) -> int:
+    # The terminator has to be on a character boundary, not straddling two characters.
+    while True:
+        nul = data.find(b"\0\0", pos)
+        if nul < 0:
+            raise _netio.UruNetProtocolError("Unterminated string in manifest")
+        if not (nul - pos) & 1:
+            return nul
+        pos = nul + 1
+
+def _parse_manifest(buffer: bytes, table: Optional[ManifestTable] = None) -> ManifestTable:
+    """Unpacks the binary manifest into our working... thingy... If a table is given, the entries
+       are added to it."""
+    if table is None:
+        table = ManifestTable()
+    data, pos = bytes(buffer), 0
+    append, unhexlify = table._append, binascii.unhexlify
+    while pos < len(data):
+        nul = _string_end(data, pos)
+        if nul == pos:
+            break
+        file_name = data[pos:nul].decode("utf-16-le", errors="replace")
+        pos = nul + 2
+        nul = _string_end(data, pos)
+        download_name = data[pos:nul].decode("utf-16-le", errors="replace")
+        pos = nul + 2
+
+        # Two 32 character hex strings, which are plain ASCII, so every other byte is the digit.
+        if data[pos + 64:pos + 66] != b"\0\0" or data[pos + 130:pos + 132] != b"\0\0":
+            raise _netio.UruNetProtocolError(f"Bad hash for {file_name} in manifest")
+        try:
+            file_hash, download_hash = unhexlify(data[pos:pos + 64:2]), unhexlify(data[pos + 66:pos + 130:2])
+        except binascii.Error:
+            raise _netio.UruNetProtocolError(f"Bad hash for {file_name} in manifest") from None
+        pos += 132
+
+        # Each number is a big endian pair of shorts followed by a null short. Because... Cyan.
+        try:
+            numbers = _manifest_numbers.unpack_from(data, pos)
+        except struct.error:
+            raise _netio.UruNetProtocolError(f"Manifest entry for {file_name} is truncated") from None
+        if numbers[2] or numbers[5] or numbers[8]:
+            raise _netio.UruNetProtocolError(f"Bad number for {file_name} in manifest")
+        pos += _manifest_numbers.size
+        append(file_name, download_name, file_hash, download_hash,
+               numbers[0] << 16 | numbers[1], numbers[3] << 16 | numbers[4], numbers[6] << 16 | numbers[7])
+    return table
+
+def _write_manifest(entries: Iterable[ManifestEntry]) -> bytes:
+    """Packs manifest entries into the FileSrv's binary manifest format"""
+    s = io.BytesIO()
+
+    def write_string(value: str, size=None) -> None:
+        if size is not None:
+            value = value[:size].ljust(size, "0")
+        s.write(value.encode("utf-16-le"))
+        s.write(bytes(2))
+
+    def write_u32(value: int) -> None:
+        s.write(struct.pack("<HHH", value >> 16, value & 0xFFFF, 0))
+
+    for i in entries:
+        write_string(str(i.file_name))
+        write_string(str(i.download_name))
+        write_string(i.file_hash, 32)
+        write_string(i.download_hash, 32)
+        write_u32(i.file_size)
+        write_u32(i.download_size)
+        write_u32(i.flags)
+    s.write(bytes(2))
+    return s.getvalue()
+
+
 class FileCli(_netio.NetClient):
 
     # The FileSrv sends all messages as buffer propagations. Fortunately, our NetCli will
@@ -55,18 +313,46 @@ class FileCli(_netio.NetClient):
         (_netio.fields.integer, "msg_id", 4),
     )
 
+    # Manifest replies wait on their ack being sent, which shouldn't stall any other requests.
+    concurrent_dispatch = True
+
+    event_types = (_msg.F2C.BuildIdUpdate,)
+    event_keys = { _msg.F2C.BuildIdUpdate: lambda msg_id, netmsg: msg_id }
+
+    @property
+    def buffer_pool(self) -> Optional[_netio.BufferPool]:
+        # Manifests are parsed as soon as they arrive, so their buffers are safe to recycle. Unless
+        # we've been handed a pool of our own, we share the one for whichever loop we're on.
+        try:
+            return self._buffer_pool
+        except AttributeError:
+            return _netio.bufpool.default_pool()
+
+    @buffer_pool.setter
+    def buffer_pool(self, pool: Optional[_netio.BufferPool]) -> None:
+        self._buffer_pool = pool
+
     def __init__(self):
         super().__init__()
         self.incoming_lookup = {
             _msg.F2C.PingReply: _msg.ping_pong,
             _msg.F2C.BuildIdReply: _msg.build_id_reply,
             _msg.F2C.ManifestReply: _msg.manifest_reply,
+            _msg.F2C.BuildIdUpdate: _msg.build_id_update,
+            _msg.F2C.FileDownloadReply: _msg.file_download_reply,
         }
         self.incoming_handlers = {
             _msg.F2C.PingReply: self._handle_pong,
             _msg.F2C.ManifestReply: self._handle_manifest,
+            _msg.F2C.FileDownloadReply: self._handle_download,
+            _msg.F2C.BuildIdUpdate: self._handle_build_id_update,
         }
         self._build = 0
+        self._pings: Dict[int, asyncio.Future] = {}
+
+    def _handle_build_id_update(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        # Nothing to do for us, but subscribers to events() will want to know.
+        self.log.info(f"Server is now on build {netmsg.build_id}")
 
     async def _handle_manifest(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
         # Go ahead and send the response that we got it.
@@ -75,82 +361,87 @@ class FileCli(_netio.NetClient):
             trans_id=netmsg.trans_id,
             reader_id=netmsg.reader_id
         )
-        ack = self.send_netstruct(_msg.C2F.ManifestEntryAck, response)
+        ack = self.send_netstruct(_msg.C2F.ManifestEntryAck, response, _netio.Lane.control)
 
         # We will potenially get this call multiple times, so we want to
         # keep firing until we have all of the files.
         if transaction := self._transactions.get(netmsg.trans_id):
-            if transaction.data is None:
-                transaction.data = []
+            if not isinstance(transaction.data, ManifestTable):
+                transaction.data = ManifestTable()
 
             # Basic transaction handling ahoy.
             try:
                 result = _netio.errors.NetError(netmsg.result)
             except ValueError:
-                self.warning(f"Transaction {netmsg.trans_id} returned an invalid error code: {result}")
+                self.log.warning(f"Transaction {netmsg.trans_id} returned an invalid error code: {netmsg.result}")
                 exc = ValueError
             else:
                 exc = _netio.errors.error_lut.get(result)
-            if result != _netio.errors.NetError.success:
-                self._transactions.pop(netmsg.trans_id)
-                transaction.set_exception(exc)
-
-            # Unpack the binary manifest into our working... thingy...
-            s = io.BytesIO(netmsg.buffer)
-            u16: int = lambda func: struct.unpack("<H", func(2))[0]
-
-            def read_string(size=None) -> str:
-                if size is None:
-                    def _iter():
-                        while True:
-                            v = s.read(2)
-                            if v != bytes(2):
-                                yield from (i for i in v)
-                            else:
-                                break
-                    value = bytes(list(_iter()))
-                else:
-                    value = bytes(list(s.read(size * 2)))
-                    assert u16(s.read) == 0
-                return value.decode("utf-16-le", errors="replace")
-
-            def read_u32():
-                value = u16(s.read) << 16 | u16(s.read)
-                assert u16(s.read) == 0
-                return value
-
-            while True:
-                file_name = read_string()
-                if not file_name:
-                    break
-                download_name = read_string()
-                file_hash = read_string(32).lower()
-                download_hash = read_string(32).lower()
-                file_size = read_u32()
-                download_size = read_u32()
-                flags = read_u32()
-
-                entry = ManifestEntry(
-                    PureWindowsPath(file_name), PureWindowsPath(download_name),
-                    file_hash, download_hash, file_size, download_size, flags
-                )
-                transaction.data.append(entry)
-
-            # Now that we've processed the buffer, see if life is good.
-            if len(transaction.data) >= netmsg.file_count:
-                self.log.debug("All file info received from manifest, firing coroutine!")
-                transaction.future.set_result(transaction.data)
+            if exc is not None:
                 self._transactions.pop(netmsg.trans_id)
+                transaction.future.set_exception(exc)
             else:
-                self.log.debug(f"Still waiting on {netmsg.file_count - len(transaction.data)} files before manifest completes...")
+                try:
+                    _parse_manifest(netmsg.buffer, transaction.data)
+                except _netio.UruNetProtocolError as e:
+                    self._transactions.pop(netmsg.trans_id)
+                    transaction.future.set_exception(e)
+                else:
+                    # Now that we've processed the buffer, see if life is good.
+                    if len(transaction.data) >= netmsg.file_count:
+                        self.log.debug("All file info received from manifest, firing coroutine!")
+                        transaction.future.set_result(transaction.data)
+                        self._transactions.pop(netmsg.trans_id)
+                    else:
+                        self.log.debug(f"Still waiting on {netmsg.file_count - len(transaction.data)} files before manifest completes...")
         else:
             self.log.warning(f"Manifest reply {netmsg.trans_id} was not associated with a transaction?")
 
         # Be sure the ack is sent before we exit.
         await ack
 
+    async def _handle_download(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        response = _netio.NetMessage(
+            _msg.file_download_chunk_ack,
+            trans_id=netmsg.trans_id,
+            reader_id=netmsg.reader_id
+        )
+        ack = self.send_netstruct(_msg.C2F.FileDownloadChunkAck, response, _netio.Lane.control)
+
+        # The chunk has to be written out before anything is awaited. The buffer goes back to the
+        # pool when we return, and with concurrent dispatch the next chunk may already be queued.
+        if transaction := self._transactions.get(netmsg.trans_id):
+            download: _Download = transaction.data
+            try:
+                result = _netio.errors.NetError(netmsg.result)
+            except ValueError:
+                self.log.warning(f"Transaction {netmsg.trans_id} returned an invalid error code: {netmsg.result}")
+                exc = ValueError
+            else:
+                exc = _netio.errors.error_lut.get(result)
+            if exc is None:
+                try:
+                    download.write(netmsg.buffer)
+                    if download.received >= netmsg.total_size:
+                        download.finish()
+                except (OSError, _netio.UruNetProtocolError) as e:
+                    exc = e
+                else:
+                    if download.received >= netmsg.total_size:
+                        self._transactions.pop(netmsg.trans_id)
+                        transaction.future.set_result(download.received)
+            if exc is not None:
+                self._transactions.pop(netmsg.trans_id)
+                transaction.future.set_exception(exc)
+        else:
+            self.log.warning(f"Download chunk {netmsg.trans_id} was not associated with a transaction?")
+
+        await ack
+
     def _handle_pong(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
         self.log.debug(f"FILE PONG: {netmsg.ping_time}!")
+        if (future := self._pings.pop(netmsg.ping_time, None)) is not None and not future.done():
+            future.set_result(netmsg)
 
     async def _perform_handshake(self, build, product, nkey, xkey) -> None:
         self._build = build
@@ -170,25 +461,76 @@ class FileCli(_netio.NetClient):
         await self.send_netstruct(None, handshake)
 
     async def ping(self) -> None:
-        ts = int(time.monotonic())
+        # FileSrv ping requests aren't transactions, so the echoed timestamp is all we have to
+        # match up the reply. Milliseconds keep back-to-back pings from colliding.
+        ts = int(time.monotonic() * 1000.0) & 0xFFFFFFFF
+        while ts in self._pings:
+            ts = (ts + 1) & 0xFFFFFFFF
         ping = _netio.msg.NetMessage(_msg.ping_pong, ping_time=ts)
+        future = self._pings[ts] = asyncio.get_running_loop().create_future()
         self.log.debug(f"FILE PING: {ts}?")
-        # FileSrv ping requests aren't transactions, so there's no result here.
-        await self.send_netstruct(_msg.C2F.PingRequest, ping)
+        try:
+            await self.send_netstruct(_msg.C2F.PingRequest, ping, _netio.Lane.control)
+            await future
+        finally:
+            self._pings.pop(ts, None)
+
+    def connection_reset(self, msg: str = "Connection reset"):
+        for i in self._pings.values():
+            i.cancel(msg)
+        self._pings.clear()
+        return super().connection_reset(msg)
 
     async def request_build_id(self) -> int:
         req = _netio.NetMessage(_msg.build_id_request)
         self.log.debug("Requesting latest buildID")
-        build = await self.send_transaction(_msg.C2F.BuildIdRequest, req)
+        build = await self.send_transaction(_msg.C2F.BuildIdRequest, req, idempotent=True)
         self.log.debug(f"Got {build.build_id=}")
         return build.build_id
 
-    async def request_manifest(self, manifest: str) -> List[ManifestEntry]:
+    async def request_manifest(self, manifest: str) -> ManifestTable:
         req = _netio.NetMessage(
             _msg.manifest_request,
             manifest_name=manifest,
             build_id=0
         )
         self.log.debug(f"Requesting manifest '{manifest}'")
-        files = await self.send_transaction(_msg.C2F.ManifestRequest, req)
+        files = await self.send_transaction(_msg.C2F.ManifestRequest, req, idempotent=True)
         return files
+
+    async def request_manifests(self, manifests: Iterable[str]) -> ManifestTable:
+        """Requests several manifests at once and merges them into one table, with any file that
+           is in more than one of them (same path, same hash) listed only once"""
+        manifests = list(dict.fromkeys(manifests))
+        self.log.debug(f"Requesting {len(manifests)} manifests")
+        tables = await asyncio.gather(*(self.request_manifest(i) for i in manifests))
+        merged = ManifestTable()
+        for i in tables:
+            merged.update(i)
+        return merged
+
+    async def download_file(self, name: Union[str, PurePath], dest: BinaryIO, *,
+                            expected_hash: Union[str, bytes, None] = None, decompress: bool = False) -> int:
+        """Downloads a file from the FileSrv into dest. If the expected MD5 of the data as sent is
+           given, it's checked. With decompress, the gzipped download is inflated on the way to
+           dest. Returns the number of bytes received."""
+        download = _Download(dest, expected_hash, decompress)
+        req = _netio.NetMessage(
+            _msg.file_download_request,
+            file_name=str(name),
+            build_id=0
+        )
+        self.log.debug(f"Downloading '{name}'")
+        return await self.send_transaction(_msg.C2F.FileDownloadRequest, req, download, idempotent=True)
+
+    async def download_to_store(self, entry: ManifestEntry, store: ContentStore) -> Path:
+        """Makes sure the file described by a manifest entry is in the store, downloading it only
+           if nobody has before, and returns its path there"""
+        if (path := store.get(entry.file_hash)) is not None:
+            return path
+        # Compressed downloads have their own name and hash. Anything else comes down as is.
+        decompress = entry.download_hash != entry.file_hash and entry.download_name.suffix.lower() == ".gz"
+        with store.writer(entry.file_hash) as writer:
+            await self.download_file(entry.download_name, writer, expected_hash=entry.download_hash,
+                                     decompress=decompress)
+        return store.path(entry.file_hash)
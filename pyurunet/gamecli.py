@@ -0,0 +1,113 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+import uuid
+
+from . import _netio
+from ._netio import gamestructs as _msg
+
+_connection_data = (
+    (_netio.fields.integer, "data_size", 4),
+    (_netio.fields.uuid, "account_uuid", 1),
+    (_netio.fields.uuid, "age_uuid", 1),
+)
+
+
+class GameCli(_netio.NetClient):
+    """A client for the game server. Plasma messages are passed through self.propagate, which
+       hands them out undecoded so that bots can relay them at volume."""
+
+    def __init__(self, account_uuid: Optional[uuid.UUID] = None, age_uuid: Optional[uuid.UUID] = None):
+        super().__init__()
+        self.incoming_lookup = {
+            _msg.G2C.PingReply: _msg.ping_pong,
+            _msg.G2C.JoinAgeReply: _msg.join_age_reply,
+            _msg.G2C.GameMgrMsg: _msg.game_mgr_msg,
+        }
+        self.incoming_handlers = {
+            _msg.G2C.PingReply: self._handle_pong,
+            _msg.G2C.GameMgrMsg: self._handle_game_mgr_msg,
+        }
+        self.propagate = _netio.propagate.PropagateRouter(self, _msg.G2C.PropagateBuffer, _msg.C2G.PropagateBuffer)
+        self.account_uuid = account_uuid if account_uuid is not None else uuid.UUID(int=0)
+        self.age_uuid = age_uuid if age_uuid is not None else uuid.UUID(int=0)
+        self._pings: Dict[int, asyncio.Future] = {}
+        self._joined: Optional[Tuple[int, int]] = None
+
+    def _handle_pong(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        self.log.debug(f"GAME PONG: {netmsg.ping_time}!")
+        if (future := self._pings.pop(netmsg.ping_time, None)) is not None and not future.done():
+            future.set_result(netmsg)
+
+    def _handle_game_mgr_msg(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        self.log.debug(f"Ignoring a GameMgrMsg of {len(netmsg.buffer)} bytes")
+
+    async def _perform_handshake(self, build, product, nkey, xkey) -> None:
+        handshake_struct = _netio.msg.connection_header + _connection_data
+        handshake = _netio.msg.NetMessage(handshake_struct,
+                                          conn_type=_netio.NetProtocol.game,
+                                          size=31,
+                                          build_id=build,
+                                          build_type=50,
+                                          branch_id=1,
+                                          product=product,
+                                          data_size=36,
+                                          account_uuid=self.account_uuid,
+                                          age_uuid=self.age_uuid)
+        await self.send_netstruct(None, handshake)
+        await self._establish_encryption_c2s(_netio.DiffieHellmanG.game, nkey, xkey)
+
+    async def _restore_session(self) -> None:
+        if self._joined is not None:
+            await self.join_age(*self._joined)
+
+    async def join_age(self, age_mcp_id: int, player_id: int) -> None:
+        req = _netio.NetMessage(
+            _msg.join_age_request,
+            age_mcp_id=age_mcp_id,
+            account_uuid=self.account_uuid,
+            player_id=player_id
+        )
+        self.log.debug(f"Joining age instance {age_mcp_id} as player {player_id}...")
+        await self.send_transaction(_msg.C2G.JoinAgeRequest, req)
+        self.log.info(f"Joined age instance {age_mcp_id}")
+        if self._reconnect_policy is not None:
+            self._joined = (age_mcp_id, player_id)
+
+    async def ping(self) -> None:
+        # Game server pings don't have a transaction ID either, so this works like FileCli.ping.
+        ts = int(time.monotonic() * 1000.0) & 0xFFFFFFFF
+        while ts in self._pings:
+            ts = (ts + 1) & 0xFFFFFFFF
+        ping = _netio.msg.NetMessage(_msg.ping_pong, ping_time=ts)
+        future = self._pings[ts] = asyncio.get_running_loop().create_future()
+        self.log.debug(f"GAME PING: {ts}?")
+        try:
+            await self.send_netstruct(_msg.C2G.PingRequest, ping, _netio.Lane.control)
+            await future
+        finally:
+            self._pings.pop(ts, None)
+
+    def connection_reset(self, msg: str = "Connection reset"):
+        for i in self._pings.values():
+            i.cancel(msg)
+        self._pings.clear()
+        return super().connection_reset(msg)
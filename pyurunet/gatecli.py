@@ -14,11 +14,109 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import annotations
+
 import asyncio
+import time
+from typing import Any, Dict
 
 from . import _netio
-#from ._netio import gatestructs as _msg
+from ._netio import gatestructs as _msg
+
+_connection_data = (
+    (_netio.fields.integer, "data_size", 4),
+    (_netio.fields.uuid, "data_token", 1),
+)
+
+# Server addresses rarely change, so every session in the process shares these lookups. After a
+# shard restart, a whole herd of reconnecting clients costs a single GateKeeper round trip.
+address_cache = _netio.TtlCache(ttl=300.0)
+
+def _cache_key(kind: str, connect_args: Dict[str, Any], is_patcher: bool = False):
+    return (
+        kind,
+        connect_args.get("host", _netio.Product.host),
+        connect_args.get("port", _netio.Product.port),
+        is_patcher
+    )
+
 
 class GateKeeperCli(_netio.NetClient):
-    pass
+    def __init__(self):
+        super().__init__()
+        self.incoming_lookup = {
+            _msg.G2C.PingReply: _msg.ping_pong,
+            _msg.G2C.FileSrvIpAddressReply: _msg.srv_address_reply,
+            _msg.G2C.AuthSrvIpAddressReply: _msg.srv_address_reply,
+        }
+        self.incoming_handlers = {}
+
+    async def _perform_handshake(self, build, product, nkey, xkey) -> None:
+        handshake_struct = _netio.msg.connection_header + _connection_data
+        handshake = _netio.msg.NetMessage(handshake_struct,
+                                          conn_type=_netio.NetProtocol.gatekeeper,
+                                          size=31,
+                                          build_id=build,
+                                          build_type=50,
+                                          branch_id=1,
+                                          product=product,
+                                          data_size=20)
+        await self.send_netstruct(None, handshake)
+        await self._establish_encryption_c2s(_netio.DiffieHellmanG.gatekeeper, nkey, xkey)
+
+    async def ping(self) -> None:
+        ts = int(time.monotonic())
+        ping = _netio.msg.NetMessage(_msg.ping_pong, ping_time=ts, payload=b"")
+        self.log.debug(f"GATE PING: {ts}?")
+        pong = await self.send_transaction(_msg.C2G.PingRequest, ping, idempotent=True,
+                                           lane=_netio.Lane.control)
+        self.log.debug(f"GATE PONG: {pong.ping_time}!")
+
+    async def _request_file_server_address(self, is_patcher: bool) -> str:
+        req = _netio.NetMessage(_msg.file_srv_address_request, is_patcher=int(is_patcher))
+        self.log.debug("Requesting FileSrv address...")
+        reply = await self.send_transaction(_msg.C2G.FileSrvIpAddressRequest, req, idempotent=True)
+        self.log.debug(f"FileSrv is at {reply.address}")
+        return reply.address
+
+    async def _request_auth_server_address(self) -> str:
+        req = _netio.NetMessage(_msg.auth_srv_address_request)
+        self.log.debug("Requesting AuthSrv address...")
+        reply = await self.send_transaction(_msg.C2G.AuthSrvIpAddressRequest, req, idempotent=True)
+        self.log.debug(f"AuthSrv is at {reply.address}")
+        return reply.address
+
+    async def get_file_server_address(self, is_patcher: bool = False, *, cached: bool = True) -> str:
+        if not cached:
+            return await self._request_file_server_address(is_patcher)
+        key = _cache_key("file", self._connect_args, is_patcher)
+        return await address_cache.get(key, lambda: self._request_file_server_address(is_patcher))
+
+    async def get_auth_server_address(self, *, cached: bool = True) -> str:
+        if not cached:
+            return await self._request_auth_server_address()
+        key = _cache_key("auth", self._connect_args)
+        return await address_cache.get(key, self._request_auth_server_address)
+
+
+async def _lookup(kind: str, connect_args: Dict[str, Any], is_patcher: bool = False) -> str:
+    gate = GateKeeperCli()
+    await gate.start(**connect_args)
+    try:
+        if kind == "file":
+            return await gate._request_file_server_address(is_patcher)
+        return await gate._request_auth_server_address()
+    finally:
+        gate.close("Lookup complete")
+
+async def resolve_file_server(is_patcher: bool = False, **connect_args) -> str:
+    """Returns the FileSrv address advertised by the GateKeeper at connect_args (the same keyword
+       arguments as NetClient.start), only connecting to it if the answer isn't cached."""
+    key = _cache_key("file", connect_args, is_patcher)
+    return await address_cache.get(key, lambda: _lookup("file", connect_args, is_patcher))
 
+async def resolve_auth_server(**connect_args) -> str:
+    """Returns the AuthSrv address advertised by the GateKeeper at connect_args (the same keyword
+       arguments as NetClient.start), only connecting to it if the answer isn't cached."""
+    key = _cache_key("auth", connect_args)
+    return await address_cache.get(key, lambda: _lookup("auth", connect_args))
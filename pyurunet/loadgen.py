@@ -0,0 +1,204 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""End-to-end load generator for the auth and file protocols.
+
+Runs N clients against a shard (or an in-process MockShard if no host is given) and reports
+latency percentiles and message rates.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from dataclasses import asdict, dataclass
+import json
+import logging
+import sys
+import time
+from typing import Dict, List, Optional
+
+from . import _netio
+from .authcli import AuthCli
+from .filecli import FileCli
+from .mocksrv import MockConfig, MockShard
+from .vault.node import VaultNode
+
+_Product = _netio.constants.Product
+
+# op name -> (client class, callable issuing one request)
+_ops: Dict[str, tuple] = {
+    "ping": (AuthCli, lambda cli, args: cli.ping()),
+    "fetch": (AuthCli, lambda cli, args: cli.vault_fetch_node(args.node_id)),
+    "refs": (AuthCli, lambda cli, args: cli.vault_fetch_node_refs(args.node_id)),
+    "find": (AuthCli, lambda cli, args: cli.vault_find_node(bytes(8))),
+    "save": (AuthCli, lambda cli, args: cli.vault_save_node(args.node_id, VaultNode(string64_1="loadgen"))),
+    "build_id": (FileCli, lambda cli, args: cli.request_build_id()),
+    "manifest": (FileCli, lambda cli, args: cli.request_manifest(args.manifest)),
+}
+
+
+@dataclass
+class LoadReport:
+    op: str
+    clients: int
+    requests: int
+    errors: int
+    elapsed: float
+    requests_per_sec: float
+    messages_per_sec: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(samples) - 1))), len(samples) - 1)
+    return samples[index]
+
+async def _run_client(args, host: str, port: int, keys: Dict[str, int], pool: Optional[_netio.AimdLimiter],
+                      latencies: List[float], counters: Dict[str, int], deadline: float) -> None:
+    cli_cls, op = _ops[args.op]
+    cli = cli_cls()
+    if pool is not None:
+        cli.limiter = pool.child(args.pipeline)
+    await cli.start(host=host, port=port, build=args.build, **keys)
+    try:
+        if cli_cls is AuthCli and args.account is not None:
+            await cli.login(args.account, args.password)
+
+        async def worker():
+            while counters["remaining"] > 0 and time.perf_counter() < deadline:
+                counters["remaining"] -= 1
+                start = time.perf_counter()
+                try:
+                    await op(cli, args)
+                except (asyncio.CancelledError, _netio.UruNetError, ValueError) as e:
+                    counters["errors"] += 1
+                    if isinstance(e, asyncio.CancelledError) and cli.writer.is_closing():
+                        return
+                else:
+                    latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(worker() for _ in range(args.pipeline)))
+    finally:
+        counters["messages"] += cli.messages_sent + cli.messages_received
+        cli.close("Load test complete")
+
+async def run_load(args) -> LoadReport:
+    shard = None
+    if args.host is None:
+        shard = MockShard(MockConfig(
+            latency=args.latency,
+            node_size=args.node_size,
+            ref_count=args.ref_count,
+            find_count=args.find_count,
+            manifest_entries=args.manifest_entries,
+            busy_rate=args.busy_rate,
+        ))
+        await shard.start()
+        host, port = shard.host, shard.port
+        keys = shard.client_keys(_netio.NetProtocol.auth)
+        if args.account is None:
+            args.account, args.password = "loadgen", "loadgen"
+    else:
+        host, port = args.host, args.port
+        keys = dict(nkey=args.nkey, xkey=args.xkey)
+
+    if _ops[args.op][0] is FileCli:
+        keys = {}
+
+    pool = _netio.AimdLimiter(args.aimd, max_limit=args.aimd * 4) if args.aimd else None
+    latencies: List[float] = []
+    counters = dict(remaining=args.requests if args.requests else sys.maxsize, errors=0, messages=0)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    try:
+        await asyncio.gather(*(
+            _run_client(args, host, port, keys, pool, latencies, counters, deadline)
+            for _ in range(args.clients)
+        ))
+    finally:
+        elapsed = time.perf_counter() - start
+        if shard is not None:
+            shard.close()
+            await shard.wait_closed()
+
+    latencies.sort()
+    return LoadReport(
+        op=args.op,
+        clients=args.clients,
+        requests=len(latencies),
+        errors=counters["errors"],
+        elapsed=elapsed,
+        requests_per_sec=len(latencies) / elapsed,
+        messages_per_sec=counters["messages"] / elapsed,
+        p50_ms=_percentile(latencies, 50) * 1000.0,
+        p90_ms=_percentile(latencies, 90) * 1000.0,
+        p99_ms=_percentile(latencies, 99) * 1000.0,
+        max_ms=latencies[-1] * 1000.0 if latencies else 0.0
+    )
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m pyurunet.loadgen", description=__doc__.splitlines()[0])
+    parser.add_argument("op", choices=sorted(_ops), help="request to issue")
+    parser.add_argument("-c", "--clients", type=int, default=10, help="number of concurrent connections")
+    parser.add_argument("-p", "--pipeline", type=int, default=1, help="requests in flight per connection")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="maximum run time in seconds")
+    parser.add_argument("-n", "--requests", type=int, default=0, help="stop after this many requests in total")
+    parser.add_argument("--aimd", type=int, default=0, metavar="LIMIT",
+                        help="throttle in-flight requests adaptively, starting from LIMIT across all clients")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    server = parser.add_argument_group("server", "Connects to a real shard. If no host is given, an in-process mock is used.")
+    server.add_argument("--host", help="shard address")
+    server.add_argument("--port", type=int, default=_Product.port)
+    server.add_argument("--build", type=int, default=_Product.build_id)
+    server.add_argument("--nkey", type=int, default=0)
+    server.add_argument("--xkey", type=int, default=0)
+    server.add_argument("--account", help="log in as this account before issuing auth requests")
+    server.add_argument("--password", default="")
+    server.add_argument("--node-id", type=int, default=1, help="vault node to fetch")
+    server.add_argument("--manifest", default="ThinExternal", help="manifest to request")
+
+    mock = parser.add_argument_group("mock", "Shape of the synthetic data served by the mock shard.")
+    mock.add_argument("--latency", type=float, default=0.0, help="simulated server processing time in seconds")
+    mock.add_argument("--node-size", type=int, default=512)
+    mock.add_argument("--ref-count", type=int, default=100)
+    mock.add_argument("--find-count", type=int, default=100)
+    mock.add_argument("--manifest-entries", type=int, default=100)
+    mock.add_argument("--busy-rate", type=float, default=0.0, help="fraction of vault writes answered with server_busy")
+    args = parser.parse_args(argv)
+
+    # The per-message debug logging would completely swamp what we're trying to measure.
+    logging.getLogger("PyUruNet").setLevel(logging.WARNING)
+
+    report = asyncio.run(run_load(args))
+    if args.json:
+        json.dump(asdict(report), sys.stdout, indent=2)
+        print()
+    else:
+        print(f"{report.op}: {report.requests} requests ({report.errors} errors) from {report.clients} clients in {report.elapsed:.2f}s")
+        print(f"  {report.requests_per_sec:,.0f} requests/s, {report.messages_per_sec:,.0f} messages/s")
+        print(f"  latency p50 {report.p50_ms:.2f}ms, p90 {report.p90_ms:.2f}ms, p99 {report.p99_ms:.2f}ms, max {report.max_ms:.2f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,505 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A tiny in-process stand-in for the AuthSrv, FileSrv, and GateKeeperSrv that answers with synthetic data.
+   This is intended for testing and load generation ONLY - it has no idea what a vault is."""
+
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import functools
+from pathlib import PureWindowsPath
+import random
+import secrets
+from typing import Dict, List, Optional, Tuple
+import uuid
+
+from . import _netio
+from ._netio import authstructs as _auth
+from ._netio import filestructs as _file
+from ._netio import gamestructs as _game
+from ._netio import gatestructs as _gate
+from .authcli import GameRank, GameScore, VaultNodeRef, _write_node_refs, _write_ranks, _write_scores
+from .filecli import ManifestEntry, _write_manifest
+from .vault.node import NodeType, VaultNode, parse_node
+
+_Product = _netio.constants.Product
+
+
+@dataclass
+class MockConfig:
+    latency: float = 0.0
+    node_size: int = 512
+    ref_count: int = 100
+    find_count: int = 100
+    score_count: int = 10
+    # Fraction of vault writes that are turned away with server_busy
+    busy_rate: float = 0.0
+    rank_count: int = 100
+    player_count: int = 1
+    manifest_entries: int = 100
+    manifest_chunk: int = 50
+    download_chunk: int = 64 * 1024
+    build_id: int = _Product.build_id
+    server_address: Optional[str] = None
+
+
+@functools.lru_cache(maxsize=8)
+def synthetic_manifest(count: int, start: int = 0) -> bytes:
+    return _write_manifest((
+        ManifestEntry(
+            PureWindowsPath(f"dat\\Age{i:05}_District_Room.prp"),
+            PureWindowsPath(f"dat\\Age{i:05}_District_Room.prp.gz"),
+            f"{i:032x}", f"{i + 1:032x}",
+            i * 1024, i * 512, 0
+        )
+        for i in range(start, start + count)
+    ))
+
+@functools.lru_cache(maxsize=8)
+def synthetic_scores(count: int, owner_id: int, game_name: str) -> bytes:
+    return _write_scores((GameScore(i + 1, owner_id or i + 1, 0, 1, 1000 - i, game_name) for i in range(count)))
+
+@functools.lru_cache(maxsize=8)
+def synthetic_ranks(count: int, page: int = 0) -> bytes:
+    start = page * count
+    return _write_ranks((GameRank(i + 1, 100000 - i, f"Player {i + 1}") for i in range(start, start + count)))
+
+@functools.lru_cache(maxsize=4096)
+def synthetic_node(node_id: int, modify_time: int, size: int) -> bytes:
+    node = VaultNode(
+        node_id=node_id,
+        create_time=0,
+        modify_time=modify_time,
+        creator_id=node_id % 16,
+        node_type=NodeType.TextNote,
+        istring64_1=f"Note {node_id % 50}",
+        blob_1=b""
+    )
+    # Pad the blob out to make up the rest of the size.
+    node.blob_1 = bytes(max(0, size - len(node.to_bytes())))
+    return node.to_bytes()
+
+@functools.lru_cache(maxsize=8)
+def synthetic_node_refs(count: int, root_id: int = 1) -> bytes:
+    return _write_node_refs((VaultNodeRef(root_id + i // 8, root_id + i + 1, 1, False) for i in range(count)))
+
+
+class _MockConnection(_netio.NetServerConnection):
+    async def _send_later(self, delay: float, replies) -> None:
+        await asyncio.sleep(delay)
+        for msg_id, netmsg in replies:
+            await self.send_netstruct(msg_id, netmsg)
+
+    async def reply(self, *replies: Tuple[int, _netio.NetMessage]) -> None:
+        """Sends (msg_id, netmsg) replies, in order, after the configured latency without
+           blocking the dispatcher"""
+        await self.spawn(self._send_later(self.server.config.latency, replies))
+
+
+class _MockAuthConnection(_MockConnection):
+    encryption_protocol = _netio.NetProtocol.auth
+
+    def __init__(self, server: MockShard, reader, writer):
+        super().__init__(server, reader, writer)
+        self.incoming_lookup = {
+            _auth.C2A.PingRequest: _auth.ping_pong,
+            _auth.C2A.ClientRegisterRequest: _auth.client_register_req,
+            _auth.C2A.AcctLoginRequest: _auth.login_request,
+            _auth.C2A.VaultNodeFetch: _auth.vault_node_fetch_request,
+            _auth.C2A.VaultFetchNodeRefs: _auth.vault_node_refs_fetch_request,
+            _auth.C2A.VaultNodeFind: _auth.vault_node_find_request,
+            _auth.C2A.VaultNodeRemove: _auth.vault_node_remove_request,
+            _auth.C2A.VaultNodeCreate: _auth.vault_node_create_request,
+            _auth.C2A.VaultNodeSave: _auth.vault_node_save_request,
+            _auth.C2A.VaultNodeAdd: _auth.vault_node_add_request,
+            _auth.C2A.ScoreGetScores: _auth.score_get_scores_request,
+            _auth.C2A.ScoreGetRanks: _auth.score_get_ranks_request,
+            _auth.C2A.ScoreGetHighScores: _auth.score_get_high_scores_request,
+        }
+        self.incoming_handlers = {
+            _auth.C2A.PingRequest: self._handle_ping,
+            _auth.C2A.ClientRegisterRequest: self._handle_register,
+            _auth.C2A.AcctLoginRequest: self._handle_login,
+            _auth.C2A.VaultNodeFetch: self._handle_node_fetch,
+            _auth.C2A.VaultFetchNodeRefs: self._handle_node_refs,
+            _auth.C2A.VaultNodeFind: self._handle_node_find,
+            _auth.C2A.VaultNodeRemove: self._handle_node_remove,
+            _auth.C2A.VaultNodeCreate: self._handle_node_create,
+            _auth.C2A.VaultNodeSave: self._handle_node_save,
+            _auth.C2A.VaultNodeAdd: self._handle_node_add,
+            _auth.C2A.ScoreGetScores: self._handle_get_scores,
+            _auth.C2A.ScoreGetRanks: self._handle_get_ranks,
+            _auth.C2A.ScoreGetHighScores: self._handle_get_high_scores,
+        }
+
+    async def _handle_ping(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        await self.reply((_auth.A2C.PingReply, netmsg))
+
+    async def _handle_register(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        reply = _netio.NetMessage(_auth.client_register_reply, challenge=secrets.randbits(32))
+        await self.reply((_auth.A2C.ClientRegisterReply, reply))
+
+    async def _handle_login(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        replies = []
+        for i in range(self.server.config.player_count):
+            player = _netio.NetMessage(
+                _auth.player_info,
+                trans_id=netmsg.trans_id,
+                player_id=i + 1,
+                player_name=f"Player {i + 1}",
+                avatar_shape="female" if i % 2 else "male",
+                explorer=1
+            )
+            replies.append((_auth.A2C.AcctPlayerInfo, player))
+        reply = _netio.NetMessage(
+            _auth.login_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            uuid=uuid.uuid4(),
+            flags=0,
+            billing_type=1,
+            encryption_key=[0, 0, 0, 0]
+        )
+        replies.append((_auth.A2C.AcctLoginReply, reply))
+        await self.reply(*replies)
+
+    async def _handle_node_fetch(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        reply = _netio.NetMessage(
+            _auth.vault_node_fetch_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            node_data=self.server.vault_node(netmsg.node_id)
+        )
+        await self.reply((_auth.A2C.VaultNodeFetched, reply))
+
+    async def _handle_node_refs(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        reply = _netio.NetMessage(
+            _auth.vault_node_refs_fetch_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            buffer=synthetic_node_refs(self.server.config.ref_count, netmsg.node_id)
+        )
+        await self.reply((_auth.A2C.VaultNodeRefsFetched, reply))
+
+    async def _handle_node_find(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        try:
+            template = parse_node(netmsg.template_node)
+        except _netio.UruNetProtocolError:
+            reply = _netio.NetMessage(
+                _auth.vault_node_find_reply,
+                trans_id=netmsg.trans_id,
+                result=_netio.NetError.invalid_parameter,
+                node_ids=()
+            )
+            await self.reply((_auth.A2C.VaultNodeFindReply, reply))
+            return
+
+        if template.node_id is not None:
+            # Lookups of a specific node actually check the modify time, since that's how
+            # clients tell if their copy is still current.
+            current = template.modify_time in (None, self.server.vault_versions.get(template.node_id, 1))
+            node_ids = (template.node_id,) if current else ()
+        else:
+            node_ids = range(1, self.server.config.find_count + 1)
+        reply = _netio.NetMessage(
+            _auth.vault_node_find_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            node_ids=node_ids
+        )
+        await self.reply((_auth.A2C.VaultNodeFindReply, reply))
+
+    async def _handle_node_remove(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        reply = _netio.NetMessage(
+            _auth.vault_node_remove_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success
+        )
+        await self.reply((_auth.A2C.VaultRemoveNodeReply, reply))
+
+    def _write_result(self) -> _netio.NetError:
+        if self.server.config.busy_rate and random.random() < self.server.config.busy_rate:
+            return _netio.NetError.server_busy
+        return _netio.NetError.success
+
+    async def _handle_node_create(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        result = self._write_result()
+        node_id = self.server.create_node() if result == _netio.NetError.success else 0
+        reply = _netio.NetMessage(_auth.vault_node_create_reply, trans_id=netmsg.trans_id, result=result, node_id=node_id)
+        await self.reply((_auth.A2C.VaultNodeCreated, reply))
+
+    async def _handle_node_save(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        result = self._write_result()
+        if result == _netio.NetError.success:
+            self.server.saves.append((netmsg.node_id, bytes(netmsg.node_data)))
+            self.server.touch_node(netmsg.node_id)
+        reply = _netio.NetMessage(_auth.vault_node_save_reply, trans_id=netmsg.trans_id, result=result)
+        await self.reply((_auth.A2C.VaultSaveNodeReply, reply))
+
+    async def _handle_node_add(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        result = self._write_result()
+        if result == _netio.NetError.success:
+            self.server.adds.append((netmsg.parent_id, netmsg.child_id, netmsg.owner_id))
+            self.server.notify_auth(
+                _auth.A2C.VaultNodeAdded,
+                _netio.NetMessage(_auth.vault_node_added, parent_id=netmsg.parent_id,
+                                  child_id=netmsg.child_id, owner_id=netmsg.owner_id)
+            )
+        reply = _netio.NetMessage(_auth.vault_node_add_reply, trans_id=netmsg.trans_id, result=result)
+        await self.reply((_auth.A2C.VaultAddNodeReply, reply))
+
+    async def _handle_get_scores(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        count = self.server.config.score_count
+        reply = _netio.NetMessage(
+            _auth.score_get_scores_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            score_count=count,
+            buffer=synthetic_scores(count, netmsg.owner_id, netmsg.game_name)
+        )
+        await self.reply((_auth.A2C.ScoreGetScoresReply, reply))
+
+    async def _handle_get_ranks(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        count = min(netmsg.num_results, self.server.config.rank_count)
+        reply = _netio.NetMessage(
+            _auth.score_get_ranks_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            rank_count=count,
+            buffer=synthetic_ranks(count, netmsg.page_number)
+        )
+        await self.reply((_auth.A2C.ScoreGetRanksReply, reply))
+
+    async def _handle_get_high_scores(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        count = min(netmsg.max_scores, self.server.config.score_count)
+        reply = _netio.NetMessage(
+            _auth.score_get_high_scores_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            score_count=count,
+            buffer=synthetic_scores(count, 0, netmsg.game_name)
+        )
+        await self.reply((_auth.A2C.ScoreGetHighScoresReply, reply))
+
+
+class _MockFileConnection(_MockConnection):
+    _msg_header = (
+        (_netio.fields.integer, "msg_size", 4),
+        (_netio.fields.integer, "msg_id", 4),
+    )
+
+    def __init__(self, server: MockShard, reader, writer):
+        super().__init__(server, reader, writer)
+        self.incoming_lookup = {
+            _file.C2F.PingRequest: _file.ping_pong,
+            _file.C2F.BuildIdRequest: _file.build_id_request,
+            _file.C2F.ManifestRequest: _file.manifest_request,
+            _file.C2F.ManifestEntryAck: _file.manifest_ack,
+            _file.C2F.FileDownloadRequest: _file.file_download_request,
+            _file.C2F.FileDownloadChunkAck: _file.file_download_chunk_ack,
+        }
+        self.incoming_handlers = {
+            _file.C2F.PingRequest: self._handle_ping,
+            _file.C2F.BuildIdRequest: self._handle_build_id,
+            _file.C2F.ManifestRequest: self._handle_manifest,
+            _file.C2F.ManifestEntryAck: self._handle_ack,
+            _file.C2F.FileDownloadRequest: self._handle_download,
+            _file.C2F.FileDownloadChunkAck: self._handle_ack,
+        }
+
+    async def _handle_ping(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        await self.reply((_file.F2C.PingReply, netmsg))
+
+    def _handle_ack(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        pass
+
+    async def _handle_build_id(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        reply = _netio.NetMessage(
+            _file.build_id_reply,
+            trans_id=netmsg.trans_id,
+            result=_netio.NetError.success,
+            build_id=self.server.config.build_id
+        )
+        await self.reply((_file.F2C.BuildIdReply, reply))
+
+    async def _handle_manifest(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        config = self.server.config
+        replies = []
+        for i, start in enumerate(range(0, config.manifest_entries, config.manifest_chunk)):
+            count = min(config.manifest_chunk, config.manifest_entries - start)
+            reply = _netio.NetMessage(
+                _file.manifest_reply,
+                trans_id=netmsg.trans_id,
+                result=_netio.NetError.success,
+                reader_id=i,
+                file_count=config.manifest_entries,
+                buffer=synthetic_manifest(count, start)
+            )
+            replies.append((_file.F2C.ManifestReply, reply))
+        await self.reply(*replies)
+
+    async def _handle_download(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        if (data := self.server.files.get(netmsg.file_name.replace("/", "\\"))) is None:
+            reply = _netio.NetMessage(
+                _file.file_download_reply,
+                trans_id=netmsg.trans_id,
+                result=_netio.NetError.file_not_found,
+                reader_id=0,
+                total_size=0,
+                buffer=b""
+            )
+            await self.reply((_file.F2C.FileDownloadReply, reply))
+            return
+
+        self.server.downloads += 1
+        chunk = self.server.config.download_chunk
+        replies = [
+            (_file.F2C.FileDownloadReply, _netio.NetMessage(
+                _file.file_download_reply,
+                trans_id=netmsg.trans_id,
+                result=_netio.NetError.success,
+                reader_id=i,
+                total_size=len(data),
+                buffer=data[start:start + chunk]
+            ))
+            for i, start in enumerate(range(0, max(len(data), 1), chunk))
+        ]
+        await self.reply(*replies)
+
+
+class _MockGateConnection(_MockConnection):
+    encryption_protocol = _netio.NetProtocol.gatekeeper
+
+    def __init__(self, server: MockShard, reader, writer):
+        super().__init__(server, reader, writer)
+        self.incoming_lookup = {
+            _gate.C2G.PingRequest: _gate.ping_pong,
+            _gate.C2G.FileSrvIpAddressRequest: _gate.file_srv_address_request,
+            _gate.C2G.AuthSrvIpAddressRequest: _gate.auth_srv_address_request,
+        }
+        self.incoming_handlers = {
+            _gate.C2G.PingRequest: self._handle_ping,
+            _gate.C2G.FileSrvIpAddressRequest: self._handle_address,
+            _gate.C2G.AuthSrvIpAddressRequest: self._handle_address,
+        }
+
+    async def _handle_ping(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        await self.reply((_gate.G2C.PingReply, netmsg))
+
+    async def _handle_address(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        # Everything lives on this one port, so the answer is always us.
+        reply = _netio.NetMessage(
+            _gate.srv_address_reply,
+            trans_id=netmsg.trans_id,
+            address=self.server.config.server_address or self.server.host
+        )
+        reply_id = {
+            _gate.C2G.FileSrvIpAddressRequest: _gate.G2C.FileSrvIpAddressReply,
+            _gate.C2G.AuthSrvIpAddressRequest: _gate.G2C.AuthSrvIpAddressReply,
+        }[msg_id]
+        await self.reply((reply_id, reply))
+
+
+class _MockGameConnection(_MockConnection):
+    encryption_protocol = _netio.NetProtocol.game
+
+    def __init__(self, server: MockShard, reader, writer):
+        super().__init__(server, reader, writer)
+        self.incoming_lookup = {
+            _game.C2G.PingRequest: _game.ping_pong,
+            _game.C2G.JoinAgeRequest: _game.join_age_request,
+        }
+        self.incoming_handlers = {
+            _game.C2G.PingRequest: self._handle_ping,
+            _game.C2G.JoinAgeRequest: self._handle_join_age,
+        }
+
+        # We're the only one in the age, so everything we're sent comes right back at us.
+        self.propagate = _netio.propagate.PropagateRouter(self, _game.C2G.PropagateBuffer, _game.G2C.PropagateBuffer)
+        self.propagate.subscribe(None, self.propagate.queue)
+
+    async def _handle_ping(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        await self.reply((_game.G2C.PingReply, netmsg))
+
+    async def _handle_join_age(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        reply = _netio.NetMessage(_game.join_age_reply, trans_id=netmsg.trans_id, result=_netio.NetError.success)
+        await self.reply((_game.G2C.JoinAgeReply, reply))
+
+
+class MockShard(_netio.NetServer):
+    """Serves the auth, file, game, and gatekeeper protocols on a single port, like a real shard
+       would."""
+
+    protocols = {
+        _netio.NetProtocol.auth: _MockAuthConnection,
+        _netio.NetProtocol.file: _MockFileConnection,
+        _netio.NetProtocol.game: _MockGameConnection,
+        _netio.NetProtocol.gatekeeper: _MockGateConnection,
+    }
+
+    def __init__(self, config: Optional[MockConfig] = None, *, host: str = "127.0.0.1", port: int = 0, **kwargs):
+        # Throwaway Diffie-Hellman keys. The key agreement works out for any modulus, so we don't
+        # bother finding a prime. This is obviously not secure, which is fine for a mock.
+        keys, self.client_xkeys = {}, {}
+        dh_protocols = (
+            (_netio.NetProtocol.auth, _netio.DiffieHellmanG.auth),
+            (_netio.NetProtocol.game, _netio.DiffieHellmanG.game),
+            (_netio.NetProtocol.gatekeeper, _netio.DiffieHellmanG.gatekeeper),
+        )
+        for protocol, g in dh_protocols:
+            nkey = secrets.randbits(512) | (1 << 511) | 1
+            kkey = secrets.randbits(512) % nkey
+            keys[protocol] = (kkey, nkey)
+            self.client_xkeys[protocol] = pow(g, kkey, nkey)
+
+        super().__init__(host=host, port=port, keys=keys, **kwargs)
+        self.config = config if config is not None else MockConfig()
+        self.vault_versions: Dict[int, int] = {}
+        self.saves: List[Tuple[int, bytes]] = []
+        self.adds: List[Tuple[int, int, int]] = []
+        self._next_node_id = 1000000
+        # File server path -> contents. Anything else is file_not_found.
+        self.files: Dict[str, bytes] = {}
+        self.downloads = 0
+
+    def create_node(self) -> int:
+        node_id, self._next_node_id = self._next_node_id, self._next_node_id + 1
+        return node_id
+
+    def vault_node(self, node_id: int) -> bytes:
+        return synthetic_node(node_id, self.vault_versions.get(node_id, 1), self.config.node_size)
+
+    def notify_auth(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        """Sends a notification to every connected auth client"""
+        for i in self.connections:
+            if isinstance(i, _MockAuthConnection):
+                i.queue_netstruct(msg_id, netmsg)
+
+    def touch_node(self, node_id: int) -> None:
+        """Bumps a node's modify time and tells everyone about it"""
+        self.vault_versions[node_id] = self.vault_versions.get(node_id, 1) + 1
+        self.notify_auth(
+            _auth.A2C.VaultNodeChanged,
+            _netio.NetMessage(_auth.vault_node_changed, node_id=node_id, revision_id=uuid.uuid4())
+        )
+
+    def client_keys(self, protocol: int = _netio.NetProtocol.auth) -> Dict[str, int]:
+        """Returns the keyword arguments a NetClient needs to connect to us"""
+        if protocol in self.keys:
+            return dict(nkey=self.keys[protocol][1], xkey=self.client_xkeys[protocol])
+        return {}
@@ -0,0 +1,316 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import errno
+import hashlib
+import os
+from pathlib import Path, PurePath, PureWindowsPath
+import secrets
+import shutil
+import time
+from typing import *
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux's FICLONE ioctl, which makes a copy-on-write clone on btrfs, XFS and friends.
+_ficlone = 0x40049409
+
+# Leftovers from writers that died mid-download are cleaned up after this long.
+_stale_tmp_age = 24 * 60 * 60
+
+Link = Literal["reflink", "hardlink", "copy"]
+
+
+def _hash_hex(value: Union[str, bytes]) -> str:
+    if isinstance(value, str):
+        value = value.lower()
+        if len(value) != 32 or value.strip("0123456789abcdef"):
+            raise ValueError(f"{value!r} is not an MD5")
+        return value
+    if len(value) != 16:
+        raise ValueError(f"{bytes(value)!r} is not an MD5")
+    return bytes(value).hex()
+
+def _install_path(root: Path, name: Union[str, PurePath]) -> Path:
+    # Manifest names are Windows paths straight from the server, so don't trust them an inch.
+    path = PureWindowsPath(str(name))
+    if path.anchor or not path.parts or ".." in path.parts:
+        raise ValueError(f"Refusing to install {str(name)!r} outside of {str(root)!r}")
+    target = root.joinpath(*path.parts)
+    if not target.resolve().is_relative_to(root.resolve()):
+        raise ValueError(f"Refusing to install {str(name)!r} outside of {str(root)!r}")
+    return target
+
+def _md5():
+    return hashlib.md5(usedforsecurity=False)
+
+
+class _StoreWriter:
+    """Streams a file into the store. Nothing shows up under its hash until the data is complete
+       and has been checked against that hash."""
+
+    def __init__(self, store: ContentStore, file_hash: str):
+        self._store = store
+        self.file_hash = file_hash
+        self._md5 = _md5()
+        self.size = 0
+        fd, self._tmp_path = store._mkstemp()
+        self._fp = os.fdopen(fd, "wb")
+
+    def write(self, data) -> int:
+        self._md5.update(data)
+        self.size += len(data)
+        return self._fp.write(data)
+
+    def clear(self) -> None:
+        """Throws away everything written so far, eg because a download is starting over"""
+        self._fp.seek(0)
+        self._fp.truncate()
+        self._md5, self.size = _md5(), 0
+
+    def commit(self) -> Path:
+        self._fp.close()
+        if (actual := self._md5.hexdigest()) != self.file_hash:
+            self.abort()
+            raise ValueError(f"Content hashes to {actual}, not {self.file_hash}")
+        path = self._store._commit(self._tmp_path, self.file_hash, self.size)
+        self._tmp_path = None
+        return path
+
+    def abort(self) -> None:
+        self._fp.close()
+        if self._tmp_path is not None:
+            try:
+                os.unlink(self._tmp_path)
+            except FileNotFoundError:
+                pass
+            self._tmp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class ContentStore:
+    """Files stored once by MD5, no matter how many manifests, builds or installs refer to them.
+       Inserts are atomic - a file is either all there under its hash or not there at all - so
+       several processes can safely share one store. Files are put into place elsewhere as
+       reflinks where the filesystem can do it, hard links where it can't, and copies as a last
+       resort.
+
+       Stored files are made read only. Anything that modifies a hard linked file in place rather
+       than replacing it would change the stored copy too, so pass link=("reflink", "copy") when
+       materializing for something that might do that.
+
+       If max_size is set, the least recently used files are collected whenever the store grows
+       past it. Using a file (get() or materialize()) bumps its modification time, which is what
+       recency is judged by."""
+
+    def __init__(self, root: Union[str, PurePath], max_size: Optional[int] = None):
+        self.root = Path(root)
+        self.max_size = max_size
+        self._objects = self.root / "objects"
+        self._tmp = self.root / "tmp"
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._tmp.mkdir(exist_ok=True)
+        self._size: Optional[int] = None
+
+    def __repr__(self) -> str:
+        return f"<ContentStore {str(self.root)!r}>"
+
+    def path(self, file_hash: Union[str, bytes]) -> Path:
+        """Where a file with this hash lives (or would live) in the store"""
+        file_hash = _hash_hex(file_hash)
+        return self._objects / file_hash[:2] / file_hash
+
+    def __contains__(self, file_hash: Union[str, bytes]) -> bool:
+        return self.path(file_hash).exists()
+
+    def get(self, file_hash: Union[str, bytes]) -> Optional[Path]:
+        """Returns the stored file's path, or None if it isn't here"""
+        path = self.path(file_hash)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def __iter__(self) -> Iterator[str]:
+        for i in self._objects.glob("??/*"):
+            yield i.name
+
+    @property
+    def size(self) -> int:
+        """Total size of the stored files, in bytes"""
+        if self._size is None:
+            self._size = sum(i.stat().st_size for i in self._objects.glob("??/*"))
+        return self._size
+
+    # Inserting
+
+    def _mkstemp(self) -> Tuple[int, str]:
+        path = self._tmp / f"{os.getpid()}-{secrets.token_hex(8)}"
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), str(path)
+
+    def _commit(self, tmp_path: str, file_hash: str, size: int) -> Path:
+        path = self.path(file_hash)
+        path.parent.mkdir(exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        if path.exists():
+            # Someone beat us to it. Same hash, same bytes, so theirs is as good as ours.
+            os.unlink(tmp_path)
+            os.utime(path)
+            return path
+        os.replace(tmp_path, path)
+        if self._size is not None:
+            self._size += size
+        if self.max_size is not None and self.size > self.max_size:
+            self.collect_garbage(keep=(file_hash,))
+        return path
+
+    def writer(self, file_hash: Union[str, bytes]) -> _StoreWriter:
+        """Returns a file-like object to stream the content into. Use it as a context manager, or
+           call commit() (or abort()) on it when done."""
+        return _StoreWriter(self, _hash_hex(file_hash))
+
+    def insert(self, file_hash: Union[str, bytes], source: Union[bytes, str, PurePath, BinaryIO]) -> Path:
+        """Adds content from bytes, a file path or a binary file object and returns its path"""
+        if (path := self.get(file_hash)) is not None:
+            return path
+        with self.writer(file_hash) as writer:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                writer.write(source)
+            elif isinstance(source, (str, PurePath)):
+                with open(source, "rb") as fp:
+                    shutil.copyfileobj(fp, writer)
+            else:
+                shutil.copyfileobj(source, writer)
+        return self.path(file_hash)
+
+    # Materializing
+
+    def materialize(self, file_hash: Union[str, bytes], target: Union[str, PurePath], *,
+                    link: Sequence[Link] = ("reflink", "hardlink", "copy")) -> Link:
+        """Puts the stored file at target, replacing whatever is there, using the first method in
+           link that works. Returns the method that was used."""
+        if (source := self.get(file_hash)) is None:
+            raise KeyError(_hash_hex(file_hash))
+        target = Path(target)
+        try:
+            if os.path.samefile(source, target):
+                return "hardlink"
+        except FileNotFoundError:
+            pass
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f".{target.name}.{secrets.token_hex(4)}.tmp")
+        try:
+            for method in link:
+                if self._place(method, source, tmp):
+                    os.replace(tmp, target)
+                    return method
+            raise OSError(errno.EXDEV, f"Couldn't materialize {source.name} with any of {', '.join(link)}")
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def _place(self, method: Link, source: Path, tmp: Path) -> bool:
+        try:
+            if method == "hardlink":
+                os.link(source, tmp)
+            elif method == "copy":
+                shutil.copyfile(source, tmp)
+            elif method == "reflink":
+                if fcntl is None:
+                    return False
+                with open(source, "rb") as src, open(tmp, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), _ficlone, src.fileno())
+            else:
+                raise ValueError(f"Unknown link method {method!r}")
+        except OSError:
+            # Wrong filesystem, different device, no permission... try the next one.
+            if tmp.exists():
+                tmp.unlink()
+            return False
+        return True
+
+    def populate(self, root: Union[str, PurePath], entries: Iterable[Any], **kwargs) -> List[Any]:
+        """Materializes every manifest entry (anything with file_name and file_hash) under root.
+           Returns the entries that aren't in the store yet. Raises ValueError, before touching
+           anything, if any entry's name would land outside of root."""
+        root = Path(root)
+        targets = [(i, _install_path(root, i.file_name)) for i in entries]
+        missing = []
+        for i, target in targets:
+            if i.file_hash not in self:
+                missing.append(i)
+            else:
+                self.materialize(i.file_hash, target, **kwargs)
+        return missing
+
+    # Collecting garbage
+
+    def collect_garbage(self, max_size: Optional[int] = None, *, keep: Iterable[str] = ()) -> Tuple[int, int]:
+        """Deletes the least recently used files until the store is no bigger than max_size (or
+           the store's own max_size). Files still hard linked into an install are left alone, since
+           deleting them wouldn't free anything. Returns the number of files and bytes removed."""
+        if max_size is None:
+            max_size = self.max_size
+        keep = set(keep)
+        now = time.time()
+        for i in self._tmp.iterdir():
+            try:
+                if now - i.stat().st_mtime > _stale_tmp_age:
+                    i.unlink()
+            except FileNotFoundError:
+                pass
+
+        files, total = [], 0
+        for i in self._objects.glob("??/*"):
+            try:
+                st = i.stat()
+            except FileNotFoundError:
+                continue
+            total += st.st_size
+            if st.st_nlink == 1 and i.name not in keep:
+                files.append((st.st_mtime, st.st_size, i))
+
+        removed = freed = 0
+        if max_size is not None and total > max_size:
+            files.sort()
+            for _, size, path in files:
+                if total <= max_size:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                total -= size
+                freed += size
+                removed += 1
+        self._size = total
+        return removed, freed
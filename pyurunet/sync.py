@@ -0,0 +1,215 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+"""Blocking wrappers around the asyncio clients for scripts and threaded tools.
+
+Every SyncClient runs its coroutines on one long-lived event loop thread, so connections (and
+their handshakes) are made once and reused, and calls from many threads are pipelined over the
+same connection.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from typing import *
+
+from . import _netio
+from .authcli import AuthCli
+from .filecli import FileCli
+from .gamecli import GameCli
+from .gatecli import GateKeeperCli
+
+T = TypeVar("T")
+
+
+class EventLoopThread:
+    """An event loop running forever on a daemon thread"""
+
+    def __init__(self, name: str = "PyUruNet"):
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def __repr__(self) -> str:
+        return f"<EventLoopThread {self._thread.name!r} {'running' if self.is_running else 'stopped'}>"
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._ready.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread.is_alive() and not self.loop.is_closed()
+
+    def submit(self, coro: Awaitable[T]) -> concurrent.futures.Future:
+        """Schedules coro on the loop and returns a future that any thread can wait on"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+        """Runs coro on the loop and blocks until it's done"""
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Can't block the event loop thread on itself - await it instead")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        if self.is_running:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
+
+
+_default_loop: Optional[EventLoopThread] = None
+_default_loop_lock = threading.Lock()
+
+def default_loop() -> EventLoopThread:
+    """The loop thread shared by every SyncClient that isn't given its own"""
+    global _default_loop
+    with _default_loop_lock:
+        if _default_loop is None or not _default_loop.is_running:
+            _default_loop = EventLoopThread()
+        return _default_loop
+
+
+class SyncClient:
+    """Wraps a NetClient so that its coroutine methods can be called from any thread and simply
+       block until they're done. Anything that isn't a coroutine method has to be reached through
+       run() or the client attribute, and the latter only from the loop thread."""
+
+    client_type: Type[_netio.NetClient] = _netio.NetClient
+
+    def __init__(self, client: Optional[_netio.NetClient] = None, *,
+                 loop: Optional[EventLoopThread] = None, timeout: Optional[float] = None):
+        self.client = client if client is not None else self.client_type()
+        self.loop = loop if loop is not None else default_loop()
+        self.timeout = timeout
+        self._keep_alive: Optional[asyncio.Task] = None
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.client!r}>"
+
+    def __getattr__(self, name: str):
+        if name == "client":
+            raise AttributeError(name)
+        attr = getattr(self.client, name)
+        if not asyncio.iscoroutinefunction(attr):
+            raise AttributeError(f"{type(self.client).__name__}.{name} isn't a coroutine method; use run() or .client")
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return self.loop.run(attr(*args, **kwargs), self.timeout)
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, func: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """Calls func(client, *args, **kwargs) on the loop thread and waits for it"""
+        return self.loop.run(func(self.client, *args, **kwargs), self.timeout)
+
+    def submit(self, name: str, *args, **kwargs) -> concurrent.futures.Future:
+        """Starts the named method without waiting for it, so a thread can have several requests
+           in flight at once"""
+        return self.loop.submit(getattr(self.client, name)(*args, **kwargs))
+
+    def start(self, *, reconnect: Optional[_netio.ReconnectPolicy] = _netio.ReconnectPolicy(), **kwargs) -> None:
+        """Connects to the server. The connection is kept alive for the life of this object, and
+           reestablished if it drops unless reconnect is None."""
+        self.loop.run(self._start(reconnect=reconnect, **kwargs), self.timeout)
+
+    async def _start(self, **kwargs) -> None:
+        await self.client.start(**kwargs)
+        if self._keep_alive is not None:
+            self._keep_alive.cancel()
+        self._keep_alive = asyncio.create_task(self.client.keep_alive())
+
+    def close(self, msg: str = "Connection closed") -> None:
+        if self.loop.is_running:
+            self.loop.run(self._close(msg))
+
+    async def _close(self, msg: str) -> None:
+        if self._keep_alive is not None:
+            self._keep_alive.cancel()
+            self._keep_alive = None
+        self.client.close(msg)
+
+    def starmap(self, name: str, calls: Iterable[Sequence[Any]], *, limit: Optional[int] = 64,
+                return_exceptions: bool = False) -> List[Any]:
+        """Calls the named method once for each tuple of arguments, with up to limit requests in
+           flight at a time, and returns the results in order. With return_exceptions, failures
+           are returned in place of their results instead of raising the first of them."""
+        method = getattr(self.client, name)
+
+        async def run_all():
+            semaphore = asyncio.Semaphore(limit) if limit else None
+
+            async def one(args):
+                if semaphore is None:
+                    return await method(*args)
+                async with semaphore:
+                    return await method(*args)
+            return await asyncio.gather(*(one(args) for args in calls), return_exceptions=return_exceptions)
+        return self.loop.run(run_all(), self.timeout)
+
+    def map(self, name: str, args: Iterable[Any], **kwargs) -> List[Any]:
+        """Like starmap(), for methods that take a single argument"""
+        return self.starmap(name, ((i,) for i in args), **kwargs)
+
+
+class SyncAuthCli(SyncClient):
+    client_type = AuthCli
+
+    def fetch_nodes(self, node_ids: Iterable[int], **kwargs) -> Dict[int, bytes]:
+        node_ids = list(node_ids)
+        return dict(zip(node_ids, self.map("vault_fetch_node", node_ids, **kwargs)))
+
+    def fetch_node_refs(self, node_ids: Iterable[int], **kwargs) -> Dict[int, Sequence[Any]]:
+        node_ids = list(node_ids)
+        return dict(zip(node_ids, self.map("vault_fetch_node_refs", node_ids, **kwargs)))
+
+
+class SyncFileCli(SyncClient):
+    client_type = FileCli
+
+
+class SyncGameCli(SyncClient):
+    client_type = GameCli
+
+
+class SyncGateKeeperCli(SyncClient):
+    client_type = GateKeeperCli
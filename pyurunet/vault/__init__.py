@@ -0,0 +1,44 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+import importlib
+
+# name -> submodule it lives in. The mirror drags in sqlite3, so nothing is imported until it's used.
+_lazy = {
+    "NodeType": "node",
+    "VaultNode": "node",
+    "parse_node": "node",
+    "write_node": "node",
+    "VaultGraph": "graph",
+    "VaultIndex": "index",
+    "SyncStats": "mirror",
+    "VaultMirror": "mirror",
+    "SharedNodeCache": "shared",
+    "VaultWriteBuffer": "writer",
+}
+
+__all__ = list(_lazy)
+
+def __getattr__(name: str):
+    if (module := _lazy.get(name)) is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
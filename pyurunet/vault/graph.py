@@ -0,0 +1,210 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate
+from typing import *
+
+from .._netio.errors import UruNetCircularReferenceError
+
+Edge = Tuple[int, int]
+
+
+def _zeros(count: int) -> array:
+    return array("I", bytes(4 * count))
+
+
+class _Csr(NamedTuple):
+    offsets: array
+    edges: array
+
+def _build_csr(ids: array, index: Dict[int, int], keys: array, values: array) -> _Csr:
+    counts = _zeros(len(ids) + 1)
+    for key in keys:
+        counts[index[key] + 1] += 1
+    offsets = array("I", accumulate(counts))
+
+    cursor, edges = offsets[:-1], _zeros(len(keys))
+    for key, value in zip(keys, values):
+        i = index[key]
+        edges[cursor[i]] = value
+        cursor[i] += 1
+    return _Csr(offsets, edges)
+
+
+class VaultGraph:
+    """The vault's ref graph in compressed sparse row form, both ways round, so that walking down
+       to children or up to parents is a slice of an array. Node IDs are kept in a sorted array
+       rather than a dict, which keeps a city sized graph to a few MB. Edges added or removed
+       after the graph was built live in a small overlay that gets folded back into the arrays
+       once it grows."""
+
+    def __init__(self, refs: Iterable[Union[Edge, Any]] = ()):
+        parents, children = array("I"), array("I")
+        for ref in refs:
+            parent_id, child_id = ref[0], ref[1]
+            parents.append(parent_id)
+            children.append(child_id)
+        self._build(parents, children)
+
+    @classmethod
+    def from_mirror(cls, mirror) -> VaultGraph:
+        return cls(mirror.db.execute("SELECT parent_id, child_id FROM refs"))
+
+    def _build(self, parents: array, children: array) -> None:
+        self._ids = array("I", sorted(set(parents).union(children)))
+        index = { node_id: i for i, node_id in enumerate(self._ids) }
+        self._down = _build_csr(self._ids, index, parents, children)
+        self._up = _build_csr(self._ids, index, children, parents)
+        self._added_down: Dict[int, Set[int]] = {}
+        self._added_up: Dict[int, Set[int]] = {}
+        self._removed: Set[Edge] = set()
+        self._overlay_size = 0
+
+    def _index(self, node_id: int) -> Optional[int]:
+        ids = self._ids
+        i = bisect_left(ids, node_id)
+        return i if i < len(ids) and ids[i] == node_id else None
+
+    def _neighbors(self, node_id: int, up: bool) -> Iterator[int]:
+        csr = self._up if up else self._down
+        if (i := self._index(node_id)) is not None:
+            edges = csr.edges[csr.offsets[i]:csr.offsets[i + 1]]
+            if removed := self._removed:
+                if up:
+                    edges = (j for j in edges if (j, node_id) not in removed)
+                else:
+                    edges = (j for j in edges if (node_id, j) not in removed)
+            yield from edges
+        if added := (self._added_up if up else self._added_down).get(node_id):
+            yield from added
+
+    def children(self, node_id: int) -> List[int]:
+        return list(self._neighbors(node_id, False))
+
+    def parents(self, node_id: int) -> List[int]:
+        return list(self._neighbors(node_id, True))
+
+    def walk(self, node_id: int, *, up: bool = False, depth_first: bool = False) -> Iterator[int]:
+        """Yields every node reachable from node_id (not including itself), each only once"""
+        seen = { node_id }
+        pending = deque((node_id,))
+        pop = pending.pop if depth_first else pending.popleft
+        neighbors = self._neighbors
+        while pending:
+            for i in neighbors(pop(), up):
+                if i not in seen:
+                    seen.add(i)
+                    pending.append(i)
+                    yield i
+
+    def descendants(self, node_id: int) -> Iterator[int]:
+        return self.walk(node_id)
+
+    def ancestors(self, node_id: int) -> Iterator[int]:
+        return self.walk(node_id, up=True)
+
+    def is_ancestor(self, ancestor_id: int, node_id: int) -> bool:
+        # Walking up is almost always cheaper - nodes have far fewer parents than children.
+        return any(i == ancestor_id for i in self.ancestors(node_id))
+
+    def would_cycle(self, parent_id: int, child_id: int) -> bool:
+        """Checks if adding parent_id -> child_id would create a cycle"""
+        return parent_id == child_id or self.is_ancestor(child_id, parent_id)
+
+    def has_edge(self, parent_id: int, child_id: int) -> bool:
+        if child_id in self._added_down.get(parent_id, ()):
+            return True
+        if (i := self._index(parent_id)) is None or (parent_id, child_id) in self._removed:
+            return False
+        csr = self._down
+        return child_id in csr.edges[csr.offsets[i]:csr.offsets[i + 1]]
+
+    def add_edge(self, parent_id: int, child_id: int, *, check: bool = True) -> None:
+        """Adds a ref. With check, refs that would create a cycle are refused with the same error
+           the server would give."""
+        if self.has_edge(parent_id, child_id):
+            return
+        if check and self.would_cycle(parent_id, child_id):
+            raise UruNetCircularReferenceError(f"{parent_id} -> {child_id} would create a cycle")
+        if (parent_id, child_id) in self._removed:
+            self._removed.discard((parent_id, child_id))
+        else:
+            self._added_down.setdefault(parent_id, set()).add(child_id)
+            self._added_up.setdefault(child_id, set()).add(parent_id)
+        self._overlay_changed()
+
+    def remove_edge(self, parent_id: int, child_id: int) -> None:
+        if (added := self._added_down.get(parent_id)) is not None and child_id in added:
+            added.discard(child_id)
+            if not added:
+                del self._added_down[parent_id]
+            added = self._added_up[child_id]
+            added.discard(parent_id)
+            if not added:
+                del self._added_up[child_id]
+        elif self.has_edge(parent_id, child_id):
+            self._removed.add((parent_id, child_id))
+        else:
+            return
+        self._overlay_changed()
+
+    def _overlay_changed(self) -> None:
+        self._overlay_size += 1
+        if self._overlay_size > max(4096, len(self._down.edges) // 4):
+            self.compact()
+
+    def compact(self) -> None:
+        """Folds the overlay back into the arrays"""
+        parents, children = array("I"), array("I")
+        for parent_id, child_id in self.edges():
+            parents.append(parent_id)
+            children.append(child_id)
+        self._build(parents, children)
+
+    def edges(self) -> Iterator[Edge]:
+        ids, csr, removed = self._ids, self._down, self._removed
+        for i, parent_id in enumerate(ids):
+            for child_id in csr.edges[csr.offsets[i]:csr.offsets[i + 1]]:
+                if (parent_id, child_id) not in removed:
+                    yield parent_id, child_id
+        for parent_id, added in self._added_down.items():
+            for child_id in added:
+                yield parent_id, child_id
+
+    def __contains__(self, node_id: int) -> bool:
+        if self._index(node_id) is not None:
+            return True
+        return node_id in self._added_down or node_id in self._added_up
+
+    def __len__(self) -> int:
+        extra = (self._added_down.keys() | self._added_up.keys())
+        return len(self._ids) + sum(1 for i in extra if self._index(i) is None)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self._down.edges) - len(self._removed) + sum(len(i) for i in self._added_down.values())
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the arrays, not counting the overlay"""
+        arrays = (self._ids, *self._down, *self._up)
+        return sum(len(i) * i.itemsize for i in arrays)
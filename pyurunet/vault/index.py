@@ -0,0 +1,108 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from typing import *
+
+from .. import _netio
+from .mirror import VaultMirror, index_key, indexed_fields
+from .node import VaultNode, parse_node
+
+_indexed = frozenset(indexed_fields)
+
+
+class VaultIndex:
+    """Answers vault finds without asking the server when the mirror knows the answer. That's
+       only the case if the mirror holds every node the find could possibly match, which is up to
+       you to promise with authoritative - either True for everything, or a collection of node
+       types that are mirrored in full. Even then, the mirror has to be connected and caught up.
+       Anything else goes to the server, and the result is cached until a vault notification
+       suggests it may have changed."""
+
+    def __init__(self, mirror: VaultMirror, *, authoritative: Union[bool, Collection[int]] = False,
+                 ttl: float = 60.0, maxsize: int = 1024):
+        self.mirror = mirror
+        self.authoritative = authoritative
+        self.results = _netio.TtlCache(ttl=ttl, maxsize=maxsize)
+        self.local_finds = 0
+        self.cached_finds = 0
+        self.server_finds = 0
+        self._generation = 0
+        self._remove_observer = mirror.add_observer(self._invalidate)
+
+    def close(self) -> None:
+        self._remove_observer()
+        self.results.invalidate()
+
+    def _invalidate(self) -> None:
+        self._generation += 1
+        self.results.invalidate()
+
+    def is_authoritative(self, template: VaultNode) -> bool:
+        if not self.authoritative or not self.mirror.current:
+            return False
+        if self.authoritative is True:
+            return True
+        return template.node_type is not None and template.node_type in self.authoritative
+
+    def find_local(self, template: VaultNode) -> List[int]:
+        """Finds matching nodes in the mirror, whether or not it's authoritative"""
+        mirror = self.mirror
+        if template.node_id is not None:
+            candidates = [template.node_id] if template.node_id in mirror else []
+            keys = ()
+        else:
+            keys = [(i, index_key(i, value)) for i in indexed_fields if (value := getattr(template, i)) is not None]
+            if keys:
+                query = " INTERSECT ".join(("SELECT node_id FROM node_keys WHERE field = ? AND value = ?",) * len(keys))
+                candidates = [i for i, in mirror.db.execute(query, [j for key in keys for j in key])]
+            else:
+                candidates = [i for i, in mirror.db.execute("SELECT node_id FROM nodes")]
+
+        # If the index covered every field in the template, there's nothing left to check.
+        if keys and all(name in _indexed for name, _ in template.items()):
+            return sorted(candidates)
+        return sorted(i for i in candidates if (node := mirror.node(i)) is not None and node.matches(template))
+
+    async def find(self, template: Union[VaultNode, bytes]) -> Sequence[int]:
+        """Returns the IDs of the nodes matching template, like AuthCli.vault_find_node"""
+        if isinstance(template, VaultNode):
+            data = template.to_bytes()
+        else:
+            data = bytes(template)
+            template = parse_node(data)
+
+        if self.is_authoritative(template):
+            self.local_finds += 1
+            return self.find_local(template)
+
+        if data in self.results:
+            self.cached_finds += 1
+        generation = self._generation
+        node_ids = await self.results.get(data, lambda: self._find_remote(data))
+
+        # Something changed while the find was in flight, so the answer may already be stale.
+        if generation != self._generation:
+            self.results.invalidate(data)
+        return node_ids
+
+    async def _find_remote(self, data: bytes) -> Tuple[int, ...]:
+        if (client := self.mirror.client) is None:
+            raise RuntimeError("VaultIndex needs a mirror that's attached to a client")
+        self.server_finds += 1
+        return tuple(await client.vault_find_node(data))
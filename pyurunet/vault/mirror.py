@@ -0,0 +1,437 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import time
+from typing import *
+from uuid import UUID
+
+from .. import _netio
+from .._netio import authstructs as _auth
+from ..authcli import VaultNodeRef
+from .node import VaultNode, parse_node
+
+_schema_version = 2
+
+_schema = """
+CREATE TABLE IF NOT EXISTS nodes (
+    node_id INTEGER PRIMARY KEY,
+    node_type INTEGER,
+    modify_time INTEGER,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_by_type ON nodes (node_type);
+CREATE TABLE IF NOT EXISTS refs (
+    parent_id INTEGER NOT NULL,
+    child_id INTEGER NOT NULL,
+    saver_id INTEGER NOT NULL,
+    seen INTEGER,
+    PRIMARY KEY (parent_id, child_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS refs_by_child ON refs (child_id);
+CREATE TABLE IF NOT EXISTS node_keys (
+    field TEXT NOT NULL,
+    value NOT NULL,
+    node_id INTEGER NOT NULL,
+    PRIMARY KEY (field, value, node_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS node_keys_by_node ON node_keys (node_id);
+CREATE TABLE IF NOT EXISTS roots (
+    node_id INTEGER PRIMARY KEY,
+    synced_at REAL
+);
+"""
+
+_reachable_from = """
+WITH RECURSIVE reachable(node_id) AS (
+    SELECT ?
+    UNION
+    SELECT refs.child_id FROM refs JOIN reachable ON refs.parent_id = reachable.node_id
+)
+SELECT node_id FROM reachable
+"""
+
+_collect_garbage = """
+BEGIN;
+DELETE FROM _reachable;
+INSERT INTO _reachable
+    WITH RECURSIVE reachable(node_id) AS (
+        SELECT node_id FROM roots
+        UNION
+        SELECT refs.child_id FROM refs JOIN reachable ON refs.parent_id = reachable.node_id
+    )
+    SELECT node_id FROM reachable;
+DELETE FROM refs WHERE parent_id NOT IN _reachable;
+DELETE FROM nodes WHERE node_id NOT IN _reachable;
+DELETE FROM node_keys WHERE node_id NOT IN _reachable;
+COMMIT;
+"""
+
+# Fields that get an entry in node_keys so that finds can be answered locally. The istrings are
+# stored casefolded, since that's how the server compares them.
+indexed_fields = (
+    "create_age_name", "create_age_uuid", "creator_acct", "creator_id", "node_type",
+    "uint32_1", "uuid_1",
+    "string64_1", "string64_2", "string64_3", "string64_4", "string64_5", "string64_6",
+    "istring64_1", "istring64_2",
+)
+
+def index_key(field: str, value: Any) -> Any:
+    if isinstance(value, UUID):
+        return value.bytes_le
+    if field.startswith("istring"):
+        return value.casefold()
+    return value
+
+# SQLite only allows so many parameters in one statement.
+_chunk_size = 500
+
+
+class SyncStats(NamedTuple):
+    refs: int
+    fetched: int
+    verified: int
+    removed: int
+
+
+class VaultMirror:
+    """A local copy of one or more vault trees, stored in SQLite. The first sync of a tree fetches
+       every node in it. After that, the mirror follows the server's vault notifications while
+       connected, and later syncs (including the one done automatically after a reconnect) only
+       fetch the nodes that were added or changed in the meantime."""
+
+    # How many requests a sync keeps in flight at once.
+    max_inflight: int = 32
+
+    def __init__(self, path: Union[str, os.PathLike] = ":memory:", client=None):
+        self.db = sqlite3.connect(os.fspath(path))
+        self._init_db()
+        self.client = None
+        self._remove_listeners: List[Callable[[], None]] = []
+        self._dirty: Set[int] = set()
+        self._new_trees: Set[int] = set()
+        self._refresher: Optional[asyncio.Task] = None
+        self._resync_task: Optional[asyncio.Task] = None
+        self._synced = False
+        self._observers: List[Callable[[], None]] = []
+        if client is not None:
+            self.attach(client)
+
+    def _init_db(self) -> None:
+        db = self.db
+        if db.execute("PRAGMA user_version").fetchone()[0] != _schema_version:
+            # It's only a cache, so an old layout just gets thrown away.
+            with db:
+                for table in ("nodes", "refs", "node_keys", "roots"):
+                    db.execute(f"DROP TABLE IF EXISTS {table}")
+            db.execute(f"PRAGMA user_version = {_schema_version}")
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.executescript(_schema)
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS _reachable (node_id INTEGER PRIMARY KEY)")
+
+    def attach(self, client) -> None:
+        """Starts following vault notifications and reconnects from client"""
+        self.detach()
+        self.client = client
+        self._remove_listeners = [
+            client.add_listener(_auth.A2C.VaultNodeChanged, self._on_node_changed),
+            client.add_listener(_auth.A2C.VaultNodeAdded, self._on_node_added),
+            client.add_listener(_auth.A2C.VaultNodeRemoved, self._on_node_removed),
+            client.add_listener(_auth.A2C.VaultNodeDeleted, self._on_node_deleted),
+            client.add_reconnect_listener(self._on_reconnected),
+        ]
+
+    def detach(self) -> None:
+        for i in self._remove_listeners:
+            i()
+        self._remove_listeners.clear()
+        for task in (self._refresher, self._resync_task):
+            if task is not None:
+                task.cancel()
+        self._refresher, self._resync_task = None, None
+        self._synced = False
+        self.client = None
+
+    def close(self) -> None:
+        self.detach()
+        self.db.close()
+
+    def add_observer(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Calls callback() whenever the server tells us something in the vault has changed. Returns
+           a function that removes the observer again."""
+        self._observers.append(callback)
+
+        def remove():
+            if callback in self._observers:
+                self._observers.remove(callback)
+        return remove
+
+    def _changed(self) -> None:
+        for callback in tuple(self._observers):
+            try:
+                callback()
+            except Exception as e:
+                if self.client is not None:
+                    self.client.log.exception(e)
+
+    @property
+    def current(self) -> bool:
+        """True if the mirror has caught up with the server and is following its notifications"""
+        client = self.client
+        if client is None or not self._synced or self._dirty or self._new_trees:
+            return False
+        if any(i is not None and not i.done() for i in (self._refresher, self._resync_task)):
+            return False
+        return client.writer is not None and not client.writer.is_closing()
+
+    def __contains__(self, node_id: int) -> bool:
+        return self.db.execute("SELECT 1 FROM nodes WHERE node_id = ?", (node_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    @property
+    def roots(self) -> List[int]:
+        return [i for i, in self.db.execute("SELECT node_id FROM roots")]
+
+    def node_data(self, node_id: int) -> Optional[bytes]:
+        """Returns the node exactly as the server sent it"""
+        row = self.db.execute("SELECT data FROM nodes WHERE node_id = ?", (node_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def node(self, node_id: int) -> Optional[VaultNode]:
+        data = self.node_data(node_id)
+        return parse_node(data) if data is not None else None
+
+    def nodes_of_type(self, node_type: int) -> List[int]:
+        return [i for i, in self.db.execute("SELECT node_id FROM nodes WHERE node_type = ?", (node_type,))]
+
+    def children(self, parent_id: int) -> List[VaultNodeRef]:
+        query = "SELECT parent_id, child_id, saver_id, seen FROM refs WHERE parent_id = ?"
+        return [self._make_ref(*i) for i in self.db.execute(query, (parent_id,))]
+
+    def parents(self, child_id: int) -> List[VaultNodeRef]:
+        query = "SELECT parent_id, child_id, saver_id, seen FROM refs WHERE child_id = ?"
+        return [self._make_ref(*i) for i in self.db.execute(query, (child_id,))]
+
+    @staticmethod
+    def _make_ref(parent_id: int, child_id: int, saver_id: int, seen: Optional[int]) -> VaultNodeRef:
+        return VaultNodeRef(parent_id, child_id, saver_id, None if seen is None else bool(seen))
+
+    def _modify_times(self, node_ids: Collection[int]) -> Dict[int, Optional[int]]:
+        node_ids, result = list(node_ids), {}
+        for i in range(0, len(node_ids), _chunk_size):
+            chunk = node_ids[i:i + _chunk_size]
+            query = f"SELECT node_id, modify_time FROM nodes WHERE node_id IN ({','.join('?' * len(chunk))})"
+            result.update(self.db.execute(query, chunk))
+        return result
+
+    def _store_refs(self, refs: Iterable[VaultNodeRef]) -> None:
+        self.db.executemany(
+            "INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?)",
+            ((i.parent_id, i.child_id, i.saver_id, i.seen) for i in refs)
+        )
+
+    def _store_nodes(self, nodes: Iterable[Tuple[int, Optional[bytes]]]) -> None:
+        with self.db:
+            for node_id, data in nodes:
+                if data is None:
+                    self._delete_node(node_id)
+                    continue
+                node = parse_node(data)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)",
+                    (node_id, node.node_type, node.modify_time, data)
+                )
+                self.db.execute("DELETE FROM node_keys WHERE node_id = ?", (node_id,))
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO node_keys VALUES (?, ?, ?)",
+                    ((i, index_key(i, value), node_id) for i in indexed_fields
+                     if (value := getattr(node, i)) is not None)
+                )
+
+    def _delete_node(self, node_id: int) -> None:
+        self.db.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+        self.db.execute("DELETE FROM refs WHERE parent_id = ? OR child_id = ?", (node_id, node_id))
+        self.db.execute("DELETE FROM node_keys WHERE node_id = ?", (node_id,))
+
+    def collect_garbage(self) -> int:
+        """Drops every node that can no longer be reached from one of the roots"""
+        before = len(self)
+        self.db.executescript(_collect_garbage)
+        return before - len(self)
+
+    def _require_client(self):
+        if self.client is None:
+            raise RuntimeError("VaultMirror is not attached to a client")
+        return self.client
+
+    async def _fetch_nodes(self, node_ids: Iterable[int], *, cached: bool = False) -> int:
+        client = self._require_client()
+        limit = asyncio.Semaphore(self.max_inflight)
+
+        async def fetch(node_id: int) -> Tuple[int, Optional[bytes]]:
+            async with limit:
+                try:
+                    return node_id, bytes(await client.vault_fetch_node(node_id, cached=cached))
+                except _netio.UruNetVaultNodeNotFoundError:
+                    return node_id, None
+
+        # Stored in batches so a huge first sync doesn't hold the whole vault in memory.
+        node_ids, fetched = list(node_ids), 0
+        for i in range(0, len(node_ids), _chunk_size):
+            results = await asyncio.gather(*(fetch(j) for j in node_ids[i:i + _chunk_size]))
+            self._store_nodes(results)
+            fetched += len(results)
+        return fetched
+
+    async def _stale_nodes(self, modify_times: Dict[int, Optional[int]]) -> List[int]:
+        """Asks the server which of the nodes have changed, without downloading them. A find with
+           the node's ID and our modify time only comes back empty if the node is different."""
+        client = self._require_client()
+        limit = asyncio.Semaphore(self.max_inflight)
+
+        async def check(node_id: int, modify_time: Optional[int]) -> bool:
+            if modify_time is None:
+                return False
+            template = VaultNode(node_id=node_id, modify_time=modify_time).to_bytes()
+            async with limit:
+                return node_id in await client.vault_find_node(template)
+
+        node_ids = list(modify_times)
+        current = await asyncio.gather(*(check(i, modify_times[i]) for i in node_ids))
+        return [i for i, ok in zip(node_ids, current) if not ok]
+
+    async def sync(self, root_id: int, *, verify: bool = True) -> SyncStats:
+        """Brings the tree under root_id up to date. Nodes we have never seen are fetched. With
+           verify, every node we already have is checked against the server and refetched only
+           if it has changed."""
+        client = self._require_client()
+        refs = await client.vault_fetch_node_refs(root_id)
+        client.log.debug(f"VaultMirror: syncing {len(refs)} refs under {root_id}")
+
+        with self.db:
+            stored = [i for i, in self.db.execute(_reachable_from, (root_id,))]
+            self.db.executemany("DELETE FROM refs WHERE parent_id = ?", ((i,) for i in stored))
+            self._store_refs(refs)
+            self.db.execute("INSERT OR IGNORE INTO roots VALUES (?, NULL)", (root_id,))
+
+        remote_ids = { root_id }
+        remote_ids.update(i.child_id for i in refs)
+        known = self._modify_times(remote_ids)
+        # Nodes we've never seen can come out of a shared cache, but anything we're refetching
+        # because it changed had better come from the server.
+        fetched = await self._fetch_nodes(remote_ids.difference(known), cached=True)
+        if verify and known:
+            fetched += await self._fetch_nodes(await self._stale_nodes(known))
+        removed = self.collect_garbage()
+
+        with self.db:
+            self.db.execute("UPDATE roots SET synced_at = ? WHERE node_id = ?", (time.time(), root_id))
+        self._synced = True
+        self._changed()
+        stats = SyncStats(len(refs), fetched, len(known) if verify else 0, removed)
+        client.log.debug(f"VaultMirror: {stats}")
+        return stats
+
+    def _on_reconnected(self) -> None:
+        # Flagged right away rather than when the task gets around to running, so nobody trusts
+        # the mirror in between.
+        if self._resync_task is not None:
+            self._resync_task.cancel()
+        self._resync_task = asyncio.create_task(self._catch_up())
+        self._changed()
+
+    async def _catch_up(self) -> None:
+        try:
+            await self.resync()
+        except Exception as e:
+            self._synced = False
+            self.client.log.warning(f"VaultMirror: resync failed: {e!r}")
+
+    async def resync(self) -> None:
+        """Catches up on everything that happened while we weren't listening"""
+        for root_id in self.roots:
+            await self.sync(root_id)
+
+    def forget(self, root_id: int) -> None:
+        """Stops mirroring the tree under root_id"""
+        with self.db:
+            self.db.execute("DELETE FROM roots WHERE node_id = ?", (root_id,))
+        self.collect_garbage()
+
+    async def wait_idle(self) -> None:
+        """Waits until every notification received so far has been applied"""
+        while self._refresher is not None and not self._refresher.done():
+            await asyncio.wait((self._refresher,))
+
+    def _kick(self) -> None:
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.create_task(self._refresh())
+
+    async def _refresh(self) -> None:
+        client = self.client
+        try:
+            while self._dirty or self._new_trees:
+                trees, self._new_trees = self._new_trees, set()
+                for tree_id in trees:
+                    refs = await client.vault_fetch_node_refs(tree_id)
+                    with self.db:
+                        self._store_refs(refs)
+                    known = self._modify_times([i.child_id for i in refs])
+                    self._dirty.update(i.child_id for i in refs if i.child_id not in known)
+
+                dirty, self._dirty = self._dirty, set()
+                await self._fetch_nodes(dirty)
+        except Exception as e:
+            # We've lost track of what changed, so don't vouch for anything until the next sync.
+            self._synced = False
+            client.log.warning(f"VaultMirror: refresh failed: {e!r}")
+
+    def _on_node_changed(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        if netmsg.node_id in self:
+            self._dirty.add(netmsg.node_id)
+            self._kick()
+        self._changed()
+
+    def _on_node_added(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        if netmsg.parent_id in self:
+            with self.db:
+                self._store_refs((VaultNodeRef(netmsg.parent_id, netmsg.child_id, netmsg.owner_id, None),))
+            if netmsg.child_id not in self:
+                # The new child may well bring a whole tree of its own with it.
+                self._dirty.add(netmsg.child_id)
+                self._new_trees.add(netmsg.child_id)
+                self._kick()
+        self._changed()
+
+    def _on_node_removed(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM refs WHERE parent_id = ? AND child_id = ?", (netmsg.parent_id, netmsg.child_id))
+        self.collect_garbage()
+
+    def _on_node_deleted(self, msg_id: int, netmsg: _netio.NetMessage) -> None:
+        self._dirty.discard(netmsg.node_id)
+        with self.db:
+            self._delete_node(netmsg.node_id)
+        self.collect_garbage()
+        self._changed()
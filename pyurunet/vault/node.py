@@ -0,0 +1,233 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from dataclasses import dataclass, fields as _dataclass_fields
+import enum
+import io
+import struct
+from typing import *
+from uuid import UUID
+
+from .._netio.errors import UruNetProtocolError
+
+
+class NodeType(enum.IntEnum):
+    Invalid = 0
+    VNodeMgrLow = 1
+    VNodeMgrPlayer = 2
+    VNodeMgrAge = 3
+    VNodeMgrGameServer = 4
+    VNodeMgrAdmin = 5
+    VNodeMgrServer = 6
+    VNodeMgrCCR = 7
+    VNodeMgrHigh = 21
+    Folder = 22
+    PlayerInfo = 23
+    System = 24
+    Image = 25
+    TextNote = 26
+    SDL = 27
+    AgeLink = 28
+    Chronicle = 29
+    PlayerInfoList = 30
+    Marker = 32
+    AgeInfo = 33
+    AgeInfoList = 34
+    MarkerGame = 35
+
+
+# How each field is stored on the wire
+_uint32, _int32, _uuid, _string, _blob = range(5)
+
+# In field mask bit order.
+_layout = (
+    ("node_id", _uint32),
+    ("create_time", _uint32),
+    ("modify_time", _uint32),
+    ("create_age_name", _string),
+    ("create_age_uuid", _uuid),
+    ("creator_acct", _uuid),
+    ("creator_id", _uint32),
+    ("node_type", _uint32),
+    ("int32_1", _int32),
+    ("int32_2", _int32),
+    ("int32_3", _int32),
+    ("int32_4", _int32),
+    ("uint32_1", _uint32),
+    ("uint32_2", _uint32),
+    ("uint32_3", _uint32),
+    ("uint32_4", _uint32),
+    ("uuid_1", _uuid),
+    ("uuid_2", _uuid),
+    ("uuid_3", _uuid),
+    ("uuid_4", _uuid),
+    ("string64_1", _string),
+    ("string64_2", _string),
+    ("string64_3", _string),
+    ("string64_4", _string),
+    ("string64_5", _string),
+    ("string64_6", _string),
+    ("istring64_1", _string),
+    ("istring64_2", _string),
+    ("text_1", _string),
+    ("text_2", _string),
+    ("blob_1", _blob),
+    ("blob_2", _blob),
+)
+
+_mask = struct.Struct("<Q")
+_uint32_struct = struct.Struct("<I")
+_int32_struct = struct.Struct("<i")
+
+
+@dataclass
+class VaultNode:
+    """A vault node. Fields that are None are not sent, which is also how find templates work:
+       only the fields that are set have to match."""
+
+    node_id: Optional[int] = None
+    create_time: Optional[int] = None
+    modify_time: Optional[int] = None
+    create_age_name: Optional[str] = None
+    create_age_uuid: Optional[UUID] = None
+    creator_acct: Optional[UUID] = None
+    creator_id: Optional[int] = None
+    node_type: Optional[int] = None
+    int32_1: Optional[int] = None
+    int32_2: Optional[int] = None
+    int32_3: Optional[int] = None
+    int32_4: Optional[int] = None
+    uint32_1: Optional[int] = None
+    uint32_2: Optional[int] = None
+    uint32_3: Optional[int] = None
+    uint32_4: Optional[int] = None
+    uuid_1: Optional[UUID] = None
+    uuid_2: Optional[UUID] = None
+    uuid_3: Optional[UUID] = None
+    uuid_4: Optional[UUID] = None
+    string64_1: Optional[str] = None
+    string64_2: Optional[str] = None
+    string64_3: Optional[str] = None
+    string64_4: Optional[str] = None
+    string64_5: Optional[str] = None
+    string64_6: Optional[str] = None
+    istring64_1: Optional[str] = None
+    istring64_2: Optional[str] = None
+    text_1: Optional[str] = None
+    text_2: Optional[str] = None
+    blob_1: Optional[bytes] = None
+    blob_2: Optional[bytes] = None
+
+    @property
+    def field_mask(self) -> int:
+        mask = 0
+        for bit, (name, _) in enumerate(_layout):
+            if getattr(self, name) is not None:
+                mask |= 1 << bit
+        return mask
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """Yields (name, value) for every field that is set"""
+        for name, _ in _layout:
+            if (value := getattr(self, name)) is not None:
+                yield name, value
+
+    def update(self, other: VaultNode) -> None:
+        """Copies every field that is set in other over this node"""
+        for name, value in other.items():
+            setattr(self, name, value)
+
+    def matches(self, template: VaultNode) -> bool:
+        """Checks if this node would be found by a find with template. Like the server, istrings
+           are compared case insensitively."""
+        for name, value in template.items():
+            mine = getattr(self, name)
+            if name.startswith("istring"):
+                if mine is None or mine.casefold() != value.casefold():
+                    return False
+            elif mine != value:
+                return False
+        return True
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, memoryview]) -> VaultNode:
+        return parse_node(data)
+
+    def to_bytes(self) -> bytes:
+        return write_node(self)
+
+
+# Make sure nobody reorders one without the other.
+assert tuple(i.name for i in _dataclass_fields(VaultNode)) == tuple(i[0] for i in _layout)
+
+
+def parse_node(data: Union[bytes, memoryview]) -> VaultNode:
+    view = memoryview(data)
+    try:
+        mask = _mask.unpack_from(view, 0)[0]
+        if mask >> len(_layout):
+            raise UruNetProtocolError(f"Vault node has unknown fields set: {mask:016X}")
+
+        node, pos = VaultNode(), _mask.size
+        for bit, (name, kind) in enumerate(_layout):
+            if not mask & (1 << bit):
+                continue
+            if kind == _uint32:
+                value = _uint32_struct.unpack_from(view, pos)[0]
+                pos += 4
+            elif kind == _int32:
+                value = _int32_struct.unpack_from(view, pos)[0]
+                pos += 4
+            else:
+                if kind == _uuid:
+                    size = 16
+                else:
+                    size = _uint32_struct.unpack_from(view, pos)[0]
+                    pos += 4
+                if pos + size > len(view):
+                    raise UruNetProtocolError(f"Vault node field {name} runs off the end of the node")
+                value = bytes(view[pos:pos + size])
+                pos += size
+                if kind == _uuid:
+                    value = UUID(bytes_le=value)
+                elif kind == _string:
+                    value = value.decode("utf-16-le", errors="replace").rstrip("\0")
+            setattr(node, name, value)
+    except struct.error as e:
+        raise UruNetProtocolError(f"Truncated vault node: {e}") from None
+    return node
+
+def write_node(node: VaultNode) -> bytes:
+    buf = io.BytesIO()
+    buf.write(_mask.pack(node.field_mask))
+    for name, kind in _layout:
+        if (value := getattr(node, name)) is None:
+            continue
+        if kind == _uint32:
+            buf.write(_uint32_struct.pack(value))
+        elif kind == _int32:
+            buf.write(_int32_struct.pack(value))
+        elif kind == _uuid:
+            buf.write(value.bytes_le)
+        else:
+            if kind == _string:
+                value = f"{value}\0".encode("utf-16-le", errors="replace")
+            buf.write(_uint32_struct.pack(len(value)))
+            buf.write(value)
+    return buf.getvalue()
@@ -0,0 +1,368 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import os
+import secrets
+import struct
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import *
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The segment is a header, an open addressed index of (node_id, length, position) slots, then a
+# ring of node records. Positions are absolute byte counts that only ever go up, so a record is
+# still intact as long as the ring hasn't come all the way back around to it - there's no need
+# to track eviction anywhere, old records just fall off the back. The generation goes up with
+# every discard so a fetch that started before one can tell its data may be out of date.
+_magic = b"PyUruNC1"
+_version = 2
+_header = struct.Struct("<8sIIQQQQ")
+_header_size = 64
+_seq_offset = 24
+_head_offset = 32
+_generation_offset = 40
+_u64 = struct.Struct("<Q")
+_slot = struct.Struct("<IIQ")
+_record = struct.Struct("<IIQ")
+
+_empty = 0
+_tombstone = 0xFFFFFFFF
+_max_probe = 32
+
+
+def _align(size: int) -> int:
+    return (size + 15) & ~15
+
+def _open(name: str, create: bool = False, size: int = 0) -> SharedMemory:
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, create=create, size=size, track=False)
+    # Before 3.13, every process that so much as attaches registers the segment with its resource
+    # tracker, which unlinks it out from under everyone else at exit. Worse, forked workers share
+    # their parent's tracker. The segment's lifetime is managed by hand instead.
+    shm = SharedMemory(name, create=create, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _unlink(shm: SharedMemory) -> None:
+    if sys.version_info < (3, 13):
+        # SharedMemory.unlink() tells the tracker to forget about it, so it had better know.
+        resource_tracker.register(shm._name, "shared_memory")
+    shm.unlink()
+
+
+class _FileLock:
+    """Cross process writer lock, since shared memory doesn't come with one"""
+
+    def __init__(self, name: str):
+        self._path = os.path.join(tempfile.gettempdir(), f"{name.lstrip('/')}.lock")
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        # flock doesn't keep threads sharing the descriptor out of each other's way.
+        self._thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SharedNodeCache:
+    """Raw vault node data shared by every process on the machine that opens the same name, so a
+       pool of workers fetches and stores each hood or age node once instead of once apiece.
+       Nodes live in a fixed size ring and the oldest are evicted as new ones come in. Readers
+       never take a lock - writers bump a sequence number around every change and readers simply
+       retry if it moved under them.
+
+       The segment sticks around after every process has closed it, so a restarted pool picks
+       up a warm cache. Call unlink() to get rid of it for good. Without a name, a fresh segment
+       is made up - hand its name to the workers."""
+
+    def __init__(self, name: Optional[str] = None, *, size: int = 64 * 1024 * 1024,
+                 slots: int = 65536, create: Optional[bool] = None,
+                 lock: Optional[ContextManager] = None):
+        if name is None:
+            name, create = f"pyurunet_{secrets.token_hex(6)}", True
+        if lock is None:
+            if fcntl is None:
+                raise RuntimeError("A lock must be provided on platforms without fcntl")
+            lock = _FileLock(name)
+        self._lock = lock
+
+        self.created = False
+        if create is not False:
+            slots = 1 << max(4, (slots - 1).bit_length())
+            size = _align(size)
+            try:
+                self._shm = _open(name, True, _header_size + slots * _slot.size + size)
+            except FileExistsError:
+                if create:
+                    raise
+            else:
+                self.created = True
+                with self._lock:
+                    # Magic goes in last so nobody attaches to a half initialized segment.
+                    _header.pack_into(self._shm.buf, 0, b"\0" * 8, _version, slots, size, 0, 0, 0)
+                    self._shm.buf[0:8] = _magic
+        if not self.created:
+            self._shm = _open(name)
+            self._wait_ready()
+
+        _, version, self._slots, self._data_size, *_ = _header.unpack_from(self._shm.buf, 0)
+        if version != _version:
+            self._shm.close()
+            raise ValueError(f"Shared node cache {name!r} is version {version}, not {_version}")
+        self._mask = self._slots - 1
+        self._index_start = _header_size
+        self._data_start = _header_size + self._slots * _slot.size
+        self.max_record = self._data_size // 4
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.retries = 0
+
+    def _wait_ready(self) -> None:
+        deadline = time.monotonic() + 5.0
+        while bytes(self._shm.buf[0:8]) != _magic:
+            if time.monotonic() > deadline:
+                self._shm.close()
+                raise ValueError(f"{self._shm.name!r} is not a shared node cache")
+            time.sleep(0.001)
+
+    def __repr__(self) -> str:
+        return f"<SharedNodeCache {self.name!r} {self._data_size // 1024}KiB, {self._slots} slots>"
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def nbytes(self) -> int:
+        return self._shm.size
+
+    @property
+    def generation(self) -> int:
+        """Bumped by every discard and clear. Grab it before fetching a node and hand it to put()."""
+        return _u64.unpack_from(self._shm.buf, _generation_offset)[0]
+
+    def close(self) -> None:
+        """Detaches from the segment. The cache is unusable afterwards."""
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+            if isinstance(self._lock, _FileLock):
+                self._lock.close()
+
+    def unlink(self) -> None:
+        """Destroys the segment for everyone and detaches from it. Other processes that are already
+           attached keep working with their mapping until they close it."""
+        if self._shm is None:
+            raise ValueError("Shared node cache is closed")
+        _unlink(self._shm)
+        if isinstance(self._lock, _FileLock):
+            try:
+                os.unlink(self._lock._path)
+            except FileNotFoundError:
+                pass
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        raise TypeError("Pass the cache's name to other processes rather than the cache itself")
+
+    # Reads
+
+    def _home(self, node_id: int) -> int:
+        return ((node_id * 0x9E3779B1) & 0xFFFFFFFF) & self._mask
+
+    def _live(self, pos: int, head: int) -> bool:
+        return head <= pos + self._data_size
+
+    def _find(self, buf, node_id: int) -> Optional[int]:
+        home, index_start = self._home(node_id), self._index_start
+        for i in range(_max_probe):
+            slot = (home + i) & self._mask
+            slot_id, _, _ = _slot.unpack_from(buf, index_start + slot * _slot.size)
+            if slot_id == node_id:
+                return slot
+            if slot_id == _empty:
+                break
+        return None
+
+    def get(self, node_id: int) -> Optional[bytes]:
+        """Returns the node's data, or None if it isn't cached"""
+        buf = self._shm.buf
+        for _ in range(64):
+            seq = _u64.unpack_from(buf, _seq_offset)[0]
+            if seq & 1:
+                self.retries += 1
+                time.sleep(0)
+                continue
+            data = self._read(buf, node_id)
+            if _u64.unpack_from(buf, _seq_offset)[0] == seq:
+                if data is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                return data
+            self.retries += 1
+        # Someone is writing like mad. Fetching the node ourselves will be quicker.
+        self.misses += 1
+        return None
+
+    def _read(self, buf, node_id: int) -> Optional[bytes]:
+        # Anything read here can be garbage if a writer is busy, so check bounds before trusting it.
+        if (slot := self._find(buf, node_id)) is None:
+            return None
+        _, length, pos = _slot.unpack_from(buf, self._index_start + slot * _slot.size)
+        head = _u64.unpack_from(buf, _head_offset)[0]
+        if not self._live(pos, head):
+            return None
+        offset = pos % self._data_size
+        if offset + _record.size + length > self._data_size:
+            return None
+        record_id, record_length, record_pos = _record.unpack_from(buf, self._data_start + offset)
+        if record_id != node_id or record_length != length or record_pos != pos:
+            return None
+        start = self._data_start + offset + _record.size
+        return bytes(buf[start:start + length])
+
+    def __contains__(self, node_id: int) -> bool:
+        # Doesn't count toward the hit rate.
+        buf = self._shm.buf
+        for _ in range(64):
+            seq = _u64.unpack_from(buf, _seq_offset)[0]
+            if not seq & 1:
+                found = self._read(buf, node_id) is not None
+                if _u64.unpack_from(buf, _seq_offset)[0] == seq:
+                    return found
+            time.sleep(0)
+        return False
+
+    def __len__(self) -> int:
+        """Number of live nodes. This is a full scan of the index, so don't go nuts."""
+        with self._lock:
+            buf, head = self._shm.buf, _u64.unpack_from(self._shm.buf, _head_offset)[0]
+            return sum(1 for node_id, _, pos in _slot.iter_unpack(buf[self._index_start:self._data_start])
+                       if node_id not in (_empty, _tombstone) and self._live(pos, head))
+
+    # Writes
+
+    def _begin(self, buf) -> None:
+        # Always lands on odd, even if a writer died halfway through and left it that way.
+        _u64.pack_into(buf, _seq_offset, (_u64.unpack_from(buf, _seq_offset)[0] + 1) | 1)
+
+    def _end(self, buf) -> None:
+        _u64.pack_into(buf, _seq_offset, _u64.unpack_from(buf, _seq_offset)[0] + 1)
+
+    def put(self, node_id: int, data: bytes, *, generation: Optional[int] = None) -> bool:
+        """Stores the node's data, replacing anything cached for it. Returns False if the node is
+           too big to be worth caching, or if anything has been discarded since generation was
+           read - the data may be an old copy of a node that changed in the meantime."""
+        if not 0 < node_id < _tombstone:
+            raise ValueError(f"Invalid node ID {node_id}")
+        length = len(data)
+        size = _align(_record.size + length)
+        if size > self.max_record:
+            return False
+
+        with self._lock:
+            buf = self._shm.buf
+            if generation is not None and _u64.unpack_from(buf, _generation_offset)[0] != generation:
+                return False
+            self._begin(buf)
+            try:
+                head = _u64.unpack_from(buf, _head_offset)[0]
+                offset = head % self._data_size
+                if offset + size > self._data_size:
+                    # Records never wrap, skip ahead to the start of the ring.
+                    head += self._data_size - offset
+                    offset = 0
+                pos = head
+                head += size
+                _u64.pack_into(buf, _head_offset, head)
+                _record.pack_into(buf, self._data_start + offset, node_id, length, pos)
+                start = self._data_start + offset + _record.size
+                buf[start:start + length] = data
+                slot = self._claim_slot(buf, node_id, head)
+                _slot.pack_into(buf, self._index_start + slot * _slot.size, node_id, length, pos)
+            finally:
+                self._end(buf)
+        self.stores += 1
+        return True
+
+    def _claim_slot(self, buf, node_id: int, head: int) -> int:
+        home, index_start = self._home(node_id), self._index_start
+        free, victim, victim_pos = None, home, None
+        for i in range(_max_probe):
+            slot = (home + i) & self._mask
+            slot_id, _, pos = _slot.unpack_from(buf, index_start + slot * _slot.size)
+            if slot_id == node_id:
+                return slot
+            if slot_id == _empty:
+                return slot if free is None else free
+            if free is None and (slot_id == _tombstone or not self._live(pos, head)):
+                free = slot
+            elif victim_pos is None or pos < victim_pos:
+                victim, victim_pos = slot, pos
+        # The neighbourhood is full of live nodes. Kick out the oldest of them.
+        return victim if free is None else free
+
+    def discard(self, node_id: int) -> None:
+        """Forgets the node, eg because it changed on the server"""
+        with self._lock:
+            buf = self._shm.buf
+            self._begin(buf)
+            # Bumped even if we don't have the node, someone may be about to put() it.
+            self._bump_generation(buf)
+            if (slot := self._find(buf, node_id)) is not None:
+                _slot.pack_into(buf, self._index_start + slot * _slot.size, _tombstone, 0, 0)
+            self._end(buf)
+
+    def clear(self) -> None:
+        with self._lock:
+            buf = self._shm.buf
+            self._begin(buf)
+            self._bump_generation(buf)
+            buf[self._index_start:self._data_start] = bytes(self._data_start - self._index_start)
+            self._end(buf)
+
+    def _bump_generation(self, buf) -> None:
+        _u64.pack_into(buf, _generation_offset, _u64.unpack_from(buf, _generation_offset)[0] + 1)
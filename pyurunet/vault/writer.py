@@ -0,0 +1,175 @@
+#    PyUruNet
+#    Copyright (C) 2016  Adam 'Hoikas' Johnson <AdamJohnso AT gmail DOT com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http:#www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+import functools
+import random
+from typing import *
+
+from .. import _netio
+from .node import VaultNode
+
+
+@dataclass
+class _PendingWrite:
+    node: VaultNode = field(default_factory=VaultNode)
+    futures: List[asyncio.Future] = field(default_factory=list)
+
+
+class VaultWriteBuffer:
+    """Holds on to node saves for a moment so that repeated saves of the same node go out as one
+       message carrying every field that was set, later saves winning. Ref adds are batched the
+       same way, minus duplicates. Creates aren't buffered, since you need the new node's ID,
+       but they do share the pipeline.
+
+       Everything sent through here is limited to max_inflight requests at once. If the server
+       says it's busy, the whole pipeline backs off for a while before retrying."""
+
+    def __init__(self, client, *, delay: float = 0.1, max_inflight: int = 8,
+                 busy_backoff: float = 0.5, max_backoff: float = 10.0, max_retries: int = 8):
+        self.client = client
+        self.delay = delay
+        self.max_inflight = max_inflight
+        self.busy_backoff = busy_backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+
+        self.saves_requested = 0
+        self.saves_sent = 0
+        self.busy_retries = 0
+
+        self._saves: Dict[int, _PendingWrite] = {}
+        self._adds: Dict[Tuple[int, int], Tuple[int, List[asyncio.Future]]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._limit: Optional[asyncio.Semaphore] = None
+        self._resume_at = 0.0
+        self._tasks: Set[asyncio.Task] = set()
+        self._node_tasks: Dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        """Number of writes waiting to be sent"""
+        return len(self._saves) + len(self._adds)
+
+    def save(self, node_id: int, node: VaultNode) -> asyncio.Future:
+        """Queues the fields set in node to be saved over node_id. The returned future completes
+           once the (possibly merged) save has gone through."""
+        self.saves_requested += 1
+        if (pending := self._saves.get(node_id)) is None:
+            pending = self._saves[node_id] = _PendingWrite()
+        pending.node.update(node)
+        future = asyncio.get_running_loop().create_future()
+        pending.futures.append(future)
+        self._schedule()
+        return future
+
+    def add(self, parent_id: int, child_id: int, owner_id: int = 0) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        key = (parent_id, child_id)
+        if (pending := self._adds.get(key)) is not None:
+            pending[1].append(future)
+        else:
+            self._adds[key] = (owner_id, [future])
+        self._schedule()
+        return future
+
+    async def create(self, node: VaultNode) -> int:
+        return await self._send(lambda: self.client.vault_create_node(node))
+
+    async def flush(self) -> None:
+        """Sends everything that's waiting and waits for all of it to complete"""
+        self._send_pending()
+        while self._tasks:
+            await asyncio.wait(tuple(self._tasks))
+
+    async def close(self) -> None:
+        await self.flush()
+
+    def _schedule(self) -> None:
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._send_pending)
+
+    def _send_pending(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        saves, self._saves = self._saves, {}
+        adds, self._adds = self._adds, {}
+        for node_id, pending in saves.items():
+            # Saves to the same node have to land in order, so chain them.
+            task = self._spawn(self._save(self._node_tasks.get(node_id), node_id, pending))
+            self._node_tasks[node_id] = task
+            task.add_done_callback(lambda x, node_id=node_id: self._save_done(node_id, x))
+        for (parent_id, child_id), (owner_id, futures) in adds.items():
+            # Bound now - a lambda would see whatever the loop variables are when the task runs.
+            send = functools.partial(self.client.vault_add_node, parent_id, child_id, owner_id)
+            self._spawn(self._resolve(futures, self._send(send)))
+
+    def _spawn(self, coro: Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _save_done(self, node_id: int, task: asyncio.Task) -> None:
+        if self._node_tasks.get(node_id) is task:
+            del self._node_tasks[node_id]
+
+    async def _save(self, previous: Optional[asyncio.Task], node_id: int, pending: _PendingWrite) -> None:
+        if previous is not None:
+            await asyncio.wait((previous,))
+        self.saves_sent += 1
+        await self._resolve(pending.futures, self._send(lambda: self.client.vault_save_node(node_id, pending.node)))
+
+    async def _resolve(self, futures: List[asyncio.Future], coro: Awaitable) -> None:
+        try:
+            result = await coro
+        except Exception as e:
+            self.client.log.warning(f"Buffered vault write failed: {e!r}")
+            for i in futures:
+                if not i.done():
+                    i.set_exception(e)
+        else:
+            for i in futures:
+                if not i.done():
+                    i.set_result(result)
+
+    async def _send(self, request: Callable[[], Awaitable[Any]]) -> Any:
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.max_inflight)
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            if (delay := self._resume_at - loop.time()) > 0.0:
+                await asyncio.sleep(delay)
+            async with self._limit:
+                # Someone else may have been told to back off while we were waiting for a slot.
+                if self._resume_at > loop.time():
+                    continue
+                try:
+                    return await request()
+                except _netio.UruNetServerBusyError:
+                    if attempt >= self.max_retries:
+                        raise
+            delay = min(self.max_backoff, self.busy_backoff * (2 ** attempt)) * random.uniform(0.5, 1.0)
+            self._resume_at = max(self._resume_at, loop.time() + delay)
+            self.busy_retries += 1
+            attempt += 1
+            self.client.log.debug(f"Server is busy, holding vault writes for {delay:.2f}s")